@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""Memory and allocations of the served channels: a dict per channel holding
+a furl of its stream URL (as it used to be) versus immutable channel records
+in a registry with the stream URL split once.
+
+Reported are the memory kept by the channels traced with tracemalloc, time and
+memory allocated while publishing them and per request for a stream lookup
+and a master playlist's entry.
+
+Usage:
+$ python benchmarks/bench_channel_registry.py
+$ python benchmarks/bench_channel_registry.py --copies 100 --number 20000
+"""
+
+import argparse
+import gc
+import pathlib
+import sys
+import timeit
+import tracemalloc
+from typing import Any, Callable, Dict, List, Tuple
+
+from furl import furl
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from ustvgo_iptv import (Channel, ChannelRecord, ChannelRegistry, load_dict,  # noqa: E402
+                         playlist_base_url)
+
+KEY = 'c2VydmVyX3RpbWU9Ni8yMS8yMDIyIDEwOjAwOjAwIFBNJmhhc2hfdmFsdWU9eHl6JnZhbGlkbWludXRlcz0yMA=='
+AUTH_KEYS = [object(), object()]  # stand-ins, only referenced by the old channels
+
+
+def make_listing(copies: int) -> List[Tuple[Channel, str]]:
+    """Channels of channels.json repeated with distinct stream ids and their stream URLs."""
+    listing = []
+    for idx in range(copies):
+        channel: Channel
+        for channel in load_dict('channels.json'):
+            stream_id = f'{channel["stream_id"]}{idx or ""}'
+            stream_kind = 'vipStream' if channel['id'] % 4 == 0 else 'myStream'
+            channel['stream_id'] = stream_id
+            listing.append((channel, f'https://h1.ustvgo.la/{stream_id}/{stream_kind}/playlist.m3u8'
+                                     f'?wmsAuthSign={KEY}'))
+    return listing
+
+
+def old_publish(listing: List[Tuple[Channel, str]]
+                ) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    """Copy of the listing per channel with stream URL, origin, vip flag and auth key."""
+    channels = []
+    for info, stream_url in listing:
+        channel: Dict[str, Any] = dict(info)
+        channel['stream_url'] = furl(stream_url)
+        channel['stream_origin'] = channel['stream_url'].origin
+        channel['is_vip'] = '/vipStream/' in channel['stream_url'].url
+        channel['auth_key'] = AUTH_KEYS[channel['is_vip']]
+        channels.append(channel)
+    return channels, {x['stream_id']: x for x in channels}
+
+
+def old_location(channel: Dict[str, Any]) -> str:
+    location: str = channel['stream_url'].copy().remove(args=['wmsAuthSign']).url
+    return location
+
+
+def old_entry(channel: Dict[str, Any], base_url: furl) -> str:
+    tvg_logo = base_url / 'logos' / (channel['stream_id'] + '.png')
+    stream_url = (furl(base_url,
+                       path=base_url.pathstr + channel['stream_url'].pathstr,
+                       query=channel['stream_url'].querystr)
+                  .remove(args=['wmsAuthSign'])
+                  .tostr(query_dont_quote='='))
+    return ('#EXTINF:-1 tvg-id="{0[stream_id]}" tvg-logo="{1}" '
+            'group-title="{0[category]}",{0[name]}\n{2}\n\n'.format(channel, tvg_logo, stream_url))
+
+
+def new_publish(listing: List[Tuple[Channel, str]]) -> ChannelRegistry:
+    return ChannelRegistry(ChannelRecord.create(info, stream_url) for info, stream_url in listing)
+
+
+def kept_memory(build: Callable[[], Any]) -> Tuple[int, int]:
+    """Memory kept by the built object and peak memory while building it, in bytes."""
+    gc.collect()
+    tracemalloc.start()
+    built = build()
+    gc.collect()
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del built
+    return kept, peak
+
+
+def allocated(case: Callable[[], Any]) -> int:
+    """Peak memory allocated by one call in bytes."""
+    case()  # warm up caches
+    tracemalloc.start()
+    case()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Channel registry memory and allocations benchmark.')
+    parser.add_argument('--copies', type=int, default=10,
+                        help='Times channels.json is repeated to make up the channels')
+    parser.add_argument('--number', type=int, default=10000, help='Requests per case')
+    args = parser.parse_args()
+
+    listing = make_listing(args.copies)
+    base_url = playlist_base_url('192.168.1.2:6363', '')
+    base = base_url.url
+
+    old_channels, old_streams = old_publish(listing)
+    registry = new_publish(listing)
+    stream_id = listing[len(listing) // 2][0]['stream_id']
+    record = registry.get(stream_id)
+    assert record is not None
+    assert old_entry(old_streams[stream_id], base_url) == base.join(record.entry)
+    assert old_location(old_streams[stream_id]) == record.location
+
+    print(f'{len(listing)} channels')
+    print('Kept memory (publishing):')
+    for title, build in (('dicts', lambda: old_publish(listing)),
+                         ('registry', lambda: new_publish(listing))):
+        kept, peak = kept_memory(build)
+        print(f'  {title:>10}: {kept / 2 ** 10:8.1f} KB, {kept / len(listing):6.0f} B/channel, '
+              f'peak {peak / 2 ** 10:8.1f} KB')
+
+    def old_republish() -> None:
+        channels, streams = old_publish(listing)
+        # Changed channels were compared by location
+        {x['stream_id'] for x in channels if old_location(old_streams[x['stream_id']])
+         != old_location(x)}
+
+    def new_republish() -> None:
+        registry.changed(new_publish(listing))
+
+    def old_lookup() -> None:
+        channel = old_streams[stream_id]
+        channel['auth_key'], channel['stream_origin'], channel['stream_url'].pathstr
+
+    def new_lookup() -> None:
+        channel = registry.get(stream_id)
+        assert channel is not None
+        AUTH_KEYS[channel.is_vip], channel.stream_origin, channel.path_qs
+
+    def timed(case: Callable[[], Any], number: int) -> float:
+        return min(timeit.repeat(case, number=number, repeat=3)) / number * 1e6
+
+    slow = max(args.number // 1000, 1)
+    print('Time and allocated memory:')
+    for title, before, after, number in (
+        ('republish', old_republish, new_republish, slow),
+        ('lookup', old_lookup, new_lookup, args.number),
+        ('entry', lambda: old_entry(old_streams[stream_id], base_url),
+         lambda: base.join(registry.by_stream_id[stream_id].entry), args.number),
+    ):
+        before_time, after_time = timed(before, number), timed(after, number)
+        print(f'  {title:>10}: before {before_time:10.2f} us {allocated(before):9d} B, '
+              f'after {after_time:10.2f} us {allocated(after):9d} B  x{before_time / after_time:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""Per-request CPU time of proxying chunklists and segments: rebuilding upstream
+URLs with furl and scanning the chunklist on every request (as it used to be)
+versus parsing each chunklist version once and looking segments up by path.
+
+Usage:
+$ python benchmarks/bench_chunklist.py
+$ python benchmarks/bench_chunklist.py --segments 10 --number 20000
+"""
+
+import argparse
+import pathlib
+import re
+import sys
+import timeit
+from typing import Callable, List, Optional
+from urllib.parse import parse_qsl, urljoin
+
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from furl import furl
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from ustvgo_iptv import (CacheEntry, SegmentCache, SegmentTable, parse_playlist,  # noqa: E402
+                         strip_auth_key, upstream_url)
+
+ORIGIN = 'https://h3.ustvgo.la'
+KEY = 'c2VydmVyX3RpbWU9Ni8yMS8yMDIyIDEwOjAwOjAwIFBNJmhhc2hfdmFsdWU9eHl6JnZhbGlkbWludXRlcz0yMA=='
+CHUNKLIST_PATH = '/ABC/myStream/chunks.m3u8'
+
+
+def make_chunklist(segments: int) -> bytes:
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:4', '#EXT-X-MEDIA-SEQUENCE:100']
+    for idx in range(100, 100 + segments):
+        lines += ['#EXTINF:4.000,', f'media_{idx}.ts?wmsAuthSign={KEY}']
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def playlist_target_duration(content: bytes) -> Optional[int]:
+    match = re.search(rb'#EXT-X-TARGETDURATION:\s*(\d+)', content)
+    return int(match.group(1)) if match else None
+
+
+def playlist_segments(content: bytes) -> List[str]:
+    segments: List[str] = []
+    is_segment = False
+    for line in content.decode(errors='replace').splitlines():
+        line = line.strip()
+        if line.startswith('#EXTINF'):
+            is_segment = True
+        elif line and not line.startswith('#') and is_segment:
+            segments.append(line)
+            is_segment = False
+    return segments
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Chunklist and segment proxying CPU benchmark.')
+    parser.add_argument('--segments', type=int, default=6, help='Segments per chunklist')
+    parser.add_argument('--number', type=int, default=10000, help='Requests per case')
+    args = parser.parse_args()
+
+    content = make_chunklist(args.segments)
+    segment_path_qs = urljoin(CHUNKLIST_PATH, playlist_segments(content)[-1])
+    segment_request = make_mocked_request('GET', segment_path_qs, headers={'Host': '127.0.0.1'})
+    chunklist_request = make_mocked_request('GET', CHUNKLIST_PATH, headers={'Host': '127.0.0.1'})
+
+    def old_segment() -> None:
+        path = segment_request.path
+        SegmentCache.make_key('ABC', path, segment_request.query)
+        (furl(segment_request.path_qs).set(origin=ORIGIN, args={'wmsAuthSign': KEY})
+         ).tostr(query_dont_quote='=')
+
+    def old_chunklist() -> None:
+        entry.response()
+        playlist_target_duration(entry.body)
+        # Prefetcher
+        for uri in playlist_segments(entry.body)[-2:]:
+            path_qs = urljoin(CHUNKLIST_PATH, uri)
+            path, _, query = path_qs.partition('?')
+            SegmentCache.make_key('ABC', path, dict(parse_qsl(query)))
+
+    entry = CacheEntry(content, {'Content-Type': 'application/vnd.apple.mpegurl'})
+    entry.playlist = parse_playlist(content, 'ABC', CHUNKLIST_PATH)
+    table = SegmentTable()
+    table.add(entry.playlist)
+    proxied_path_qs = entry.playlist.segments[-1].path_qs
+
+    def new_segment() -> None:
+        segment = table.get(proxied_path_qs)
+        if segment is None:
+            strip_auth_key(segment_request.path_qs)
+        else:
+            upstream_url(ORIGIN, segment.path_qs, KEY)
+
+    def new_chunklist() -> None:
+        assert entry.playlist is not None
+        web.Response(body=entry.playlist.render(f'http://{chunklist_request.host}'),
+                     headers=entry.headers)
+        entry.playlist.target_duration
+        for segment in entry.playlist.segments[-2:]:
+            segment.cache_key
+
+    def parse() -> None:
+        parse_playlist(content, 'ABC', CHUNKLIST_PATH)
+
+    def timed(case: Callable[[], None]) -> float:
+        number: int = args.number
+        return min(timeit.repeat(case, number=number, repeat=3)) / number * 1e6
+
+    print(f'{args.segments} segments per chunklist, {args.number} requests per case')
+    for title, before, after in (('segment', old_segment, new_segment),
+                                 ('chunklist', old_chunklist, new_chunklist)):
+        before_time, after_time = timed(before), timed(after)
+        print(f'{title:>10}: before {before_time:8.2f} us/request, '
+              f'after {after_time:8.2f} us/request  x{before_time / after_time:.1f}')
+    print(f'Parsing of chunklist once per version: {timed(parse):.2f} us')
+
+
+if __name__ == '__main__':
+    main()
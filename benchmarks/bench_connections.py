@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""Connection churn of the client-facing server: players polling chunklists
+over kept-alive connections versus a new connection per request, and a burst
+of simultaneous new connections against the listen backlog.
+
+Every scenario starts the server with its own arguments against the mock
+of USTVGO. Reported are latency percentiles, connection errors and CPU time
+per request of the server.
+
+Usage:
+$ python benchmarks/bench_connections.py
+$ python benchmarks/bench_connections.py --pollers 200 --gap 0.5 --burst 2000
+"""
+
+import argparse
+import asyncio
+import pathlib
+import shlex
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import urljoin
+
+import aiohttp
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from benchmarks.harness import cpu_time, mock_upstream, percentile, server  # noqa: E402
+
+SCENARIOS = {
+    'default': [],
+    'no-keepalive': ['--keepalive-timeout', '0'],
+    'small-backlog': ['--backlog', '8'],
+    'large-backlog': ['--backlog', '4096'],
+}
+
+
+async def chunklist_url(base_url: str) -> str:
+    """Chunklist of the first channel of the master playlist."""
+    def uris(content: str) -> List[str]:
+        return [x for x in content.splitlines() if x and not x.startswith('#')]
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f'{base_url}/ustvgo.m3u8') as response:
+            stream_url = uris(await response.text())[0]
+        async with session.get(stream_url) as response:
+            return urljoin(str(response.url), uris(await response.text())[-1])
+
+
+async def poll(url: str, pollers: int, gap: float, duration: float,
+               keepalive: bool) -> Tuple[List[float], int]:
+    """Pollers requesting the url every gap seconds, latencies and errors."""
+    latencies: List[float] = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def poller() -> None:
+        nonlocal errors
+        while time.monotonic() < deadline:
+            started_time = time.monotonic()
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    errors += response.status != 200
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.monotonic() - started_time)
+            await asyncio.sleep(max(0.0, gap - (time.monotonic() - started_time)))
+
+    connector = aiohttp.TCPConnector(limit=0, force_close=not keepalive)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[poller() for _ in range(pollers)])
+
+    return latencies, errors
+
+
+async def burst(url: str, connections: int) -> Tuple[List[float], int]:
+    """Simultaneous new connections, one request each."""
+    latencies: List[float] = []
+    errors = 0
+
+    async def connect() -> None:
+        nonlocal errors
+        started_time = time.monotonic()
+        try:
+            async with session.get(url) as response:
+                await response.read()
+                errors += response.status != 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            errors += 1
+        latencies.append(time.monotonic() - started_time)
+
+    connector = aiohttp.TCPConnector(limit=0, force_close=True)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        await asyncio.gather(*[connect() for _ in range(connections)])
+
+    return latencies, errors
+
+
+def report(title: str, latencies: List[float], errors: int, used_cpu_time: float) -> None:
+    print(f'  {title:>10}: {len(latencies):6d} requests, {errors:4d} errors, '
+          f'p50 {percentile(latencies, 0.5) * 1e3:7.1f} ms  '
+          f'p99 {percentile(latencies, 0.99) * 1e3:7.1f} ms  '
+          f'max {max(latencies, default=0) * 1e3:7.1f} ms  '
+          f'CPU {used_cpu_time / max(len(latencies), 1) * 1e3:.3f} ms/request')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Client connection churn benchmark.')
+    parser.add_argument('--scenario', action='append', choices=[*SCENARIOS, 'custom'],
+                        help='Scenarios to run, all but custom by default')
+    parser.add_argument('--server-args', default='', help='Server arguments of custom scenario')
+    parser.add_argument('--pollers', type=int, default=100, help='Number of polling players')
+    parser.add_argument('--gap', type=float, default=1, help='Seconds between polls of a player')
+    parser.add_argument('--duration', type=float, default=15, help='Seconds of polling per mode')
+    parser.add_argument('--burst', type=int, default=1000,
+                        help='Number of simultaneous new connections')
+    parser.add_argument('--port', type=int, default=16363, help='Server port')
+    parser.add_argument('--upstream-port', type=int, default=18080, help='Mock upstream port')
+    args = parser.parse_args()
+
+    scenarios = {**SCENARIOS, 'custom': shlex.split(args.server_args)}
+    base_url = f'http://127.0.0.1:{args.port}'
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            mock_upstream(args.upstream_port, ['--key-lifetime', '0']), \
+            open(pathlib.Path(tmp_dir) / 'server.log', 'w') as log_file:
+        print(f'{args.pollers} players polling every {args.gap:g} s for {args.duration:g} s, '
+              f'burst of {args.burst} connections')
+
+        for name in args.scenario or SCENARIOS:
+            print(f'\n[{name}] {shlex.join(scenarios[name]) or "(defaults)"}')
+            with server(args.port, args.upstream_port, scenarios[name], log_file) as info:
+                url = asyncio.run(chunklist_url(base_url))
+                cases: Dict[str, bool] = {'keep-alive': True, 'new conn': False}
+                for title, keepalive in cases.items():
+                    started_cpu_time = cpu_time(info.pid)
+                    latencies, errors = asyncio.run(poll(url, args.pollers, args.gap,
+                                                         args.duration, keepalive))
+                    report(title, latencies, errors, cpu_time(info.pid) - started_cpu_time)
+
+                started_cpu_time = cpu_time(info.pid)
+                latencies, errors = asyncio.run(burst(url, args.burst))
+                report('burst', latencies, errors, cpu_time(info.pid) - started_cpu_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""Extraction of stream URLs from web player's pages: streaming scan
+(extract_hls_src) versus decoding the whole page and searching it with regex.
+
+First part checks and times extraction from the pages in memory split in chunks,
+the second one scrapes all the channels from the mock upstream over HTTP.
+Pages are synthetic (mock_upstream.player_page padded with filler markup), so the
+timings show the cost of the scan itself rather than how it does on real pages:
+in memory it's no faster than decoding and searching a 32 KB page.
+
+Usage:
+$ python benchmarks/bench_extract.py
+$ python benchmarks/bench_extract.py --page-size 65536 --rounds 10
+"""
+
+import argparse
+import asyncio
+import pathlib
+import re
+import sys
+import time
+from typing import AsyncIterator, List, Optional
+
+from furl import furl
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from benchmarks.harness import mock_upstream  # noqa: E402
+from benchmarks.mock_upstream import player_page  # noqa: E402
+from ustvgo_iptv import (USTVGO_HEADERS, Channel, UpstreamPool, extract_hls_src,  # noqa: E402
+                         load_dict, player_url, retrieve_stream_url)
+
+STREAM_URL = ('https://h3.ustvgo.la/ABC/myStream/playlist.m3u8?wmsAuthSign='
+              'c2VydmVyX3RpbWU9Ni8yMS8yMDIyIDEwOjAwOjAwIFBNJmhhc2hfdmFsdWU9eHl6JnZhbGlkbWludXRlcz0yMA==')
+
+
+async def chunked(page: bytes, chunk_size: int) -> AsyncIterator[bytes]:
+    for idx in range(0, len(page), chunk_size):
+        yield page[idx:idx + chunk_size]
+
+
+def full_page_search(page: bytes) -> Optional[str]:
+    match = re.search(r'hls_src=["\'](?P<stream_url>[^"\']+)', page.decode('utf-8'))
+    return match.group('stream_url') if match else None
+
+
+async def check() -> None:
+    """Same URL for any chunking, including matches straddling the chunks."""
+    page = player_page(STREAM_URL, size=1024).encode()
+    for chunk_size in list(range(1, 300)) + [len(page)]:
+        stream_url = await extract_hls_src(chunked(page, chunk_size))
+        assert stream_url == STREAM_URL, (chunk_size, stream_url)
+    assert await extract_hls_src(chunked(b'<html>hls_src=nothing</html>', 7)) is None
+
+
+async def bench_memory(page_size: int, chunk_size: int, number: int) -> None:
+    print(f'In memory, {page_size // 1024} KB synthetic pages in {chunk_size // 1024} KB chunks:')
+    for position in (0.1, 0.6, 0.95):
+        page = player_page(STREAM_URL, size=page_size, position=position).encode()
+
+        started_time = time.perf_counter()
+        for _ in range(number):
+            full_page_search(page)
+        full_page_time = (time.perf_counter() - started_time) / number
+
+        started_time = time.perf_counter()
+        for _ in range(number):
+            await extract_hls_src(chunked(page, chunk_size))
+        streaming_time = (time.perf_counter() - started_time) / number
+
+        print(f'  hls_src at {position:4.0%}: full page {full_page_time * 1e6:8.1f} us, '
+              f'streaming {streaming_time * 1e6:8.1f} us  x{full_page_time / streaming_time:.1f}')
+
+
+async def retrieve_full_page(channel: Channel, pool: UpstreamPool,
+                             ustvgo_url: str) -> Optional[str]:
+    """The way stream URLs used to be retrieved."""
+    url = player_url(channel, ustvgo_url)
+    async with pool.session(url).get(url=url, headers=USTVGO_HEADERS,
+                                     raise_for_status=True) as response:
+        resp_html = await response.text()
+        match = re.search(r'hls_src=["\'](?P<stream_url>[^"\']+)', resp_html)
+        return furl(match.group('stream_url')).url if match else None
+
+
+async def retrieve_streaming(channel: Channel, pool: UpstreamPool,
+                             ustvgo_url: str) -> Optional[str]:
+    result = await retrieve_stream_url(channel, pool, ustvgo_url=ustvgo_url)
+    return result.stream_url if result else None
+
+
+async def bench_http(upstream_port: int, rounds: int, parallel: int) -> None:
+    channels: List[Channel] = load_dict('channels.json')
+    ustvgo_url = f'http://127.0.0.1:{upstream_port}'
+
+    print(f'Over HTTP, {len(channels)} channels x {rounds} rounds, {parallel} parallel:')
+    for title, retrieve in (('full page', retrieve_full_page), ('streaming', retrieve_streaming)):
+        pool = UpstreamPool()
+        semaphore = asyncio.Semaphore(parallel)
+
+        async def task(channel: Channel) -> Optional[str]:
+            async with semaphore:
+                return await retrieve(channel, pool, ustvgo_url)  # noqa: B023
+
+        started_time, started_cpu_time = time.perf_counter(), time.process_time()
+        for _ in range(rounds):
+            results = await asyncio.gather(*[task(x) for x in channels])
+            assert all(results)
+        elapsed = time.perf_counter() - started_time
+        cpu_time = time.process_time() - started_cpu_time
+        await pool.close()
+
+        pages = len(channels) * rounds
+        print(f'  {title:>10}: {elapsed / pages * 1e3:6.2f} ms/page, '
+              f'CPU {cpu_time / pages * 1e3:6.2f} ms/page')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Stream URL extraction benchmark.')
+    parser.add_argument('--page-size', type=int, default=32 * 1024, help='Player page size')
+    parser.add_argument('--chunk-size', type=int, default=16 * 1024,
+                        help='Chunk size of in-memory pages')
+    parser.add_argument('--number', type=int, default=2000, help='In-memory iterations')
+    parser.add_argument('--rounds', type=int, default=5, help='Rounds of scraping all channels')
+    parser.add_argument('--parallel', type=int, default=10, help='Parallel requests')
+    parser.add_argument('--upstream-port', type=int, default=18080, help='Mock upstream port')
+    args = parser.parse_args()
+
+    asyncio.run(check())
+    asyncio.run(bench_memory(args.page_size, args.chunk_size, args.number))
+    with mock_upstream(args.upstream_port, ['--player-page-size', str(args.page_size)]):
+        asyncio.run(bench_http(args.upstream_port, args.rounds, args.parallel))
+
+
+if __name__ == '__main__':
+    main()
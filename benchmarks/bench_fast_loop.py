@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+"""Startup time, throughput and latency of the stream proxy with and without
+uvloop (--fast-loop) and orjson (--fast-json).
+
+Usage:
+$ pip install uvloop orjson
+$ python benchmarks/bench_fast_loop.py
+$ python benchmarks/bench_fast_loop.py --clients 2 --viewers 100 --duration 20
+"""
+
+import argparse
+import pathlib
+import sys
+import tempfile
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from benchmarks.harness import mock_upstream, run_load, server  # noqa: E402
+
+CASES = {
+    'default': [],
+    '--fast-json': ['--fast-json'],
+    '--fast-loop': ['--fast-loop'],
+    '--fast-loop --fast-json': ['--fast-loop', '--fast-json'],
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark of uvloop and orjson opt-ins.')
+    parser.add_argument('--clients', type=int, default=2, help='Number of client processes')
+    parser.add_argument('--viewers', type=int, default=50, help='Number of viewers')
+    parser.add_argument('--channels', type=int, default=10, help='Number of channels watched')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per case')
+    parser.add_argument('--port', type=int, default=16363, help='Server port')
+    parser.add_argument('--upstream-port', type=int, default=18080, help='Mock upstream port')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir, mock_upstream(args.upstream_port), \
+            open(pathlib.Path(tmp_dir) / 'server.log', 'w') as log_file:
+        print(f'{args.viewers} viewers of {args.channels} channels, {args.duration:g} s per case')
+        baseline = None
+        for title, case_args in CASES.items():
+            with server(args.port, args.upstream_port, case_args, log_file) as info:
+                result = run_load(f'http://127.0.0.1:{args.port}', args.clients, args.viewers,
+                                  args.channels, args.duration)
+
+            baseline = baseline or result['rps']
+            print(f'{title:>24}: startup {info.startup_time:5.2f} s  {result["rps"]:9.1f} req/s  '
+                  f'p50 {result["p50_ms"]:6.1f} ms  p99 {result["p99_ms"]:6.1f} ms  '
+                  f'x{result["rps"] / baseline:.2f}  errors: {result["errors"]:g}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+"""Master playlist microbenchmark.
+
+Compares rendering of the master playlist on every request with furl (as it used to be)
+with joining the entries split beforehand and with serving it from the playlist cache,
+for all the channels of channels.json or a filtered view of them. Re-rendering
+once the channels have changed is timed too.
+
+Usage:
+$ python benchmarks/bench_master_playlist.py
+$ python benchmarks/bench_master_playlist.py --requests 5000
+"""
+
+import argparse
+import io
+import pathlib
+import sys
+import timeit
+from typing import Any, Dict, List
+
+from aiohttp.test_utils import make_mocked_request
+from furl import furl
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from ustvgo_iptv import (ChannelRecord, ChannelRegistry, ChannelView, PlaylistCache,  # noqa: E402
+                         load_dict, playlist_base_url, render_playlist, render_playlist_header)
+
+
+def former_render_playlist(channels: List[Dict[str, Any]], host: str,
+                           use_uncompressed_tvguide: bool, password: str) -> str:
+    """Former rendering of master playlist, stream URLs are processed with furl every time."""
+    with io.StringIO() as f:
+        base_url = furl(netloc=host, scheme='http', path=password)
+        tvg_compressed_ext = '' if use_uncompressed_tvguide else '.gz'
+        tvg_url = base_url / f'tvguide.xml{tvg_compressed_ext}'
+
+        f.write('#EXTM3U url-tvg="%s" refresh="1800"\n\n' % tvg_url)
+        for channel in channels:
+            if channel.get('stream_url'):
+                tvg_logo = base_url / 'logos' / (channel['stream_id'] + '.png')
+                stream_url = (furl(base_url,
+                                   path=base_url.pathstr + channel['stream_url'].pathstr,
+                                   query=channel['stream_url'].querystr)
+                              # No need to expose auth key to the master playlist
+                              .remove(args=['wmsAuthSign'])
+                              .tostr(query_dont_quote='='))
+
+                f.write(('#EXTINF:-1 tvg-id="{0[stream_id]}" tvg-logo="{1}" '
+                         'group-title="{0[category]}",{0[name]}\n'.format(channel, tvg_logo)))
+                f.write(f'{stream_url}\n\n')
+
+        return f.getvalue()
+
+
+def make_channels() -> List[ChannelRecord]:
+    """All the channels with fake stream URLs as if they were collected."""
+    channels = []
+    for channel in load_dict('channels.json'):
+        stream_kind = 'vipStream' if channel['id'] % 4 == 0 else 'myStream'
+        channels.append(ChannelRecord.create(
+            channel, f'https://h1.ustvgo.la/{channel["stream_id"]}/'
+                     f'{stream_kind}/playlist.m3u8?wmsAuthSign=c2VydmVyX3RpbWU9'
+        ))
+    return channels
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Master playlist microbenchmark.')
+    parser.add_argument('--requests', type=int, default=1000, help='Number of requests')
+    args = parser.parse_args()
+
+    channels = make_channels()
+    # Channels as they used to be kept, listings with furl of the stream URL
+    former_channels = [{**x.info, 'stream_url': furl(x.stream_url)} for x in channels]
+    registry = ChannelRegistry(channels)
+    host, password = '192.168.1.2:6363', ''
+    request = make_mocked_request('GET', '/ustvgo.m3u8', headers={'Host': host})
+    gzip_request = make_mocked_request('GET', '/ustvgo.m3u8',
+                                       headers={'Host': host, 'Accept-Encoding': 'gzip'})
+
+    cache = PlaylistCache(
+        lambda view: (registry.by_stream_id[x].entry for x in registry.select(view)),
+        lambda host, view: render_playlist_header(host, False, password, view.query),
+        lambda host: playlist_base_url(host, password).url
+    )
+    news = ChannelView.from_query([('category', 'News'), ('language', 'en')])
+
+    def update() -> None:
+        cache.invalidate()
+        cache.get(host, password, 'False')
+
+    # Rendering with furl is slow, it's timed with fewer requests
+    slow = max(args.requests // 100, 1)
+    cases = {
+        'render per request': (lambda: former_render_playlist(former_channels, host, False,
+                                                              password), slow),
+        'join per request': (lambda: render_playlist([x.entry for x in channels], host, False,
+                                                     password), args.requests),
+        'cached': (lambda: cache.get(host, password, 'False').response(request), args.requests),
+        'cached gzip': (lambda: cache.get(host, password, 'False').response(gzip_request),
+                        args.requests),
+        'filter per request': (lambda: former_render_playlist(
+            [x for x in former_channels if x['category'] == 'News' and x['language'] == 'en'],
+            host, False, password), slow),
+        'cached view': (lambda: cache.get(host, password, 'False', view=news).response(request),
+                        args.requests),
+        'channels update': (update, args.requests),
+    }
+
+    print(f'{len(channels)} channels, {args.requests} requests')
+    baseline = None
+    for title, (case, number) in cases.items():
+        elapsed = min(timeit.repeat(case, number=number, repeat=3))
+        per_request = elapsed / number * 1e6
+        baseline = baseline or per_request
+        print(f'{title:>20}: {per_request:10.1f} us/request  x{baseline / per_request:.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+"""End-to-end load benchmark suite, runs offline against the mock of USTVGO.
+
+Every scenario starts the server with its own arguments and the viewers
+spread across the channels watch them at real-time pace (or back-to-back
+with --no-pace) while the auth keys keep rotating. Reported are throughput,
+latency percentiles of playlists and segments, peak memory and CPU time
+per request of the server and the number of requests the upstream got.
+
+Usage:
+$ python benchmarks/bench_suite.py
+$ python benchmarks/bench_suite.py --viewers 200 --channels 20 --duration 60
+$ python benchmarks/bench_suite.py --scenario default --scenario no-cache --no-pace
+$ python benchmarks/bench_suite.py --scenario custom --server-args="--prefetch-segments 0"
+"""
+
+import argparse
+import pathlib
+import shlex
+import sys
+import tempfile
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from benchmarks.harness import (cpu_time, mock_upstream, run_load, server,  # noqa: E402
+                                upstream_stats)
+
+SCENARIOS = {
+    'default': [],
+    'no-cache': ['--segment-cache-size', '0', '--prefetch-segments', '0'],
+    'lazy': ['--lazy'],
+    'workers': ['--workers', '2'],
+    'fast': ['--fast-loop', '--fast-json'],
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='End-to-end load benchmark suite.')
+    parser.add_argument('--scenario', action='append', choices=[*SCENARIOS, 'custom'],
+                        help='Scenarios to run, all but custom by default')
+    parser.add_argument('--server-args', default='', help='Server arguments of custom scenario')
+    parser.add_argument('--viewers', type=int, default=100, help='Number of viewers (M)')
+    parser.add_argument('--channels', type=int, default=10, help='Number of channels watched (K)')
+    parser.add_argument('--clients', type=int, default=2, help='Number of client processes')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds per scenario')
+    parser.add_argument('--no-pace', dest='paced', action='store_false',
+                        help='Fetch back-to-back instead of every target duration')
+    parser.add_argument('--segment-size', type=int, default=512 * 1024,
+                        help='Size of upstream segments in bytes')
+    parser.add_argument('--segment-latency', type=float, default=0.02,
+                        help='Upstream segment latency in seconds')
+    parser.add_argument('--key-lifetime', type=float, default=20,
+                        help='Seconds till upstream auth keys expire, 0 keeps them forever')
+    parser.add_argument('--port', type=int, default=16363, help='Server port')
+    parser.add_argument('--upstream-port', type=int, default=18080, help='Mock upstream port')
+    args = parser.parse_args()
+
+    scenarios = {**SCENARIOS, 'custom': shlex.split(args.server_args)}
+    mock_args = ['--segment-size', str(args.segment_size),
+                 '--segment-latency', str(args.segment_latency),
+                 '--key-lifetime', str(args.key_lifetime)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            mock_upstream(args.upstream_port, mock_args), \
+            open(pathlib.Path(tmp_dir) / 'server.log', 'w') as log_file:
+        print(f'{args.viewers} viewers of {args.channels} channels '
+              f'{"at real-time pace" if args.paced else "back-to-back"}, '
+              f'{args.duration:g} s per scenario, auth keys expire every {args.key_lifetime:g} s')
+
+        for name in args.scenario or SCENARIOS:
+            upstream_stats(args.upstream_port, reset=True)
+            with server(args.port, args.upstream_port, scenarios[name], log_file) as info:
+                started_cpu_time = cpu_time(info.pid)
+                result = run_load(f'http://127.0.0.1:{args.port}', args.clients, args.viewers,
+                                  args.channels, args.duration, paced=args.paced)
+                used_cpu_time = cpu_time(info.pid) - started_cpu_time
+            upstream = upstream_stats(args.upstream_port)
+
+            print(f'\n[{name}] {shlex.join(scenarios[name]) or "(defaults)"}')
+            print(f'  startup {info.startup_time:.2f} s, peak RSS {info.max_rss / 2 ** 20:.1f} MB, '
+                  f'CPU {used_cpu_time / max(result["requests"], 1) * 1e3:.3f} ms/request')
+            print(f'  {result["rps"]:.1f} req/s, {result["mbps"]:.1f} MB/s, '
+                  f'{result["requests"]:g} requests, {result["errors"]:g} errors')
+            for kind in ('m3u8', 'ts'):
+                print(f'  {kind:>5} p50 {result[f"{kind}_p50_ms"]:7.1f} ms  '
+                      f'p90 {result[f"{kind}_p90_ms"]:7.1f} ms  '
+                      f'p99 {result[f"{kind}_p99_ms"]:7.1f} ms')
+            print('  upstream: ' + ', '.join(f'{kind}={count}'
+                                             for kind, count in sorted(upstream.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+"""Peak memory and time to first byte of serving transformed TV Guide:
+buffered path (as it used to be) downloading the whole guide, decompressing it,
+filtering it with iterparse and compressing it back in one piece versus
+streaming transform of the chunks as they arrive.
+
+Every case runs in its own process so its peak RSS isn't shared with the others,
+upstream is imitated by chunks of the gzipped guide arriving at the bandwidth.
+Transformed guide is kept in memory in both paths, as the server caches it.
+
+Usage:
+$ python benchmarks/bench_tvguide.py
+$ python benchmarks/bench_tvguide.py --hours 168 --bandwidth 20
+"""
+
+import argparse
+import datetime
+import gzip
+import io
+import multiprocessing
+import pathlib
+import sys
+import time
+import zlib
+from typing import Callable, FrozenSet, Iterator, List, Optional, Tuple
+from xml.etree import ElementTree
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from benchmarks.mock_upstream import MockUpstream  # noqa: E402
+from ustvgo_iptv import (ASSET_CHUNK_SIZE, TvGuideTransform, inflate, load_dict,  # noqa: E402
+                         local_icon_url)
+
+LOGOS_URL = 'http://192.168.1.2:6363/logos/'
+
+# Time to first byte, kept memory (downloaded and transformed guide), output size
+Outcome = Tuple[float, List[bytes], int]
+# Time to first byte, total time, peak RSS growth in bytes, output size
+Result = Tuple[float, float, int, int]
+
+
+def buffered_filter(compressed: bytes, channel_ids: FrozenSet[str]) -> bytes:
+    """Former filter of XMLTV by the channels, whole guide decompressed and parsed."""
+    root: Optional[ElementTree.Element] = None
+    depth = 0
+    with io.BytesIO() as f, gzip.GzipFile(fileobj=io.BytesIO(compressed)) as source:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        for event, element in ElementTree.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                if root is None:
+                    root = element
+                    f.write(ElementTree.tostring(ElementTree.Element(element.tag, element.attrib),
+                                                 encoding='unicode').partition(' />')[0].encode()
+                            + b'>\n')
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth == 1 and root is not None:
+                if (element.get('id') or element.get('channel')) in channel_ids:
+                    element.tail = '\n'
+                    f.write(ElementTree.tostring(element, encoding='utf-8'))
+                root.clear()
+
+        assert root is not None
+        f.write(f'</{root.tag}>\n'.encode())
+        return f.getvalue()
+
+
+def arriving(body: bytes, bandwidth: float) -> Iterator[bytes]:
+    """Chunks of the body arriving at the bandwidth in bytes per second, 0 is unlimited."""
+    for idx in range(0, len(body), ASSET_CHUNK_SIZE):
+        chunk = body[idx:idx + ASSET_CHUNK_SIZE]
+        if bandwidth:
+            time.sleep(len(chunk) / bandwidth)
+        yield chunk
+
+
+def buffered(body: bytes, bandwidth: float, channel_ids: FrozenSet[str],
+             is_compressed: bool) -> Outcome:
+    """Time to the first byte and the output of the buffered path."""
+    started_time = time.monotonic()
+    downloaded = b''.join(arriving(body, bandwidth))
+    content = buffered_filter(downloaded, channel_ids)
+    if is_compressed:
+        content = gzip.compress(content)
+    return time.monotonic() - started_time, [downloaded, content], len(content)
+
+
+def streaming(body: bytes, bandwidth: float,
+              make_transform: Callable[[], TvGuideTransform]) -> Outcome:
+    """Time to the first byte and the output of the streaming path, it's gzipped
+    for .xml too as the clients accepting it get it with Content-Encoding."""
+    started_time = time.monotonic()
+    first_byte_time = 0.0
+    transform = make_transform()
+    downloaded: List[bytes] = []
+    output: List[bytes] = []
+    for chunk in arriving(body, bandwidth):
+        downloaded.append(chunk)
+        chunk = transform.feed(chunk)
+        output.append(chunk)
+        if chunk and not first_byte_time:
+            first_byte_time = time.monotonic() - started_time
+    output.append(transform.close())
+    content = b''.join(output)
+    return first_byte_time, [b''.join(downloaded), content], len(content)
+
+
+def memory_status(field: str) -> int:
+    """Memory of the process from its status in bytes (Linux only)."""
+    status = pathlib.Path('/proc/self/status').read_text()
+    return next(int(x.split()[1]) * 1024 for x in status.splitlines() if x.startswith(field + ':'))
+
+
+def make_tvguide(hours: int) -> Tuple[bytes, int]:
+    """Gzipped TV Guide of the mock upstream and its uncompressed size."""
+    body = MockUpstream(tvguide_hours=hours).make_tvguide('for-dark-bg')
+    return body, len(gzip.decompress(body))
+
+
+def buffered_plain(body: bytes, bandwidth: float) -> Outcome:
+    """Time to the first byte and the output of the former uncompressed guide."""
+    started_time = time.monotonic()
+    downloaded = b''.join(arriving(body, bandwidth))
+    content = gzip.decompress(downloaded)
+    return time.monotonic() - started_time, [downloaded, content], len(content)
+
+
+def streaming_plain(body: bytes, bandwidth: float) -> Outcome:
+    """Time to the first byte of the guide decompressed as it arrives for the clients
+    not accepting gzip, the output isn't kept."""
+    started_time = time.monotonic()
+    first_byte_time = 0.0
+    downloaded: List[bytes] = []
+    size = 0
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    for chunk in arriving(body, bandwidth):
+        downloaded.append(chunk)
+        for piece in inflate(decompressor, chunk):
+            size += len(piece)
+            if not first_byte_time:
+                first_byte_time = time.monotonic() - started_time
+    return first_byte_time, [b''.join(downloaded)], size
+
+
+def run_case(case: Callable[[], Outcome],
+             queue: 'multiprocessing.Queue[Result]') -> None:
+    pathlib.Path('/proc/self/clear_refs').write_text('5')  # reset peak RSS
+    before = memory_status('VmRSS')
+    started_time = time.monotonic()
+    first_byte_time, kept, output_size = case()
+    total_time = time.monotonic() - started_time
+    after = memory_status('VmHWM')
+    queue.put((first_byte_time, total_time, after - before, output_size))
+
+
+def measure(case: Callable[[], Outcome]) -> Result:
+    # Forked to run the case without pickling it
+    context = multiprocessing.get_context('fork')
+    queue: 'multiprocessing.Queue[Result]' = context.Queue()
+    process = context.Process(target=run_case, args=(case, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Streaming TV Guide transform benchmark.')
+    parser.add_argument('--hours', type=int, default=72, help='Hours of programmes in TV Guide')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='Upstream bandwidth in MB/s, 0 is unlimited')
+    args = parser.parse_args()
+
+    # Guide is made in a child process, so the cases don't inherit the memory it took
+    with multiprocessing.get_context('fork').Pool(1) as pool:
+        body, size = pool.apply(make_tvguide, (args.hours,))
+    channels = load_dict('channels.json')
+    channel_ids = frozenset(x['stream_id'] for x in channels[:len(channels) // 4])
+    bandwidth = args.bandwidth * 2 ** 20
+
+    def transform(channel_ids: Optional[FrozenSet[str]] = None,
+                  icon_url: Optional[Callable[[str], str]] = None,
+                  time_shift: Optional[datetime.timedelta] = None) -> Callable[[], TvGuideTransform]:
+        return lambda: TvGuideTransform(channel_ids, icon_url, time_shift)
+
+    icon_url = lambda src: local_icon_url(src, LOGOS_URL)  # noqa: E731
+    shift = datetime.timedelta(hours=-1)
+    cases: List[Tuple[str, Optional[Callable[[], Outcome]], Callable[[], Outcome]]] = [
+        ('plain .xml', lambda: buffered_plain(body, bandwidth),
+         lambda: streaming_plain(body, bandwidth)),
+        ('filter .gz', lambda: buffered(body, bandwidth, channel_ids, True),
+         lambda: streaming(body, bandwidth, transform(channel_ids))),
+        ('filter .xml', lambda: buffered(body, bandwidth, channel_ids, False),
+         lambda: streaming(body, bandwidth, transform(channel_ids))),
+        ('icons', None, lambda: streaming(body, bandwidth, transform(icon_url=icon_url))),
+        ('shift', None, lambda: streaming(body, bandwidth, transform(time_shift=shift))),
+        ('all', None, lambda: streaming(body, bandwidth,
+                                        transform(channel_ids, icon_url, shift))),
+    ]
+
+    print(f'TV Guide: {len(channels)} channels, {args.hours} hours, '
+          f'{len(body) / 2 ** 20:.1f} MB gzipped, {size / 2 ** 20:.1f} MB, '
+          f'bandwidth {args.bandwidth or "unlimited"} MB/s')
+    for title, before, after in cases:
+        for path, case in (('buffered', before), ('streaming', after)):
+            if case is None:
+                continue
+            first_byte_time, total_time, peak_rss, output_size = measure(case)
+            print(f'  {title:>12} {path:>9}: TTFB {first_byte_time * 1000:8.1f} ms, '
+                  f'total {total_time * 1000:8.1f} ms, peak RSS +{peak_rss / 2 ** 20:6.1f} MB, '
+                  f'output {output_size / 2 ** 10:8.1f} KB')
+
+
+if __name__ == '__main__':
+    main()
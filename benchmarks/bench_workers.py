@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+"""Throughput of the server depending on the number of worker processes.
+
+Loads the server running against the mock upstream with viewers fetching
+chunklists and segments back-to-back, mostly served from the segment cache.
+
+Usage:
+$ python benchmarks/bench_workers.py
+$ python benchmarks/bench_workers.py --workers 1 2 4 --clients 4 --duration 20
+"""
+
+import argparse
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from benchmarks.harness import mock_upstream, run_load, server  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Throughput depending on the number of workers.')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, min(4, os.cpu_count() or 1)], help='Worker counts to compare')
+    parser.add_argument('--clients', type=int, default=4, help='Number of client processes')
+    parser.add_argument('--viewers', type=int, default=100, help='Number of viewers')
+    parser.add_argument('--channels', type=int, default=10, help='Number of channels watched')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per case')
+    parser.add_argument('--port', type=int, default=16363, help='Server port')
+    parser.add_argument('--upstream-port', type=int, default=18080, help='Mock upstream port')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir, mock_upstream(args.upstream_port), \
+            open(pathlib.Path(tmp_dir) / 'server.log', 'w') as log_file:
+        print(f'{args.viewers} viewers of {args.channels} channels, {args.duration:g} s per case')
+        baseline = None
+        for workers in args.workers:
+            with server(args.port, args.upstream_port, ['--workers', str(workers)], log_file):
+                time.sleep(1 + workers * 0.5)  # let all the workers bind
+                result = run_load(f'http://127.0.0.1:{args.port}', args.clients, args.viewers,
+                                  args.channels, args.duration)
+
+            baseline = baseline or result['rps']
+            print(f'{workers:>3} workers: {result["rps"]:9.1f} req/s {result["mbps"]:8.1f} MB/s  '
+                  f'p99 {result["p99_ms"]:7.1f} ms  x{result["rps"] / baseline:.2f}  '
+                  f'errors: {result["errors"]:g}')
+
+
+if __name__ == '__main__':
+    main()
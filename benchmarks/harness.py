@@ -0,0 +1,250 @@
+"""Running the server against the mock upstream and loading it with viewers."""
+
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import pathlib
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from types import SimpleNamespace
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urljoin
+
+import aiohttp
+
+ROOT_DIR = pathlib.Path(__file__).resolve().parent.parent
+
+# Per kind of request: latencies, errors, bytes
+Results = Dict[str, Tuple[List[float], int, int]]
+
+
+def upstream_stats(port: int, reset: bool = False) -> Dict[str, int]:
+    """Number of requests the mock upstream got by kind."""
+    url = f'http://127.0.0.1:{port}/' + ('_reset' if reset else '_stats')
+    with urllib.request.urlopen(urllib.request.Request(url, method='POST' if reset else 'GET')) as f:
+        stats: Dict[str, int] = json.loads(f.read())
+        return stats
+
+
+@contextlib.contextmanager
+def mock_upstream(port: int, args: Optional[List[str]] = None) -> Iterator[None]:
+    """Run mock upstream in a separate process."""
+    process = subprocess.Popen([sys.executable, str(ROOT_DIR / 'benchmarks' / 'mock_upstream.py'),
+                                '--port', str(port)] + (args or []))
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                upstream_stats(port)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        yield
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def process_tree(pid: int) -> List[int]:
+    """The process and its children (Linux only)."""
+    pids = [pid]
+    for stat_path in pathlib.Path('/proc').glob('[0-9]*/stat'):
+        try:
+            if int(stat_path.read_text().rsplit(')', 1)[1].split()[1]) == pid:
+                pids.append(int(stat_path.parent.name))
+        except (OSError, IndexError, ValueError):
+            pass
+
+    return pids
+
+
+def cpu_time(pid: int) -> float:
+    """CPU time of the process and its children in seconds (Linux only)."""
+    total = 0
+    for x in process_tree(pid):
+        try:
+            # utime and stime fields after the command name
+            fields = pathlib.Path(f'/proc/{x}/stat').read_text().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            pass
+
+    return total / os.sysconf('SC_CLK_TCK')
+
+
+def rss(pid: int) -> int:
+    """Resident memory of the process and its children in bytes (Linux only)."""
+    total = 0
+    for x in process_tree(pid):
+        try:
+            total += int((pathlib.Path(f'/proc/{x}/statm')).read_text().split()[1])
+        except (OSError, IndexError, ValueError):
+            pass
+
+    return total * os.sysconf('SC_PAGE_SIZE')
+
+
+@contextlib.contextmanager
+def server(port: int, upstream_port: int, args: List[str],
+           log_file: Any) -> Iterator[SimpleNamespace]:
+    """Run the server against the mock upstream, yield its pid and startup time,
+    i.e. till the master playlist is served, and peak memory sampled meanwhile."""
+    started_time = time.monotonic()
+    upstream_url = f'http://127.0.0.1:{upstream_port}'
+    process = subprocess.Popen(
+        [sys.executable, str(ROOT_DIR / 'ustvgo_iptv.py'), '--port', str(port),
+         '--ustvgo-url', upstream_url, '--tvguide-base-url', f'{upstream_url}/tvguide'] + args,
+        stdout=log_file, stderr=log_file, start_new_session=True
+    )
+
+    info = SimpleNamespace(pid=process.pid, startup_time=0.0, max_rss=0)
+    stopped = threading.Event()
+
+    def sample_memory() -> None:
+        while not stopped.wait(0.5):
+            info.max_rss = max(info.max_rss, rss(process.pid))
+
+    sampler = threading.Thread(target=sample_memory, daemon=True)
+    sampler.start()
+    try:
+        wait_for_server(f'http://127.0.0.1:{port}')
+        info.startup_time = time.monotonic() - started_time
+        yield info
+    finally:
+        stopped.set()
+        sampler.join()
+        # Whole process group, including the workers
+        os.killpg(process.pid, signal.SIGINT)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)
+
+
+def wait_for_server(base_url: str, timeout: float = 60) -> None:
+    async def probe() -> None:
+        deadline = time.monotonic() + timeout
+        async with aiohttp.ClientSession() as session:
+            while time.monotonic() < deadline:
+                try:
+                    async with session.get(f'{base_url}/ustvgo.m3u8') as response:
+                        if response.status == 200:
+                            return
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.05)
+        raise RuntimeError('Server has not started')
+
+    asyncio.run(probe())
+
+
+async def watch(base_url: str, viewers: int, channels: int, duration: float,
+                paced: bool) -> Results:
+    """Viewers of the channels of the master playlist, each one fetches the chunklist
+    and its new segments every target duration like players do or back-to-back unless paced."""
+    results: Dict[str, Tuple[List[float], List[int], List[int]]] = {}
+    deadline = time.monotonic() + duration
+
+    async def get(url: str, kind: str) -> Tuple[int, bytes, str]:
+        latencies, errors, sizes = results.setdefault(kind, ([], [0], [0]))
+        started_time = time.monotonic()
+        try:
+            async with session.get(url) as response:
+                content = await response.read()
+                status = response.status
+                url = str(response.url)  # after redirects
+        except aiohttp.ClientError:
+            content, status = b'', 0
+        latencies.append(time.monotonic() - started_time)
+        errors[0] += status != 200
+        sizes[0] += len(content)
+        return status, content, url
+
+    def uris(content: bytes) -> List[str]:
+        return [x for x in content.decode().splitlines() if x and not x.startswith('#')]
+
+    async def viewer(stream_url: str) -> None:
+        status, content, stream_url = await get(stream_url, 'm3u8')
+        if status != 200 or not uris(content):
+            return
+
+        chunks_url = urljoin(stream_url, uris(content)[-1])
+        seen: List[str] = []
+        while time.monotonic() < deadline:
+            started_time = time.monotonic()
+            status, content, _ = await get(chunks_url, 'm3u8')
+            segments = uris(content) if status == 200 else []
+            # Start at the live edge
+            for segment in segments[-1:] if not seen else segments:
+                name = segment.split('?')[0]
+                if name not in seen:
+                    seen = (seen + [name])[-10:]
+                    await get(urljoin(chunks_url, segment), 'ts')
+
+            if paced:
+                target_duration = next((int(x.split(':')[1]) for x in content.decode().splitlines()
+                                        if x.startswith('#EXT-X-TARGETDURATION:')), 2)
+                await asyncio.sleep(max(0.0, target_duration - (time.monotonic() - started_time)))
+
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        _, master, _ = await get(f'{base_url}/ustvgo.m3u8', 'master')
+        await get(f'{base_url}/tvguide.xml.gz', 'tvguide')
+        stream_urls = uris(master)[:channels]
+        await asyncio.gather(*[viewer(stream_urls[idx % len(stream_urls)])
+                               for idx in range(viewers)])
+
+    return {kind: (latencies, errors[0], sizes[0])
+            for kind, (latencies, errors, sizes) in results.items()}
+
+
+def client(base_url: str, viewers: int, channels: int, duration: float, paced: bool,
+           queue: 'multiprocessing.Queue[Results]') -> None:
+    queue.put(asyncio.run(watch(base_url, viewers, channels, duration, paced)))
+
+
+def percentile(values: List[float], share: float) -> float:
+    return sorted(values)[min(int(len(values) * share), len(values) - 1)] if values else 0
+
+
+def run_load(base_url: str, clients: int, viewers: int, channels: int, duration: float,
+             paced: bool = False) -> Dict[str, float]:
+    """Load the server with the viewers spread across client processes."""
+    queue: 'multiprocessing.Queue[Results]' = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=client, args=(
+        base_url, viewers // clients + (idx < viewers % clients), channels, duration, paced, queue
+    )) for idx in range(clients)]
+    for process in processes:
+        process.start()
+    totals = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    summary = {'requests': 0.0, 'errors': 0.0, 'bytes': 0.0}
+    for kind in ('m3u8', 'ts'):
+        latencies = [x for results in totals for x in results.get(kind, ([], 0, 0))[0]]
+        summary[f'{kind}_p50_ms'] = percentile(latencies, 0.5) * 1000
+        summary[f'{kind}_p90_ms'] = percentile(latencies, 0.9) * 1000
+        summary[f'{kind}_p99_ms'] = percentile(latencies, 0.99) * 1000
+
+    latencies = []
+    for results in totals:
+        for kind, (kind_latencies, errors, size) in results.items():
+            summary['requests'] += len(kind_latencies)
+            summary['errors'] += errors
+            summary['bytes'] += size
+            latencies.extend(kind_latencies)
+
+    summary['rps'] = summary['requests'] / duration
+    summary['mbps'] = summary['bytes'] / duration / 2 ** 20
+    summary['p50_ms'] = percentile(latencies, 0.5) * 1000
+    summary['p99_ms'] = percentile(latencies, 0.99) * 1000
+    return summary
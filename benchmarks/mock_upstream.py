@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+"""Mock of USTVGO for the benchmarks.
+
+Imitates the web player (player.php) handing out stream URLs with auth keys,
+stream servers of VIP and non-VIP channels with live chunklists and segments,
+and TV Guide / logos origin. Auth keys rotate, expired ones get 403.
+
+Usage:
+$ python benchmarks/mock_upstream.py --port 18080
+$ python benchmarks/mock_upstream.py --segment-size 1048576 --segment-latency 0.05 --key-lifetime 60
+
+Server:
+$ ./ustvgo_iptv.py --ustvgo-url http://127.0.0.1:18080 \
+      --tvguide-base-url http://127.0.0.1:18080/tvguide
+"""
+
+import argparse
+import asyncio
+import base64
+import datetime
+import gzip
+import hashlib
+import io
+import pathlib
+import sys
+import time
+import zlib
+from typing import Dict, Optional
+from xml.sax.saxutils import escape, quoteattr
+
+from aiohttp import web
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+from ustvgo_iptv import load_dict  # noqa: E402
+
+TARGET_DURATION = 2
+WINDOW = 3  # segments in a chunklist
+PNG = base64.b64decode('iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNk'
+                       '+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg==')
+
+
+def player_page(stream_url: str, size: int = 32 * 1024, position: float = 0.6) -> str:
+    """Web player's page of about the size with hls_src at the relative position,
+    laid out like the real one: styles and scripts around the player's setup."""
+    filler = ('<script>!function(e,t){"object"==typeof exports?module.exports=t():e.lib=t()}'
+              '(this,function(){var n={version:"1.0",init:function(o){return o||{}}};'
+              'return n});</script>\n<style>.player-wrapper{position:relative;width:100%;'
+              'padding-top:56.25%}.player{position:absolute;top:0;left:0}</style>\n')
+    player = ('<div id="player" class="player-wrapper"></div>\n<script>\n'
+              f"var hls_src='{stream_url}';\n"
+              'var player = new Clappr.Player({source: hls_src, parentId: "#player"});\n'
+              '</script>\n')
+    head = '<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>Player</title>\n'
+    body_size = max(0, size - len(head) - len(player))
+    before = filler * int(body_size * position / len(filler))
+    after = filler * int(body_size * (1 - position) / len(filler))
+    return f'{head}{before}</head><body>\n{player}{after}</body></html>\n'
+
+
+class MockUpstream:
+    """USTVGO state and handlers."""
+
+    def __init__(self, segment_size: int = 512 * 1024, segment_latency: float = 0,
+                 key_lifetime: float = 0, vip_share: float = 0.25,
+                 player_page_size: int = 32 * 1024, tvguide_hours: int = 24) -> None:
+        self.segment = b'G' + bytes(segment_size - 1)  # MPEG-TS sync byte
+        self.segment_latency = segment_latency
+        self.key_lifetime = key_lifetime  # 0 keeps the keys forever
+        self.vip_share = vip_share
+        self.player_page_size = player_page_size
+        self.tvguide_hours = tvguide_hours
+        self.started_time = time.time()
+        self.channels = load_dict('channels.json')
+        self.requests: Dict[str, int] = {}
+        self.tvguide: Dict[str, bytes] = {}
+
+    def count(self, kind: str) -> None:
+        self.requests[kind] = self.requests.get(kind, 0) + 1
+
+    def is_vip(self, stream_id: str) -> bool:
+        return zlib.crc32(stream_id.encode()) % 100 < self.vip_share * 100
+
+    def auth_key(self, is_vip: bool, period: Optional[int] = None) -> str:
+        """Auth key of the period, encoded like the real ones."""
+        if period is None:
+            period = int((time.time() - self.started_time) // self.key_lifetime) \
+                if self.key_lifetime else 0
+        server_time = int(self.started_time + period * self.key_lifetime)
+        hash_value = hashlib.md5(f'{is_vip}{period}'.encode()).hexdigest()
+        valid_minutes = max(1, int(self.key_lifetime // 60)) if self.key_lifetime else 1440
+        key = f'server_time={server_time}&hash_value={hash_value}&validminutes={valid_minutes}'
+        return base64.b64encode(key.encode()).decode()
+
+    def authorize(self, request: web.Request) -> str:
+        """Current auth key of the stream, 403 unless the request has it."""
+        key = self.auth_key(request.match_info['kind'] == 'vipStream')
+        if request.query.get('wmsAuthSign') != key:
+            self.count('forbidden')
+            raise web.HTTPForbidden()
+        return key
+
+    async def player(self, request: web.Request) -> web.Response:
+        self.count('player')
+        stream_id = request.query.get('stream', '')
+        is_vip = self.is_vip(stream_id)
+        kind = 'vipStream' if is_vip else 'myStream'
+        stream_url = (f'http://{request.host}/{stream_id}/{kind}/playlist.m3u8'
+                      f'?wmsAuthSign={self.auth_key(is_vip)}')
+        return web.Response(text=player_page(stream_url, self.player_page_size),
+                            content_type='text/html')
+
+    async def playlist(self, request: web.Request) -> web.Response:
+        self.count('playlist')
+        key = self.authorize(request)
+        return web.Response(text=('#EXTM3U\n#EXT-X-VERSION:3\n'
+                                  '#EXT-X-STREAM-INF:BANDWIDTH=2000000\n'
+                                  f'chunks.m3u8?wmsAuthSign={key}\n'),
+                            content_type='application/vnd.apple.mpegurl')
+
+    async def chunks(self, request: web.Request) -> web.Response:
+        self.count('chunks')
+        key = self.authorize(request)
+        sequence = int(time.time() // TARGET_DURATION)
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', f'#EXT-X-TARGETDURATION:{TARGET_DURATION}',
+                 f'#EXT-X-MEDIA-SEQUENCE:{sequence}']
+        for idx in range(sequence, sequence + WINDOW):
+            lines += [f'#EXTINF:{TARGET_DURATION}.000,', f'media_{idx}.ts?wmsAuthSign={key}']
+
+        return web.Response(text='\n'.join(lines) + '\n',
+                            content_type='application/vnd.apple.mpegurl')
+
+    async def segment_handler(self, request: web.Request) -> web.Response:
+        self.count('segment')
+        self.authorize(request)
+        if self.segment_latency:
+            await asyncio.sleep(self.segment_latency)
+        return web.Response(body=self.segment, content_type='video/mp2t')
+
+    def make_tvguide(self, color_scheme: str) -> bytes:
+        """XMLTV of all the channels, a programme per hour for the hours."""
+        base_url = 'https://raw.githubusercontent.com/interlark/ustvgo-tvguide/master'
+        start = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0,
+                                                                     microsecond=0)
+        with io.StringIO() as f:
+            f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n')
+            for channel in self.channels:
+                icon = f'{base_url}/images/icons/channels/{color_scheme}/{channel["stream_id"]}.png'
+                f.write(f'  <channel id={quoteattr(channel["stream_id"])}>\n'
+                        f'    <display-name>{escape(channel["name"])}</display-name>\n'
+                        f'    <icon src={quoteattr(icon)}/>\n'
+                        '  </channel>\n')
+            for channel in self.channels:
+                for hour in range(self.tvguide_hours):
+                    programme_start = start + datetime.timedelta(hours=hour)
+                    programme_stop = programme_start + datetime.timedelta(hours=1)
+                    f.write(f'  <programme start="{programme_start:%Y%m%d%H%M%S %z}" '
+                            f'stop="{programme_stop:%Y%m%d%H%M%S %z}" '
+                            f'channel={quoteattr(channel["stream_id"])}>\n'
+                            f'    <title lang="en">{escape(channel["name"])} at {hour}</title>\n'
+                            f'    <desc lang="en">{"Lorem ipsum dolor sit amet. " * 8}</desc>\n'
+                            '  </programme>\n')
+            f.write('</tv>\n')
+            return gzip.compress(f.getvalue().encode())
+
+    async def tvguide_handler(self, request: web.Request) -> web.Response:
+        self.count('tvguide')
+        color_scheme = request.match_info['color_scheme']
+        if color_scheme not in self.tvguide:
+            self.tvguide[color_scheme] = self.make_tvguide(color_scheme)
+        return self.static_response(request, self.tvguide[color_scheme], 'application/gzip')
+
+    async def logo_handler(self, request: web.Request) -> web.Response:
+        self.count('logo')
+        return self.static_response(request, PNG, 'image/png')
+
+    def static_response(self, request: web.Request, body: bytes,
+                        content_type: str) -> web.Response:
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if request.headers.get('If-None-Match') == etag:
+            self.count('not_modified')
+            return web.Response(status=304, headers={'ETag': etag})
+        return web.Response(body=body, content_type=content_type, headers={'ETag': etag})
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.requests)
+
+    async def reset(self, request: web.Request) -> web.Response:
+        self.requests.clear()
+        return web.json_response(self.requests)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_post('/_reset', self.reset)
+        app.router.add_get('/player.php', self.player)
+        app.router.add_get('/tvguide/ustvgo.{color_scheme}.xml.gz', self.tvguide_handler)
+        app.router.add_get('/tvguide/images/icons/channels/{color_scheme}/{name}', self.logo_handler)
+        app.router.add_get('/{stream_id}/{kind:myStream|vipStream}/playlist.m3u8', self.playlist)
+        app.router.add_get('/{stream_id}/{kind:myStream|vipStream}/chunks.m3u8', self.chunks)
+        app.router.add_get('/{stream_id}/{kind:myStream|vipStream}/{name}.ts',
+                           self.segment_handler)
+        return app
+
+
+def args_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Mock of USTVGO.')
+    parser.add_argument('--port', type=int, default=18080, help='Port to listen')
+    parser.add_argument('--segment-size', type=int, default=512 * 1024,
+                        help='Size of segments in bytes')
+    parser.add_argument('--segment-latency', type=float, default=0,
+                        help='Delay of segment responses in seconds')
+    parser.add_argument('--key-lifetime', type=float, default=0,
+                        help='Seconds till auth keys expire, 0 keeps them forever')
+    parser.add_argument('--vip-share', type=float, default=0.25, help='Share of VIP channels')
+    parser.add_argument('--player-page-size', type=int, default=32 * 1024,
+                        help='Size of web player pages in bytes')
+    parser.add_argument('--tvguide-hours', type=int, default=24,
+                        help='Hours of programmes in TV Guide, scales its size')
+    return parser
+
+
+def main() -> None:
+    args = args_parser().parse_args()
+    upstream = MockUpstream(args.segment_size, args.segment_latency, args.key_lifetime,
+                            args.vip_share, args.player_page_size, args.tvguide_hours)
+    web.run_app(upstream.make_app(), host='127.0.0.1', port=args.port, print=None,
+                access_log=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,16 +2,36 @@
 
 import argparse
 import asyncio
+import base64
+import contextlib
+import datetime
+import email.utils
 import functools
+import gzip
+import hashlib
 import io
 import json
 import logging
+import math
+import multiprocessing
+import os
 import pathlib
+import random
 import re
 import sys
+import socket
 import time
-from typing import Any, Awaitable, Callable, List, Optional
-from urllib.parse import quote_plus
+import xml.sax.expatreader
+import xml.sax.handler
+import xml.sax.saxutils
+import xml.sax.xmlreader
+import zlib
+from collections import OrderedDict, deque
+from multiprocessing.connection import Connection
+from types import SimpleNamespace
+from typing import (Any, AsyncIterator, Awaitable, Callable, Deque, Dict, FrozenSet, Iterable,
+                    Iterator, List, Mapping, NamedTuple, Optional, Sequence, Set, Tuple, Union)
+from urllib.parse import parse_qsl, quote, quote_plus, urlencode, urljoin, urlsplit
 
 import aiohttp
 import netifaces
@@ -24,9 +44,11 @@ if sys.version_info >= (3, 8):
 else:
     from typing_extensions import TypedDict
 
+# Listing of the channel as it's loaded from channels.json
 Channel = TypedDict('Channel', {'id': int, 'stream_id': str, 'tvguide_id': str,
-                                'name': str, 'category': str, 'language': str,
-                                'stream_url': furl})
+                                'name': str, 'category': str, 'language': str})
+
+Handler = Callable[[web.Request], Awaitable[web.StreamResponse]]
 
 # Fix for https://github.com/pyinstaller/pyinstaller/issues/1113
 ''.encode('idna')
@@ -50,302 +72,3747 @@ Channel = TypedDict('Channel', {'id': int, 'stream_id': str, 'tvguide_id': str,
 VERSION = '0.1.12'
 USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
               '(KHTML, like Gecko) Chrome/102.0.5005.63 Safari/537.36')
-USTVGO_HEADERS = {'Referer': 'https://ustvgo.tv', 'User-Agent': USER_AGENT}
+USTVGO_URL = 'https://ustvgo.tv'
+USTVGO_HEADERS = {'Referer': USTVGO_URL, 'User-Agent': USER_AGENT}
+
+# Stream URL within web player's page, closing quote ensures it's complete
+HLS_SRC_PREFIX = b'hls_src='
+HLS_SRC_PATTERN = re.compile(rb'hls_src=["\'](?P<stream_url>[^"\']+)["\']')
+# Max size of the match carried over to the next chunk of the page
+HLS_SRC_MAX_SIZE = 4096
+# Max size of web player's page read to the end after the stream URL is found
+PLAYER_PAGE_DRAIN_SIZE = 256 * 1024
+# Seconds before expired auth key is renewed again if renewal didn't get a new key
+AUTH_KEY_RETRY_DELAY = 5
+
+# Cache lifetime of the playlists without target duration (multivariant)
+PLAYLIST_DEFAULT_TTL = 5
+
+# Master playlist entry of the channel in lazy mode, redirects to the resolved stream
+LAZY_PLAYLIST_NAME = 'ustvgo.m3u8'
+# Time not to retry resolving the channel in lazy mode after it failed
+LAZY_FAILURE_TTL = 60
+
+# Revalidation periods of TV Guide (updated twice an hour) and channel logos
+TVGUIDE_MAX_AGE = 10 * 60
+LOGOS_MAX_AGE = 24 * 60 * 60
+# Upstream errors, e.g. missing logos, are revalidated sooner
+ASSET_ERROR_MAX_AGE = 60
+# Max number of assets kept in memory, least recently used ones are dropped
+MAX_ASSETS = 512
+# Max number of variants derived from an asset, e.g. TV Guides of the channel views
+MAX_ASSET_VARIANTS = 16
+# Assets are fetched and TV Guide is processed by chunks of this size
+ASSET_CHUNK_SIZE = 64 * 1024
+
+# Client request headers that must not be forwarded to pooled keep-alive upstream connections
+HOP_BY_HOP_HEADERS = frozenset(x.lower() for x in (
+    aiohttp.hdrs.HOST, aiohttp.hdrs.USER_AGENT, aiohttp.hdrs.CONNECTION, 'Keep-Alive',
+    aiohttp.hdrs.PROXY_AUTHORIZATION, aiohttp.hdrs.TE, aiohttp.hdrs.TRAILER,
+    aiohttp.hdrs.TRANSFER_ENCODING, aiohttp.hdrs.UPGRADE,
+))
 
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s :: %(levelname)s :: %(message)s',
     datefmt='%H:%M:%S'
 )
 
-logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
+
+
+def root_dir() -> pathlib.Path:
+    """Root directory."""
+    if hasattr(sys, '_MEIPASS'):
+        return pathlib.Path(sys._MEIPASS)
+    else:
+        return pathlib.Path(__file__).parent
+
+
+class JSON:
+    """JSON codec, orjson is used once enabled if it's installed."""
+
+    orjson: Any = None
+
+    @classmethod
+    def enable_orjson(cls) -> bool:
+        try:
+            import orjson
+        except ImportError:
+            return False
+
+        cls.orjson = orjson
+        return True
+
+    @classmethod
+    def loads(cls, data: bytes) -> Any:
+        return cls.orjson.loads(data) if cls.orjson else json.loads(data)
+
+    @classmethod
+    def dumps(cls, obj: Any) -> bytes:
+        return cls.orjson.dumps(obj) if cls.orjson else json.dumps(obj).encode()
+
+
+def enable_fast_loop() -> bool:
+    """Use uvloop event loop for the following asyncio.run() if it's installed."""
+    try:
+        import uvloop
+    except ImportError:
+        return False
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return True
+
+
+def load_dict(filename: str) -> Any:
+    """Load root dictionary."""
+    filepath = root_dir() / filename
+    return JSON.loads(filepath.read_bytes())
+
+
+def local_ip_addresses() -> List[str]:
+    """Finding all local IP addresses."""
+    ip_addresses: List[str] = []
+    interfaces = netifaces.interfaces()
+    for i in interfaces:
+        iface = netifaces.ifaddresses(i).get(netifaces.AF_INET, [])
+        ip_addresses.extend(x['addr'] for x in iface)
+
+    return ip_addresses
+
+
+def parse_bind(bind: str, port: int) -> Tuple[Optional[str], int, Optional[str]]:
+    """Host (None for all interfaces), port and Unix socket path of bind address
+    given as HOST, HOST:PORT, [IPV6]:PORT or unix:PATH."""
+    if bind.startswith('unix:'):
+        return None, port, bind[len('unix:'):]
+    # Bare IPv6 address
+    if bind.count(':') > 1 and not bind.startswith('['):
+        return bind, port, None
+
+    split = urlsplit('//' + bind)
+    return split.hostname or None, split.port or port, None
+
+
+def served_base_urls(binds: List[str], port: int) -> List[str]:
+    """Base URLs of the bound addresses, wildcard ones are expanded to the local ones."""
+    urls: List[str] = []
+    for bind in binds:
+        host, bind_port, path = parse_bind(bind, port)
+        if path is not None:
+            urls.append(f'unix:{path}')
+        elif host in (None, '0.0.0.0', '::'):
+            urls.extend(f'http://{x}:{bind_port}' for x in local_ip_addresses())
+        else:
+            urls.append(f'http://[{host}]:{bind_port}' if ':' in str(host) else
+                        f'http://{host}:{bind_port}')
+
+    return urls
+
+
+def proxy_response_headers(headers: Mapping[str, str]) -> Dict[str, str]:
+    """Upstream response headers which are passed to the client."""
+    return {name: value for name, value in headers.items()
+            if name not in
+            (aiohttp.hdrs.CONTENT_ENCODING, aiohttp.hdrs.CONTENT_LENGTH,
+             aiohttp.hdrs.TRANSFER_ENCODING, aiohttp.hdrs.CONNECTION)}
+
+
+def client_address(request: web.Request, ip_header: Optional[str] = None) -> str:
+    """Client's address its requests are accounted by: IP from the header set by trusted
+    reverse proxy, if any, peer's IP or the connection itself on Unix socket."""
+    if ip_header:
+        value = request.headers.get(ip_header)
+        if value:
+            # Proxy appends the address it's connected from to the ones the client claims
+            return value.rsplit(',', 1)[-1].strip()
+
+    if request.remote:
+        return request.remote
+
+    return f'connection:{id(request.transport)}'
+
+
+def url_origin(url: str) -> str:
+    """Origin part (scheme://netloc) of URL."""
+    parts = urlsplit(url)
+    return f'{parts.scheme}://{parts.netloc}'
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 10) -> float:
+    """Exponential backoff delay with jitter, attempts are counted from 1."""
+    delay = min(cap, base * 2.0 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def upstream_failed(e: BaseException) -> Optional[bool]:
+    """Whether the error means origin is down or overloaded, None if it's unrelated to origin."""
+    if isinstance(e, asyncio.CancelledError):
+        return None
+    if isinstance(e, aiohttp.ClientResponseError):
+        return e.status >= 500 or e.status == 429
+    if isinstance(e, (asyncio.TimeoutError, aiohttp.ClientConnectionError,
+                      aiohttp.ClientPayloadError)):
+        return True
+    return None
+
+
+class CircuitOpenError(Exception):
+    """Origin is down, requests to it fail fast."""
+
+    def __init__(self, origin: str, retry_after: float) -> None:
+        super().__init__(f'Upstream {origin} is down, retry in {retry_after:.0f} s')
+        self.origin = origin
+        self.retry_after = retry_after
+
+
+class OriginLimiter:
+    """AIMD concurrency limit of upstream origin with circuit breaker.
+
+    The limit grows by one per response (slow start) till the first congestion,
+    then by one per round trip, and halves on failures or responses way slower
+    than usual. Consecutive failures open the circuit for exponentially growing
+    time, after that a single probe request decides whether to close it.
+    """
+
+    def __init__(self, origin: str, initial_limit: int, min_limit: int, max_limit: int,
+                 failure_threshold: int, open_time: float, max_open_time: float,
+                 slow_latency: float) -> None:
+        self.origin = origin
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.failure_threshold = failure_threshold
+        self.open_time = open_time
+        self.max_open_time = max_open_time
+        self.slow_latency = slow_latency  # never considered slow below that
+        self.slow_start = True
+        self.in_flight = 0
+        self.waiters: Deque['asyncio.Future[None]'] = deque()
+        self.latency = 0.0  # moving average of time to response
+        self.baseline_latency = 0.0  # same but slowly moving
+        self.decreased_time = 0.0
+        self.failures = 0  # consecutive
+        self.openings = 0  # consecutive openings of the circuit
+        self.open_until = 0.0
+        self.probing = False
+        self.requests = 0
+        self.errors = 0
+        self.rejected = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= self.failure_threshold
+
+    def _check(self) -> bool:
+        """Fail fast while circuit is open, let one request probe origin after that."""
+        if not self.is_open:
+            return False
+
+        now = time.monotonic()
+        if now < self.open_until or self.probing:
+            self.rejected += 1
+            raise CircuitOpenError(self.origin, max(self.open_until - now, 0))
+
+        self.probing = True
+        return True
+
+    async def acquire(self) -> bool:
+        """Wait for a free slot, return whether it's the probe request."""
+        is_probe = self._check()
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            return is_probe
+
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter  # slot is handed over by release()
+        except BaseException:
+            if waiter.done() and not waiter.cancelled() and waiter.exception() is None:
+                self.release(is_probe, None, 0)
+            else:
+                with contextlib.suppress(ValueError):
+                    self.waiters.remove(waiter)
+                self.probing = self.probing and not is_probe
+            raise
+
+        return is_probe
+
+    def release(self, is_probe: bool, failed: Optional[bool], latency: float) -> None:
+        """Free the slot, adapt the limit to the outcome of the request, if any."""
+        self.in_flight -= 1
+        if is_probe:
+            self.probing = False
+        if failed is not None:
+            self._record(is_probe, failed, latency)
+
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def _record(self, is_probe: bool, failed: bool, latency: float) -> None:
+        self.requests += 1
+        if failed:
+            self.errors += 1
+            self.failures += 1
+            self._decrease()
+            if is_probe or self.failures == self.failure_threshold:
+                self._open()
+            return
+
+        self.failures = 0
+        self.openings = 0
+        if self.baseline_latency:
+            self.latency += (latency - self.latency) * 0.2
+            self.baseline_latency += (latency - self.baseline_latency) * 0.02
+        else:
+            self.latency = self.baseline_latency = latency
+
+        if latency > max(self.slow_latency, self.baseline_latency * 4):
+            self._decrease()
+        elif self.slow_start:
+            self.limit = min(self.limit + 1, self.max_limit)
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+
+    def _decrease(self) -> None:
+        # Once per round trip, the requests in flight see the same congestion
+        now = time.monotonic()
+        if now - self.decreased_time > max(self.latency, 0.1):
+            self.decreased_time = now
+            self.limit = max(self.limit / 2, self.min_limit)
+            self.slow_start = False
+
+    def _open(self) -> None:
+        self.openings += 1
+        open_time = backoff_delay(self.openings, base=self.open_time, cap=self.max_open_time)
+        self.open_until = time.monotonic() + open_time
+        logger.warning('Upstream %s is down, failing fast for %.1f s.', self.origin, open_time)
+
+        # Queued requests won't get through either
+        waiters, self.waiters = self.waiters, deque()
+        for waiter in waiters:
+            if not waiter.done():
+                self.rejected += 1
+                waiter.set_exception(CircuitOpenError(self.origin, open_time))
+
+
+class UpstreamSlot:
+    """Slot of origin's concurrency limit held for the time of upstream request."""
+
+    def __init__(self, limiter: OriginLimiter) -> None:
+        self.limiter = limiter
+        self.is_probe = False
+        self.started_time = 0.0
+        self.latency: Optional[float] = None
+
+    def response_started(self) -> None:
+        """Response headers arrived, latency is measured till now."""
+        if self.latency is None:
+            self.latency = time.monotonic() - self.started_time
+
+    async def __aenter__(self) -> 'UpstreamSlot':
+        self.is_probe = await self.limiter.acquire()
+        self.started_time = time.monotonic()
+        return self
+
+    async def __aexit__(self, exc_type: Any, exc: Optional[BaseException], tb: Any) -> None:
+        latency = self.latency if self.latency is not None \
+            else time.monotonic() - self.started_time
+        self.limiter.release(self.is_probe, upstream_failed(exc) if exc else False, latency)
+
+
+class UpstreamLimiter:
+    """Adaptive concurrency limits and circuit breakers of upstream origins."""
+
+    def __init__(self, initial_limit: int = 10, min_limit: int = 1, max_limit: int = 32,
+                 failure_threshold: int = 5, open_time: float = 5, max_open_time: float = 60,
+                 slow_latency: float = 1) -> None:
+        self.options: Dict[str, Any] = dict(
+            initial_limit=min(initial_limit, max_limit), min_limit=min_limit, max_limit=max_limit,
+            failure_threshold=failure_threshold, open_time=open_time, max_open_time=max_open_time,
+            slow_latency=slow_latency
+        )
+        self.origins: Dict[str, OriginLimiter] = {}
+
+    def origin(self, url: str, initial_limit: Optional[int] = None) -> OriginLimiter:
+        """Limiter of origin of URL, new one starts with the initial limit or the default one."""
+        origin = url_origin(url)
+        limiter = self.origins.get(origin)
+        if limiter is None:
+            options = self.options if initial_limit is None else {
+                **self.options, 'initial_limit': min(initial_limit, self.options['max_limit'])
+            }
+            limiter = self.origins[origin] = OriginLimiter(origin, **options)
+        return limiter
+
+    def slot(self, url: str, initial_limit: Optional[int] = None) -> UpstreamSlot:
+        """Slot for request to origin of URL, raises CircuitOpenError if it's down."""
+        return UpstreamSlot(self.origin(url, initial_limit))
+
+    def stats(self) -> Dict[str, float]:
+        """Limiter statistics."""
+        limiters = self.origins.values()
+        return {'limiter_in_flight': sum(x.in_flight for x in limiters),
+                'limiter_queued': sum(len(x.waiters) for x in limiters),
+                'limiter_errors': sum(x.errors for x in limiters),
+                'limiter_rejected': sum(x.rejected for x in limiters),
+                'limiter_open_circuits': sum(x.is_open for x in limiters)}
+
+    def collect(self) -> Iterable[Tuple[str, 'Labels', float]]:
+        """Per-origin gauges for metrics."""
+        for origin, limiter in list(self.origins.items()):
+            labels = (('origin', origin),)
+            yield 'upstream_concurrency_limit', labels, int(limiter.limit)
+            yield 'upstream_in_flight', labels, limiter.in_flight
+            yield 'upstream_queued', labels, len(limiter.waiters)
+            yield 'upstream_latency_seconds', labels, limiter.latency
+            yield 'upstream_circuit_open', labels, int(limiter.is_open)
+            yield 'upstream_rejected_total', labels, limiter.rejected
+
+
+class UpstreamPool:
+    """App-lifetime pool of keep-alive upstream sessions keyed by origin."""
+
+    def __init__(self, pool_size: int = 32, dns_cache_ttl: int = 300,
+                 keepalive_timeout: float = 30, read_bufsize: int = 2 ** 18,
+                 limiter: Optional[UpstreamLimiter] = None) -> None:
+        self.pool_size = pool_size
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.read_bufsize = read_bufsize  # per-connection read buffer high-water mark
+        self.sessions: Dict[str, aiohttp.ClientSession] = {}
+        # Requests are made within limiter's slots
+        self.limiter = limiter or UpstreamLimiter(max_limit=pool_size)
+        self.hits = 0  # requests served by already opened connection
+        self.misses = 0  # requests that had to open new connection
+
+        self.trace_config = aiohttp.TraceConfig()
+        self.trace_config.on_connection_reuseconn.append(self._on_connection_reuse)
+        self.trace_config.on_connection_create_end.append(self._on_connection_create)
+
+    async def _on_connection_reuse(self, session: aiohttp.ClientSession, ctx: SimpleNamespace,
+                                   params: aiohttp.TraceConnectionReuseconnParams) -> None:
+        self.hits += 1
+
+    async def _on_connection_create(self, session: aiohttp.ClientSession, ctx: SimpleNamespace,
+                                    params: aiohttp.TraceConnectionCreateEndParams) -> None:
+        self.misses += 1
+
+    def session(self, url: str) -> aiohttp.ClientSession:
+        """Get pooled session for origin of URL."""
+        origin = url_origin(url)
+        session = self.sessions.get(origin)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                ssl=False, limit=self.pool_size, limit_per_host=self.pool_size,
+                ttl_dns_cache=self.dns_cache_ttl, keepalive_timeout=self.keepalive_timeout
+            )
+            session = aiohttp.ClientSession(connector=connector, read_bufsize=self.read_bufsize,
+                                            trace_configs=[self.trace_config])
+            self.sessions[origin] = session
+
+        return session
+
+    def stats(self) -> Dict[str, float]:
+        """Pool statistics."""
+        return {'pool_sessions': len(self.sessions), 'pool_hits': self.hits,
+                'pool_misses': self.misses}
+
+    async def close(self) -> None:
+        """Close all pooled sessions."""
+        sessions, self.sessions = self.sessions, {}
+        for session in sessions.values():
+            await session.close()
+
+
+# Response to upstream request and the contexts to exit when it's done with
+Attempt = Tuple[aiohttp.ClientResponse, contextlib.AsyncExitStack]
+
+
+class OriginHealth:
+    """Passively and actively measured health of upstream origin."""
+
+    __slots__ = ('ttfb', 'throughput', 'segment_size', 'error_rate', 'samples', 'recorded',
+                 'ttfb_p95', 'measured_time')
+
+    def __init__(self) -> None:
+        self.ttfb = 0.0  # moving averages
+        self.throughput = 0.0  # bytes per second
+        self.segment_size = 0.0
+        self.error_rate = 0.0
+        self.samples: Deque[float] = deque(maxlen=200)  # recent TTFBs
+        self.recorded = 0
+        self.ttfb_p95 = 0.0
+        self.measured_time = 0.0
+
+    def record_ttfb(self, ttfb: float) -> None:
+        self.ttfb = ttfb if not self.recorded else self.ttfb + (ttfb - self.ttfb) * 0.2
+        self.error_rate *= 0.9
+        self.samples.append(ttfb)
+        self.recorded += 1
+        self.measured_time = time.monotonic()
+        # Recomputed once in a while, it's needed on every segment request
+        if self.recorded % 20 == 0:
+            samples = sorted(self.samples)
+            self.ttfb_p95 = samples[int(len(samples) * 0.95) - 1]
+
+    def record_transfer(self, size: int, duration: float) -> None:
+        throughput = size / max(duration, 0.001)
+        if self.throughput:
+            self.throughput += (throughput - self.throughput) * 0.2
+            self.segment_size += (size - self.segment_size) * 0.2
+        else:
+            self.throughput, self.segment_size = throughput, size
+
+    def record_error(self) -> None:
+        self.error_rate += (1 - self.error_rate) * 0.1
+        self.measured_time = time.monotonic()
+
+    @property
+    def score(self) -> Optional[float]:
+        """Expected time to fetch a segment, lower is better, None if it's not measured yet."""
+        if not self.recorded:
+            return None
+        transfer_time = self.segment_size / self.throughput if self.throughput else 0
+        return (self.ttfb + transfer_time) * (1 + 4 * self.error_rate)
+
+
+class OriginRegistry:
+    """Origins seen serving VIP and non-VIP streams, scored by their health.
+
+    Requests of a channel are routed to its own origin unless another one of
+    the same kind is clearly healthier or its circuit is open. Slow segment
+    requests are hedged: once there's no response after p95 of origin's TTFB,
+    the next origin is requested too and the first response is taken.
+    Origins that haven't been measured for a while are probed with playlist requests.
+    """
+
+    def __init__(self, pool: UpstreamPool, hedging: bool = True, probe_interval: float = 30,
+                 min_hedge_delay: float = 0.05, exclude_time: float = 300,
+                 initial_limit: Optional[int] = None) -> None:
+        self.pool = pool
+        self.initial_limit = initial_limit  # of origins' concurrency, pool's default if None
+        self.hedging = hedging
+        self.probe_interval = probe_interval
+        self.min_hedge_delay = min_hedge_delay
+        self.exclude_time = exclude_time
+        self.groups: Dict[bool, List[str]] = {False: [], True: []}  # origins by is_vip
+        self.health: Dict[str, OriginHealth] = {}
+        self.excluded: Dict[Tuple[str, str], float] = {}  # (origin, stream_id) -> until
+        self.failed_over: Set[str] = set()  # streams routed away from their own origin
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.probes = 0
+
+    def add(self, origin: str, is_vip: bool) -> None:
+        """Origin is seen serving streams of the kind."""
+        if origin not in self.groups[is_vip]:
+            self.groups[is_vip].append(origin)
+            self.health.setdefault(origin, OriginHealth())
+            self.pool.limiter.origin(origin, self.initial_limit)
+
+    def exclude(self, origin: str, stream_id: str) -> None:
+        """Origin doesn't serve the stream, don't route it there for a while."""
+        self.excluded[(origin, stream_id)] = time.monotonic() + self.exclude_time
+
+    def _is_available(self, origin: str, stream_id: str) -> bool:
+        until = self.excluded.get((origin, stream_id))
+        if until is not None and until < time.monotonic():
+            del self.excluded[(origin, stream_id)]
+            until = None
+        limiter = self.pool.limiter.origins.get(origin)
+        return until is None and (limiter is None or not limiter.is_open)
+
+    def is_available(self, channel: 'ChannelRecord') -> bool:
+        """Stream of the channel can be requested from some origin."""
+        return self._is_available(channel.stream_origin, channel.stream_id) or \
+            any(self._is_available(x, channel.stream_id) for x in self.groups[channel.is_vip])
+
+    def route(self, channel: 'ChannelRecord') -> List[str]:
+        """Origins to request the stream from, the healthiest first."""
+        primary = channel.stream_origin
+        scored = []
+        for origin in self.groups[channel.is_vip]:
+            if origin != primary and self._is_available(origin, channel.stream_id):
+                score = self.health[origin].score
+                if score is not None:
+                    scored.append((score, origin))
+        scored.sort()
+        origins = [x for _, x in scored]
+
+        # Stick to channel's own origin unless another one is clearly better
+        primary_health = self.health.get(primary)
+        primary_score = primary_health.score if primary_health is not None else None
+        if not self._is_available(primary, channel.stream_id) and origins:
+            origins.append(primary)
+        elif origins and primary_score is not None and scored[0][0] < primary_score * 0.75:
+            origins.insert(1, primary)
+        else:
+            origins.insert(0, primary)
+
+        # Counted once per switch away from channel's own origin, not per request
+        if origins[0] == primary:
+            self.failed_over.discard(channel.stream_id)
+        elif channel.stream_id not in self.failed_over:
+            self.failed_over.add(channel.stream_id)
+            self.failovers += 1
+        return origins
+
+    def hedge_delay(self, origins: List[str]) -> Optional[float]:
+        """Time to wait for the response before requesting the next origin, None not to."""
+        if not self.hedging or len(origins) < 2:
+            return None
+        health = self.health.get(origins[0])
+        if health is None or health.recorded < 20:
+            return None
+        # Don't add up to the load of congested origin
+        limiter = self.pool.limiter.origins.get(origins[1])
+        if limiter is not None and limiter.waiters:
+            return None
+
+        return max(health.ttfb_p95, self.min_hedge_delay)
+
+    def record_transfer(self, origin: str, size: int, duration: float) -> None:
+        """Segment was read in full."""
+        health = self.health.get(origin)
+        if health is not None:
+            health.record_transfer(size, duration)
+
+    @contextlib.asynccontextmanager
+    async def request(self, origins: List[str], method: str, path_qs: str, key: str,
+                      hedge_delay: Optional[float] = None,
+                      **kwargs: Any) -> AsyncIterator[Tuple[aiohttp.ClientResponse, str]]:
+        """Request to the first origin within limiter's slot, hedged by the request
+        to the second one after the delay, yield the first response and its origin.
+
+        The slot is held till the response headers arrive, the body is read
+        at client's pace and mustn't hold up the requests of the others."""
+        async def attempt(origin: str) -> Attempt:
+            health = self.health.setdefault(origin, OriginHealth())
+            stack = contextlib.AsyncExitStack()
+            started_time = time.monotonic()
+            try:
+                async with self.pool.limiter.slot(origin, self.initial_limit):
+                    response = await stack.enter_async_context(self.pool.session(origin).request(
+                        method=method, url=upstream_url(origin, path_qs, key), **kwargs
+                    ))
+            except BaseException as e:
+                await stack.__aexit__(type(e), e, e.__traceback__)
+                if upstream_failed(e):
+                    health.record_error()
+                elif isinstance(e, asyncio.CancelledError):
+                    # Lost the race, it's slower than that at least
+                    health.record_ttfb(time.monotonic() - started_time)
+                raise
+
+            health.record_ttfb(time.monotonic() - started_time)
+            return response, stack
+
+        if hedge_delay is None or len(origins) < 2:
+            response, stack = await attempt(origins[0])
+            origin = origins[0]
+        else:
+            response, stack, origin = await self._hedge(attempt, origins[:2], hedge_delay)
+
+        try:
+            yield response, origin
+        except BaseException as e:
+            if upstream_failed(e):
+                self.health[origin].record_error()
+            await stack.__aexit__(type(e), e, e.__traceback__)
+            raise
+        else:
+            await stack.aclose()
+
+    async def _hedge(self, attempt: Callable[[str], Awaitable[Attempt]], origins: List[str],
+                     hedge_delay: float) -> Tuple[aiohttp.ClientResponse, contextlib.AsyncExitStack, str]:
+        tasks: Dict['asyncio.Future[Attempt]', str] = {asyncio.ensure_future(attempt(origins[0])): origins[0]}
+        pending = set(tasks)
+        winner: Optional['asyncio.Future[Attempt]'] = None
+        errors: List[BaseException] = []
+        is_hedged = False
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, timeout=None if is_hedged else hedge_delay,
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    is_hedged = True
+                    self.hedges += 1
+                    hedge = asyncio.ensure_future(attempt(origins[1]))
+                    tasks[hedge] = origins[1]
+                    pending.add(hedge)
+                    continue
+
+                for future in done:
+                    exc = future.exception()
+                    if exc is not None:
+                        errors.append(exc)
+                    elif winner is None:
+                        winner = future
+        finally:
+            # The slower request is cancelled, both might have been done at once too
+            for future in pending:
+                future.cancel()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if isinstance(result, tuple) and (winner is None or result is not winner.result()):
+                    await result[1].aclose()
+
+        if winner is None:
+            raise errors[0]
+
+        if tasks[winner] != origins[0]:
+            self.hedge_wins += 1
+        response, stack = winner.result()
+        return response, stack, tasks[winner]
+
+    async def run(self, probe: Callable[[str, bool], Awaitable[None]]) -> None:
+        """Probe origins not measured for a while, one at a time, forever."""
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            now = time.monotonic()
+            for is_vip, origins in list(self.groups.items()):
+                for origin in list(origins):
+                    if now - self.health[origin].measured_time > self.probe_interval:
+                        self.probes += 1
+                        await probe(origin, is_vip)
+
+    def stats(self) -> Dict[str, float]:
+        """Registry statistics."""
+        return {'origins': len(self.health), 'origin_failovers': self.failovers,
+                'origin_hedges': self.hedges, 'origin_hedge_wins': self.hedge_wins,
+                'origin_probes': self.probes}
+
+    def collect(self) -> Iterable[Tuple[str, 'Labels', float]]:
+        """Per-origin health for metrics."""
+        for origin, health in list(self.health.items()):
+            labels = (('origin', origin),)
+            yield 'origin_score_seconds', labels, health.score or 0
+            yield 'origin_ttfb_seconds', labels, health.ttfb
+            yield 'origin_ttfb_p95_seconds', labels, health.ttfb_p95
+            yield 'origin_throughput_bytes', labels, health.throughput
+            yield 'origin_error_rate', labels, health.error_rate
+
+
+Labels = Tuple[Tuple[str, str], ...]
+MetricsCollector = Callable[[], Iterable[Tuple[str, Labels, float]]]
+
+
+class Histogram:
+    """Cumulative histogram of observed values."""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.sum += value
+        self.count += 1
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+
+
+class Metrics:
+    """Prometheus-style metrics registry, does nothing if disabled."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, enabled: bool = True, prefix: str = 'ustvgo_') -> None:
+        self.enabled = enabled
+        self.prefix = prefix
+        self.descriptions: Dict[str, Tuple[str, str]] = {}  # name -> (type, help)
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.collectors: List[MetricsCollector] = []
+
+    def describe(self, name: str, metric_type: str, description: str) -> None:
+        self.descriptions[name] = (metric_type, description)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        """Increase counter."""
+        if self.enabled:
+            counter = self.counters.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Observe value of histogram."""
+        if self.enabled:
+            histogram = self.histograms.setdefault(name, {})
+            key = tuple(sorted(labels.items()))
+            if key not in histogram:
+                histogram[key] = Histogram(self.BUCKETS)
+            histogram[key].observe(value)
+
+    def add_collector(self, collector: MetricsCollector) -> None:
+        """Add source of gauges collected on rendering."""
+        self.collectors.append(collector)
+
+    def add_stats(self, stats: Callable[[], Dict[str, float]]) -> None:
+        """Add component's statistics as gauges."""
+        self.add_collector(lambda: ((name, (), value) for name, value in stats().items()))
+
+    @staticmethod
+    def _labels(labels: Labels, *extra: Tuple[str, str]) -> str:
+        items = labels + extra
+        if not items:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (name, value.replace('\\', '\\\\')
+                                              .replace('"', '\\"').replace('\n', '\\n'))
+                                 for name, value in items)
+
+    def _header(self, lines: List[str], name: str, default_type: str) -> None:
+        metric_type, description = self.descriptions.get(name, (default_type, ''))
+        if description:
+            lines.append(f'# HELP {self.prefix}{name} {description}')
+        lines.append(f'# TYPE {self.prefix}{name} {metric_type}')
+
+    def render(self) -> str:
+        """Render metrics in Prometheus text format."""
+        lines: List[str] = []
+        for name, counter in sorted(self.counters.items()):
+            self._header(lines, name, 'counter')
+            for labels, value in counter.items():
+                lines.append(f'{self.prefix}{name}{self._labels(labels)} {value:g}')
+
+        for name, histograms in sorted(self.histograms.items()):
+            self._header(lines, name, 'histogram')
+            for labels, histogram in histograms.items():
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    bucket_labels = self._labels(labels, ('le', f'{bound:g}'))
+                    lines.append(f'{self.prefix}{name}_bucket{bucket_labels} {count}')
+                lines.append(f'{self.prefix}{name}_bucket{self._labels(labels, ("le", "+Inf"))} '
+                             f'{histogram.count}')
+                lines.append(f'{self.prefix}{name}_sum{self._labels(labels)} {histogram.sum:g}')
+                lines.append(f'{self.prefix}{name}_count{self._labels(labels)} {histogram.count}')
+
+        gauges: Dict[str, List[Tuple[Labels, float]]] = {}
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                gauges.setdefault(name, []).append((labels, value))
+
+        for name, values in sorted(gauges.items()):
+            self._header(lines, name, 'gauge')
+            for labels, value in values:
+                lines.append(f'{self.prefix}{name}{self._labels(labels)} {value:g}')
+
+        return '\n'.join(lines) + '\n'
+
+
+async def measure_event_loop_lag(metrics: Metrics, interval: float = 0.5) -> None:
+    """Observe how late the event loop wakes up sleeping tasks."""
+    while True:
+        started_time = time.monotonic()
+        await asyncio.sleep(interval)
+        metrics.observe('event_loop_lag_seconds', time.monotonic() - started_time - interval)
+
+
+class CacheEntry:
+    """Cached upstream response, held in memory or spilled to a file."""
+
+    __slots__ = ('body', 'path', 'size', 'headers', 'status', 'expires', 'prefetched', 'playlist')
+
+    def __init__(self, body: bytes, headers: Mapping[str, str], status: int = 200,
+                 ttl: Optional[float] = None, path: Optional[pathlib.Path] = None,
+                 size: Optional[int] = None) -> None:
+        self.body = body
+        self.path = path
+        self.size = len(body) if size is None else size
+        self.headers = dict(headers)
+        self.status = status
+        self.expires = time.monotonic() + ttl if ttl is not None else None
+        self.prefetched = False  # fetched ahead and not requested by anyone yet
+        self.playlist: Optional['ParsedPlaylist'] = None
+
+    @property
+    def is_expired(self) -> bool:
+        return self.expires is not None and self.expires <= time.monotonic()
+
+    def response(self) -> web.StreamResponse:
+        """Make client response out of the entry."""
+        if self.path is not None:
+            return web.FileResponse(self.path, status=self.status, headers=self.headers)
+
+        return web.Response(body=self.body, status=self.status, headers=self.headers)
+
+
+class SegmentDownload:
+    """Segment being fetched from upstream at upstream's pace, the clients requesting it
+    meanwhile read its chunks as they arrive, each at its own pace."""
+
+    __slots__ = ('status', 'headers', 'size', 'chunks', 'received', 'done', 'error', 'arrived')
+
+    def __init__(self, status: int, headers: Mapping[str, str], size: int) -> None:
+        self.status = status
+        self.headers = dict(headers)
+        self.size = size  # Content-Length
+        self.chunks: List[bytes] = []
+        self.received = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.arrived = asyncio.Event()  # replaced on every arrival
+
+    async def fill(self, chunks: AsyncIterator[bytes]) -> bool:
+        """Read upstream chunks into the download, whether the segment arrived in full."""
+        error: Optional[BaseException] = aiohttp.ClientPayloadError('Segment download interrupted')
+        try:
+            async for chunk in chunks:
+                self.chunks.append(chunk)
+                self.received += len(chunk)
+                self._wake()
+            error = None
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            error = e
+        finally:
+            # Readers mustn't wait for the chunks that won't come, even if it's cancelled
+            self.done = True
+            self.error = error
+            self._wake()
+
+        return error is None
+
+    def _wake(self) -> None:
+        self.arrived.set()
+        self.arrived = asyncio.Event()
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        """Chunks fetched so far and the upcoming ones, raise if the fetch fails."""
+        idx = 0
+        while True:
+            arrived = self.arrived
+            while idx < len(self.chunks):
+                yield self.chunks[idx]
+                idx += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await arrived.wait()
+
+    async def stream(self, request: web.Request) -> web.StreamResponse:
+        """Stream the segment to the client as it arrives."""
+        response = web.StreamResponse(status=self.status, headers=self.headers)
+        response.content_length = self.size
+        try:
+            await response.prepare(request)
+            async for chunk in self.iter_chunks():
+                await response.write(chunk)
+            await response.write_eof()
+        except (aiohttp.ClientError, ConnectionResetError) as e:
+            # Nothing can be retried once bytes were sent to the client,
+            # drop the connection so the client sees a truncated response.
+            logger.debug('Streaming of %s interrupted: %s', request.path, e)
+            if request.transport is not None:
+                request.transport.close()
+
+        return response
+
+
+class DiskCache:
+    """Size-capped directory of segments spilled from memory, evicted by LRU."""
+
+    FILE_SUFFIX = '.seg'
+
+    def __init__(self, directory: pathlib.Path, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        self.writing: Set[str] = set()  # keys being spilled
+        self.hits = 0
+        self.spilled = 0
+        self.prefetch_wasted = 0
+
+        # Files left by the previous run are unknown to the index, wipe them
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for filepath in self.directory.glob('*' + self.FILE_SUFFIX):
+            filepath.unlink()
+
+    def lookup(self, key: str) -> Optional[CacheEntry]:
+        """Find spilled entry."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+        return entry
+
+    async def put(self, key: str, entry: CacheEntry) -> None:
+        """Write entry to disk evicting least recently used ones."""
+        if entry.size > self.max_bytes or key in self.entries or key in self.writing:
+            return
+
+        filepath = self.directory / (hashlib.sha1(key.encode()).hexdigest() + self.FILE_SUFFIX)
+        loop = asyncio.get_event_loop()
+        # Same segment might be evicted again while it's being written
+        self.writing.add(key)
+        try:
+            await loop.run_in_executor(None, filepath.write_bytes, entry.body)
+        except OSError as e:
+            logger.error('Failed to spill segment to %s: %s', filepath, e)
+            return
+        finally:
+            self.writing.discard(key)
+
+        spilled = CacheEntry(b'', entry.headers, entry.status, path=filepath, size=entry.size)
+        spilled.prefetched = entry.prefetched
+        self.entries[key] = spilled
+        self.size += entry.size
+        self.spilled += 1
+        while self.size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.size
+            if evicted.prefetched:
+                self.prefetch_wasted += 1
+            if evicted.path is not None:
+                await loop.run_in_executor(None, self._unlink, evicted.path)
+
+    @staticmethod
+    def _unlink(filepath: pathlib.Path) -> None:
+        try:
+            filepath.unlink()
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, float]:
+        """Disk cache statistics."""
+        return {'disk_cache_entries': len(self.entries), 'disk_cache_bytes': self.size,
+                'disk_cache_hits': self.hits, 'disk_cache_spilled': self.spilled}
+
+
+# Cached entry, download being shared or nothing
+CachedSegment = Union[CacheEntry, SegmentDownload, None]
+
+
+class SegmentCache:
+    """In-memory LRU/TTL cache of stream playlists and segments with request coalescing.
+
+    Evicted segments are spilled to the optional disk cache tier.
+    """
+
+    def __init__(self, max_bytes: int, spill: Optional[DiskCache] = None) -> None:
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.size = 0
+        self.entries: 'OrderedDict[str, CacheEntry]' = OrderedDict()
+        self.inflight: Dict[str, 'asyncio.Future[CachedSegment]'] = {}
+        self.spills: Set['asyncio.Future[None]'] = set()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # hits served by waiting on in-flight upstream fetch
+        self.bytes_saved = 0
+        self.prefetch_hits = 0
+        self.prefetch_wasted = 0  # prefetched segments evicted without being requested
+
+    @staticmethod
+    def make_key(stream_id: str, path: str, query: Mapping[str, str]) -> str:
+        """Cache key of upstream resource, auth key doesn't matter."""
+        query_str = '&'.join(f'{name}={value}' for name, value in query.items()
+                             if name != 'wmsAuthSign')
+        return f'{stream_id}:{path}?{query_str}'
+
+    async def lookup(self, key: str) -> CachedSegment:
+        """Find cached entry or wait for the one being fetched,
+        segments are shared as soon as their download starts."""
+        cached = self.entries.get(key)
+        if cached is not None and cached.is_expired:
+            self._remove(key)
+            cached = None
+
+        entry: CachedSegment = cached
+        if entry is not None:
+            self.entries.move_to_end(key)
+        elif self.spill is not None and key in self.spill.entries:
+            entry = self.spill.lookup(key)
+        elif key in self.inflight:
+            entry = await asyncio.shield(self.inflight[key])
+            if entry is not None:
+                self.coalesced += 1
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.bytes_saved += entry.size
+            if isinstance(entry, CacheEntry) and entry.prefetched:
+                entry.prefetched = False
+                self.prefetch_hits += 1
+
+        return entry
+
+    def __contains__(self, key: str) -> bool:
+        entry = self.entries.get(key)
+        return (entry is not None and not entry.is_expired) or key in self.inflight or \
+            (self.spill is not None and key in self.spill.entries)
+
+    def begin(self, key: str) -> 'asyncio.Future[CachedSegment]':
+        """Mark key as being fetched from upstream."""
+        future: 'asyncio.Future[CachedSegment]' = asyncio.get_event_loop().create_future()
+        self.inflight[key] = future
+        return future
+
+    def share(self, key: str, download: Optional[SegmentDownload]) -> None:
+        """Wake up the waiters of the key being fetched to read its download,
+        None lets them fetch it on their own."""
+        future = self.inflight.get(key)
+        if future is not None and not future.done():
+            future.set_result(download)
+
+    def end(self, key: str, future: 'asyncio.Future[CachedSegment]',
+            entry: Optional[CacheEntry]) -> None:
+        """Finish fetching, store entry and wake up waiters."""
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+        if entry is not None:
+            self.put(key, entry)
+        if not future.done():
+            future.set_result(entry)
+
+    def put(self, key: str, entry: CacheEntry) -> None:
+        """Store entry evicting least recently used ones."""
+        if entry.size > self.max_bytes:
+            return
+
+        if key in self.entries:
+            self._remove(key)
+
+        self.entries[key] = entry
+        self.size += entry.size
+        while self.size > self.max_bytes:
+            evicted_key = next(iter(self.entries))
+            evicted = self._remove(evicted_key)
+            # Only immutable segments are worth keeping on disk
+            if self.spill is not None and evicted.expires is None:
+                task = asyncio.ensure_future(self.spill.put(evicted_key, evicted))
+                self.spills.add(task)
+                task.add_done_callback(self._spilled)
+            elif evicted.prefetched:
+                self.prefetch_wasted += 1
+
+    def _spilled(self, task: 'asyncio.Future[None]') -> None:
+        self.spills.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Failed to spill segment: %r', task.exception())
+
+    def _remove(self, key: str) -> CacheEntry:
+        entry = self.entries.pop(key)
+        self.size -= entry.size
+        return entry
+
+    def stats(self) -> Dict[str, float]:
+        """Cache statistics."""
+        lookups = self.hits + self.misses
+        return {'cache_entries': len(self.entries), 'cache_bytes': self.size,
+                'cache_hits': self.hits, 'cache_misses': self.misses,
+                'cache_coalesced': self.coalesced,
+                'cache_hit_ratio': self.hits / lookups if lookups else 0,
+                'cache_bytes_saved': self.bytes_saved,
+                'prefetch_hits': self.prefetch_hits,
+                'prefetch_wasted': self.prefetch_wasted + (self.spill.prefetch_wasted
+                                                           if self.spill is not None else 0),
+                **(self.spill.stats() if self.spill is not None else {})}
+
+    def close(self) -> None:
+        for task in self.spills:
+            task.cancel()
+
+
+class Asset:
+    """Static upstream resource: TV Guide or logo."""
+
+    __slots__ = ('body', 'status', 'etag', 'last_modified', 'fetched_time', 'derived')
+
+    def __init__(self, body: bytes, status: int = 200, etag: Optional[str] = None,
+                 last_modified: Optional[str] = None,
+                 fetched_time: Optional[float] = None) -> None:
+        self.body = body
+        self.status = status
+        self.etag = etag or f'"{hashlib.md5(body).hexdigest()}"'
+        self.last_modified = last_modified
+        self.fetched_time = time.time() if fetched_time is None else fetched_time
+        self.derived: Dict[str, bytes] = {}  # variants derived from the body, e.g. transformed
+
+    def keep(self, variant: str, body: bytes) -> None:
+        """Keep variant derived from the body, only the recent ones are kept."""
+        self.derived[variant] = body
+        while len(self.derived) > MAX_ASSET_VARIANTS:
+            del self.derived[next(iter(self.derived))]
+
+    def headers(self, variant: str = '') -> Dict[str, str]:
+        """Validators of the body or its variant."""
+        return asset_headers(self.etag, self.last_modified, variant)
+
+    def not_modified(self, request: web.Request, variant: str = '') -> Optional[web.Response]:
+        """Not modified response if client's conditional headers match."""
+        if self.status != 200:
+            return None
+
+        headers = self.headers(variant)
+        if_none_match = request.headers.get(aiohttp.hdrs.IF_NONE_MATCH)
+        if if_none_match is not None:
+            if headers[aiohttp.hdrs.ETAG] in if_none_match or if_none_match.strip() == '*':
+                return web.Response(status=304, headers=headers)
+        elif self.last_modified and \
+                request.headers.get(aiohttp.hdrs.IF_MODIFIED_SINCE) == self.last_modified:
+            return web.Response(status=304, headers=headers)
+
+        return None
+
+    def response(self, request: web.Request, content_type: str,
+                 body: Optional[bytes] = None, variant: str = '',
+                 content_encoding: Optional[str] = None) -> web.Response:
+        """Make response, honor client's conditional headers."""
+        not_modified = self.not_modified(request, variant)
+        if not_modified is not None:
+            return not_modified
+
+        headers = self.headers(variant)
+        if content_encoding is not None:
+            headers[aiohttp.hdrs.CONTENT_ENCODING] = content_encoding
+        return web.Response(body=self.body if body is None else body, status=self.status,
+                            headers=headers, content_type=content_type)
+
+
+def asset_headers(etag: Optional[str], last_modified: Optional[str],
+                  variant: str = '') -> Dict[str, str]:
+    """ETag of the asset or its variant and Last-Modified, if known."""
+    headers: Dict[str, str] = {}
+    if etag:
+        headers[aiohttp.hdrs.ETAG] = etag if not variant else f'{etag[:-1]}-{variant}"'
+    if last_modified:
+        headers[aiohttp.hdrs.LAST_MODIFIED] = last_modified
+    return headers
+
+
+class AssetDownload:
+    """Body of a missing asset being fetched, its chunks can be read as they arrive."""
+
+    __slots__ = ('etag', 'last_modified', 'chunks', 'done', 'asset', 'error', 'started', 'arrived')
+
+    def __init__(self) -> None:
+        self.etag: Optional[str] = None  # upstream's ones
+        self.last_modified: Optional[str] = None
+        self.chunks: List[bytes] = []
+        self.done = False
+        self.asset: Optional[Asset] = None  # once it's fetched
+        self.error: Optional[BaseException] = None
+        # True once upstream responded 200 OK, False if it didn't
+        self.started: 'asyncio.Future[bool]' = asyncio.get_event_loop().create_future()
+        self.arrived = asyncio.Event()  # replaced on every arrival
+
+    def start(self, etag: Optional[str], last_modified: Optional[str]) -> None:
+        self.etag = etag
+        self.last_modified = last_modified
+        self.started.set_result(True)
+
+    def append(self, chunk: bytes) -> None:
+        self.chunks.append(chunk)
+        self._wake()
+
+    def finish(self, asset: Optional[Asset], error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.asset = asset
+        self.error = error
+        if not self.started.done():
+            self.started.set_result(False)
+        self._wake()
+
+    def _wake(self) -> None:
+        self.arrived.set()
+        self.arrived = asyncio.Event()
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        """Chunks fetched so far and the upcoming ones, raise if the fetch fails."""
+        idx = 0
+        while True:
+            arrived = self.arrived
+            while idx < len(self.chunks):
+                yield self.chunks[idx]
+                idx += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await arrived.wait()
+
+
+class AssetCache:
+    """Upstream static resources kept in memory with optional persistence to disk.
+
+    Stale assets are served while being revalidated in the background
+    with upstream's ETag / Last-Modified.
+    """
+
+    def __init__(self, pool: UpstreamPool, directory: Optional[pathlib.Path] = None,
+                 max_entries: int = MAX_ASSETS) -> None:
+        self.pool = pool
+        self.directory = directory
+        self.max_entries = max_entries
+        self.assets: 'OrderedDict[str, Asset]' = OrderedDict()
+        self.inflight: Dict[str, 'asyncio.Future[Asset]'] = {}
+        self.downloads: Dict[str, AssetDownload] = {}  # of the missing inflight assets
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.not_modified = 0
+
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+    async def get(self, url: str, max_age: float) -> Asset:
+        """Get asset, fetch it if missing, revalidate in the background if stale."""
+        asset = self.assets.get(url) or self._load(url)
+        if asset is None:
+            self.misses += 1
+            return await self._refresh(url)
+
+        self.hits += 1
+        self.assets.move_to_end(url)
+        if asset.status != 200:
+            max_age = min(max_age, ASSET_ERROR_MAX_AGE)
+        if time.time() - asset.fetched_time > max_age and url not in self.inflight:
+            self._refresh(url)
+
+        return asset
+
+    async def open(self, url: str, max_age: float) -> Union[Asset, AssetDownload]:
+        """Get asset like get() does or, if it's missing, its download once upstream
+        has responded with it, so its body can be processed as it arrives."""
+        if url in self.assets or self._load(url) is not None:
+            return await self.get(url, max_age)
+
+        self.misses += 1
+        fetch = self._refresh(url)
+        download = self.downloads.get(url)
+        if download is not None and await asyncio.shield(download.started):
+            fetch.add_done_callback(lambda x: x.cancelled() or x.exception())  # read from download
+            return download
+
+        return await fetch
+
+    def _refresh(self, url: str) -> 'asyncio.Future[Asset]':
+        """Single-flight fetch of the asset."""
+        if url not in self.inflight:
+            if url not in self.assets:
+                self.downloads[url] = AssetDownload()
+            future = asyncio.ensure_future(self._fetch(url))
+            future.add_done_callback(functools.partial(self._fetched, url))
+            self.inflight[url] = future
+
+        return asyncio.shield(self.inflight[url])
+
+    def _fetched(self, url: str, future: 'asyncio.Future[Asset]') -> None:
+        self.inflight.pop(url, None)
+        download = self.downloads.pop(url, None)
+        if download is not None:
+            if future.cancelled():
+                download.finish(None, asyncio.CancelledError())
+            else:
+                download.finish(None if future.exception() else future.result(), future.exception())
+
+    async def _fetch(self, url: str) -> Asset:
+        asset = self.assets.get(url)
+        download = self.downloads.get(url)
+        headers = {}
+        if asset is not None and asset.status == 200:
+            self.revalidations += 1
+            headers[aiohttp.hdrs.IF_NONE_MATCH] = asset.etag
+            if asset.last_modified:
+                headers[aiohttp.hdrs.IF_MODIFIED_SINCE] = asset.last_modified
+
+        try:
+            async with self.pool.session(url).get(url, headers=headers) as response:
+                if response.status == 304 and asset is not None:
+                    self.not_modified += 1
+                    asset.fetched_time = time.time()
+                    return asset
+
+                etag = response.headers.get(aiohttp.hdrs.ETAG)
+                last_modified = response.headers.get(aiohttp.hdrs.LAST_MODIFIED)
+                if download is not None and response.status == 200:
+                    download.start(etag, last_modified)
+
+                chunks = []
+                async for chunk in response.content.iter_chunked(ASSET_CHUNK_SIZE):
+                    chunks.append(chunk)
+                    if download is not None:
+                        download.append(chunk)
+                asset = Asset(b''.join(chunks), status=response.status, etag=etag,
+                              last_modified=last_modified)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logger.error('Failed to fetch %s: %s', url, e)
+            if asset is not None:
+                return asset  # keep serving the stale one
+            raise
+
+        # Don't replace good asset with upstream hiccup
+        kept = self.assets.get(url)
+        if asset.status == 200 or kept is None or kept.status != 200:
+            self._store(url, asset)
+            if asset.status == 200:
+                await self._save(url, asset)
+            return asset
+
+        return kept
+
+    def _store(self, url: str, asset: Asset) -> None:
+        self.assets[url] = asset
+        self.assets.move_to_end(url)
+        while len(self.assets) > self.max_entries:
+            self.assets.popitem(last=False)
+
+    def _paths(self, url: str) -> Tuple[pathlib.Path, pathlib.Path]:
+        assert self.directory is not None
+        name = hashlib.sha1(url.encode()).hexdigest()
+        return self.directory / name, self.directory / f'{name}.json'
+
+    def _load(self, url: str) -> Optional[Asset]:
+        if self.directory is None:
+            return None
+
+        body_path, meta_path = self._paths(url)
+        try:
+            meta = JSON.loads(meta_path.read_bytes())
+            asset = Asset(body_path.read_bytes(), etag=meta['etag'],
+                          last_modified=meta['last_modified'], fetched_time=meta['fetched_time'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+        self._store(url, asset)
+        return asset
+
+    async def _save(self, url: str, asset: Asset) -> None:
+        if self.directory is None:
+            return
+
+        body_path, meta_path = self._paths(url)
+        meta = {'url': url, 'etag': asset.etag, 'last_modified': asset.last_modified,
+                'fetched_time': asset.fetched_time}
+
+        def save() -> None:
+            # Directory might be shared by worker processes, don't expose partial writes
+            for path, content in ((body_path, asset.body), (meta_path, JSON.dumps(meta))):
+                tmp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+                tmp_path.write_bytes(content)
+                os.replace(tmp_path, path)
+
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, save)
+        except OSError as e:
+            logger.error('Failed to save %s: %s', url, e)
+
+    def stats(self) -> Dict[str, float]:
+        """Asset cache statistics."""
+        return {'assets': len(self.assets), 'assets_hits': self.hits,
+                'assets_misses': self.misses, 'assets_revalidations': self.revalidations,
+                'assets_not_modified': self.not_modified}
+
+
+@functools.lru_cache(maxsize=4096)  # programmes of the channels share their times
+def shift_xmltv_time(value: str, shift: datetime.timedelta) -> str:
+    """Shift XMLTV time like "20220621220000 +0000", keep it as is if it's malformed."""
+    try:
+        shifted = datetime.datetime.strptime(value[:14], '%Y%m%d%H%M%S') + shift
+    except ValueError:
+        return value
+    return shifted.strftime('%Y%m%d%H%M%S') + value[14:]
+
+
+def local_icon_url(src: str, logos_url: str) -> str:
+    """Channel icon of the TV Guide served by the logos route, other icons are kept."""
+    if '/images/icons/channels/' not in src:
+        return src
+    return logos_url + src.rpartition('/')[2]
+
+
+def inflate(decompressor: 'zlib._Decompress', data: bytes,
+            size: int = ASSET_CHUNK_SIZE) -> Iterator[bytes]:
+    """Data decompressed in pieces of the size at most."""
+    while data:
+        yield decompressor.decompress(data, size)
+        data = decompressor.unconsumed_tail
+
+
+async def iter_slices(body: bytes, size: int = ASSET_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Body in chunks, like the ones of a download."""
+    for idx in range(0, len(body), size):
+        yield body[idx:idx + size]
+
+
+class TvGuideTransform(xml.sax.handler.ContentHandler):
+    """Streaming transform of gzipped XMLTV into gzipped XMLTV.
+
+    Chunks are decompressed, parsed, filtered and compressed back as they're fed,
+    elements are written out as soon as they're parsed and never kept, so memory
+    stays the same whatever the size of the TV Guide.
+    """
+
+    def __init__(self, channel_ids: Optional[FrozenSet[str]] = None,
+                 icon_url: Optional[Callable[[str], str]] = None,
+                 time_shift: Optional[datetime.timedelta] = None, compresslevel: int = 6) -> None:
+        super().__init__()
+        self.channel_ids = channel_ids  # ids of the channels kept, all of them if None
+        self.icon_url = icon_url  # upstream URL of <icon> -> new one
+        self.time_shift = time_shift  # of the programmes
+        self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        self.compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+        self.parser = xml.sax.expatreader.ExpatParser()
+        self.parser.setContentHandler(self)
+        self.output = io.StringIO()
+        self.writer = xml.sax.saxutils.XMLGenerator(self.output, encoding='utf-8',
+                                                    short_empty_elements=True)
+        self.depth = 0
+        self.is_kept = False  # current <channel> or <programme>
+        self.input_size = 0
+
+    def feed(self, chunk: bytes) -> bytes:
+        """Transform next chunk, return compressed output so far."""
+        self.input_size += len(chunk)
+        output = []
+        # XMLTV compresses well, it's parsed in bounded pieces
+        for piece in inflate(self.decompressor, chunk):
+            self.parser.feed(piece)
+            output.append(self.compressor.compress(self._drain()))
+        return b''.join(output)
+
+    def close(self) -> bytes:
+        """Finish transform, return the rest of the output."""
+        self.parser.feed(self.decompressor.flush())
+        self.parser.close()
+        return self.compressor.compress(self._drain()) + self.compressor.flush()
+
+    def _drain(self) -> bytes:
+        text = self.output.getvalue()
+        self.output.seek(0)
+        self.output.truncate()
+        return text.encode()
+
+    def startDocument(self) -> None:
+        self.writer.startDocument()
+
+    def startElement(self, name: str, attrs: 'xml.sax.xmlreader.AttributesImpl[str]') -> None:
+        self.depth += 1
+        if self.depth == 1:
+            self.writer.startElement(name, attrs)
+            self.writer.ignorableWhitespace('\n')
+            return
+
+        if self.depth == 2:
+            # <channel id=...> and <programme channel=...>
+            self.is_kept = self.channel_ids is None or \
+                (attrs.get('id') or attrs.get('channel')) in self.channel_ids
+        if not self.is_kept:
+            return
+
+        if name == 'icon' and self.icon_url is not None and 'src' in attrs:
+            attrs = xml.sax.xmlreader.AttributesImpl({**attrs, 'src': self.icon_url(attrs['src'])})
+        elif name == 'programme' and self.time_shift:
+            shift = self.time_shift
+            attrs = xml.sax.xmlreader.AttributesImpl(
+                {x: shift_xmltv_time(value, shift) if x in ('start', 'stop') else value
+                 for x, value in attrs.items()})
+        self.writer.startElement(name, attrs)
+
+    def endElement(self, name: str) -> None:
+        self.depth -= 1
+        if self.depth == 0 or self.is_kept:
+            self.writer.endElement(name)
+            if self.depth <= 1:
+                self.writer.ignorableWhitespace('\n')
+
+    def characters(self, content: str) -> None:
+        # Whitespace between <channel> and <programme> elements is replaced
+        if self.is_kept and self.depth >= 2:
+            self.writer.characters(content)
+
+
+def playlist_target_duration(content: bytes) -> Optional[int]:
+    """Target duration of HLS media playlist."""
+    match = re.search(rb'#EXT-X-TARGETDURATION:\s*(\d+)', content)
+    return int(match.group(1)) if match else None
+
+
+def playlist_ttl(content: bytes) -> float:
+    """Time to live of cached playlist, half of its target duration."""
+    target_duration = playlist_target_duration(content)
+    if target_duration is not None:
+        return target_duration / 2
+
+    return PLAYLIST_DEFAULT_TTL
+
+
+def strip_auth_key(path_qs: str) -> str:
+    """Path with query without auth key."""
+    path, _, query = path_qs.partition('?')
+    if 'wmsAuthSign=' not in query:
+        return path_qs
+
+    query = '&'.join(x for x in query.split('&') if not x.startswith('wmsAuthSign='))
+    return f'{path}?{query}' if query else path
+
+
+def upstream_url(origin: str, path_qs: str, key: str) -> str:
+    """Upstream URL of proxied path with query (without auth key) signed by the key."""
+    return f'{origin}{path_qs}{"&" if "?" in path_qs else "?"}wmsAuthSign={quote(key, safe="=")}'
+
+
+class SegmentRef:
+    """Segment of upstream media playlist as it's proxied."""
+
+    __slots__ = ('path_qs', 'cache_key', 'duration')
+
+    def __init__(self, path_qs: str, cache_key: str, duration: float) -> None:
+        self.path_qs = path_qs  # upstream path with query, without auth key
+        self.cache_key = cache_key
+        self.duration = duration
+
+
+class ParsedPlaylist:
+    """Upstream HLS playlist parsed once per its version.
+
+    It's kept as the text between URIs and the URIs resolved to proxied paths
+    without auth keys, to be joined with the proxy's base URL for clients.
+    """
+
+    __slots__ = ('parts', 'uris', 'segments', 'media_sequence', 'target_duration', 'rendered')
+
+    def __init__(self, parts: List[str], uris: List[str], segments: List[SegmentRef],
+                 media_sequence: int, target_duration: Optional[int]) -> None:
+        self.parts = parts  # len(uris) + 1 pieces of text around the URIs
+        self.uris = uris
+        self.segments = segments
+        self.media_sequence = media_sequence
+        self.target_duration = target_duration
+        self.rendered: Dict[str, bytes] = {}  # by base URL
+
+    def render(self, base_url: str, max_rendered: int = 4) -> bytes:
+        """Playlist with absolute URLs of the proxy."""
+        body = self.rendered.get(base_url)
+        if body is None:
+            with io.StringIO() as f:
+                f.write(self.parts[0])
+                for uri, part in zip(self.uris, self.parts[1:]):
+                    f.write(base_url)
+                    f.write(uri)
+                    f.write(part)
+                body = f.getvalue().encode()
+
+            # Host header is client-controlled
+            if len(self.rendered) < max_rendered:
+                self.rendered[base_url] = body
+
+        return body
+
+
+def parse_playlist(content: bytes, stream_id: str, playlist_path: str) -> ParsedPlaylist:
+    """Parse upstream HLS playlist of the stream requested by proxied path."""
+    parts: List[str] = []
+    uris: List[str] = []
+    segments: List[SegmentRef] = []
+    media_sequence = 0
+    target_duration = None
+    duration: Optional[float] = None
+
+    text: List[str] = []
+    for line in content.decode(errors='replace').splitlines(keepends=True):
+        stripped = line.strip()
+        if not stripped.startswith('#'):
+            # Absolute URLs aren't proxied
+            if stripped and '://' not in stripped:
+                path_qs = strip_auth_key(urljoin(playlist_path, stripped))
+                parts.append(''.join(text))
+                uris.append(path_qs)
+                text = [line[len(line.rstrip('\r\n')):]]
+
+                if duration is not None:
+                    path, _, query = path_qs.partition('?')
+                    cache_key = SegmentCache.make_key(stream_id, path, dict(parse_qsl(query)))
+                    segments.append(SegmentRef(path_qs, cache_key, duration))
+                    duration = None
+                continue
+        elif stripped.startswith('#EXTINF:'):
+            try:
+                duration = float(stripped[8:].split(',', 1)[0])
+            except ValueError:
+                duration = 0
+        elif stripped.startswith('#EXT-X-TARGETDURATION:'):
+            with contextlib.suppress(ValueError):
+                target_duration = int(stripped[22:])
+        elif stripped.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+            with contextlib.suppress(ValueError):
+                media_sequence = int(stripped[22:])
+
+        text.append(line)
+
+    parts.append(''.join(text))
+    return ParsedPlaylist(parts, uris, segments, media_sequence, target_duration)
+
+
+class SegmentTable:
+    """Proxied paths of the segments of recently parsed media playlists."""
+
+    def __init__(self, max_entries: int = 4096) -> None:
+        self.max_entries = max_entries
+        self.segments: 'OrderedDict[str, SegmentRef]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, playlist: ParsedPlaylist) -> None:
+        for segment in playlist.segments:
+            self.segments[segment.path_qs] = segment
+            self.segments.move_to_end(segment.path_qs)
+
+        while len(self.segments) > self.max_entries:
+            self.segments.popitem(last=False)
+
+    def get(self, path_qs: str) -> Optional[SegmentRef]:
+        segment = self.segments.get(path_qs)
+        if segment is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return segment
+
+    def stats(self) -> Dict[str, float]:
+        """Segment table statistics."""
+        return {'segment_table': len(self.segments), 'segment_table_hits': self.hits,
+                'segment_table_misses': self.misses}
+
+
+class TokenBucket:
+    """Token bucket rate limiter."""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_time')
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated_time = time.monotonic()
+
+    def take(self) -> float:
+        """Take a token, return 0 or time till there's one if there's none."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_time) * self.rate)
+        self.updated_time = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionRejected(Exception):
+    """Request is over the limit."""
+
+    def __init__(self, limit: str, status: int, retry_after: float) -> None:
+        super().__init__(f'Over the limit of {limit.replace("_", " ")}, retry later')
+        self.limit = limit
+        self.status = status
+        self.retry_after = retry_after
+
+
+class ClientUsage:
+    """In-flight upstream requests and bytes of the client and its request rate."""
+
+    __slots__ = ('requests', 'bytes', 'bucket')
+
+    def __init__(self, bucket: Optional[TokenBucket]) -> None:
+        self.requests = 0
+        self.bytes = 0
+        self.bucket = bucket
+
+
+class UpstreamTicket:
+    """Admitted upstream request, keeps account of the bytes it buffers."""
+
+    def __init__(self, admission: 'Admission', client: ClientUsage) -> None:
+        self.admission = admission
+        self.client = client
+        self.bytes = 0
+
+    def reserve(self, size: int) -> bool:
+        """Account bytes about to be buffered, False if it'd be over the limits."""
+        admission = self.admission
+        if admission.max_bytes and admission.bytes + size > admission.max_bytes or \
+                admission.max_client_bytes and self.client.bytes + size > admission.max_client_bytes:
+            return False
+
+        self.bytes += size
+        self.client.bytes += size
+        admission.bytes += size
+        return True
+
+    def release(self) -> None:
+        """Buffered bytes are dropped."""
+        self.client.bytes -= self.bytes
+        self.admission.bytes -= self.bytes
+        self.bytes = 0
+
+    def __enter__(self) -> 'UpstreamTicket':
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any) -> None:
+        self.release()
+        self.client.requests -= 1
+        self.admission.requests -= 1
+
+
+class Admission:
+    """Admission control of the clients, 0 disables a limit.
+
+    Clients' request rates are limited by token buckets. Upstream requests
+    are limited by their number and bytes buffered by them, globally and per client,
+    and by rate per channel. Rejected requests get 429 if it's the client's
+    limit and 503 if it's a shared one.
+    """
+
+    def __init__(self, max_requests: int = 0, max_client_requests: int = 0, max_bytes: int = 0,
+                 max_client_bytes: int = 0, client_rate: float = 0, client_burst: float = 0,
+                 channel_rate: float = 0, channel_burst: float = 0,
+                 max_clients: int = 10000) -> None:
+        self.max_requests = max_requests
+        self.max_client_requests = max_client_requests
+        self.max_bytes = max_bytes
+        self.max_client_bytes = max_client_bytes
+        self.client_rate = client_rate
+        self.client_burst = max(client_burst, 1)
+        self.channel_rate = channel_rate
+        self.channel_burst = max(channel_burst, 1)
+        self.max_clients = max_clients  # bounds memory, idle clients are forgotten first
+        self.requests = 0
+        self.bytes = 0
+        self.clients: 'OrderedDict[str, ClientUsage]' = OrderedDict()
+        self.channels: Dict[str, TokenBucket] = {}
+        self.rejected: Dict[str, int] = {}
+
+    def _client(self, client: str) -> ClientUsage:
+        usage = self.clients.get(client)
+        if usage is None:
+            bucket = TokenBucket(self.client_rate, self.client_burst) if self.client_rate else None
+            usage = self.clients[client] = ClientUsage(bucket)
+            if len(self.clients) > self.max_clients:
+                idle_client = next((x for x, y in self.clients.items() if not y.requests), None)
+                if idle_client is not None:
+                    del self.clients[idle_client]
+        else:
+            self.clients.move_to_end(client)
+
+        return usage
+
+    def _reject(self, limit: str, status: int, retry_after: float = 1) -> AdmissionRejected:
+        self.rejected[limit] = self.rejected.get(limit, 0) + 1
+        return AdmissionRejected(limit, status, retry_after)
+
+    def check_rate(self, client: str) -> None:
+        """Count client's request, raise AdmissionRejected if it's too frequent."""
+        bucket = self._client(client).bucket
+        if bucket is not None:
+            wait_time = bucket.take()
+            if wait_time:
+                raise self._reject('client_rate', 429, wait_time)
+
+    def upstream(self, client: str, stream_id: str) -> UpstreamTicket:
+        """Admit upstream request of the client, raise AdmissionRejected if it's over the limits."""
+        usage = self._client(client)
+        if self.max_client_requests and usage.requests >= self.max_client_requests:
+            raise self._reject('client_upstream_requests', 429)
+        if self.max_client_bytes and usage.bytes >= self.max_client_bytes:
+            raise self._reject('client_upstream_bytes', 429)
+        if self.max_requests and self.requests >= self.max_requests:
+            raise self._reject('upstream_requests', 503)
+        if self.max_bytes and self.bytes >= self.max_bytes:
+            raise self._reject('upstream_bytes', 503)
+
+        if self.channel_rate:
+            bucket = self.channels.get(stream_id)
+            if bucket is None:
+                bucket = self.channels[stream_id] = TokenBucket(self.channel_rate,
+                                                                self.channel_burst)
+            wait_time = bucket.take()
+            if wait_time:
+                raise self._reject('channel_rate', 503, wait_time)
+
+        usage.requests += 1
+        self.requests += 1
+        return UpstreamTicket(self, usage)
+
+    def stats(self) -> Dict[str, float]:
+        """Admission statistics."""
+        return {'admission_upstream_requests': self.requests,
+                'admission_upstream_bytes': self.bytes,
+                'admission_clients': len(self.clients),
+                'admission_rejected': sum(self.rejected.values())}
+
+    def collect(self) -> Iterable[Tuple[str, 'Labels', float]]:
+        """Limits, their usage and rejections for metrics."""
+        for limit, value in (('upstream_requests', self.max_requests),
+                             ('client_upstream_requests', self.max_client_requests),
+                             ('upstream_bytes', self.max_bytes),
+                             ('client_upstream_bytes', self.max_client_bytes),
+                             ('client_rate', self.client_rate),
+                             ('channel_rate', self.channel_rate)):
+            yield 'admission_limit', (('limit', limit),), value
+            yield 'admission_rejected_total', (('limit', limit),), self.rejected.get(limit, 0)
+        yield 'admission_upstream_requests', (), self.requests
+        yield 'admission_upstream_bytes', (), self.bytes
+        yield 'admission_clients', (), len(self.clients)
+
+
+class ViewerTracker:
+    """Active viewers of the channels."""
+
+    def __init__(self, idle_durations: float = 3, default_target_duration: int = 10) -> None:
+        self.idle_durations = idle_durations  # viewer is gone after so many idle target durations
+        self.default_target_duration = default_target_duration
+        self.target_durations: Dict[str, int] = {}
+        self.last_seen: Dict[str, Dict[str, float]] = {}
+
+    def touch(self, stream_id: str, client: str) -> None:
+        """Register request of the client."""
+        self.last_seen.setdefault(stream_id, {})[client] = time.monotonic()
+
+    def set_target_duration(self, stream_id: str, target_duration: int) -> None:
+        self.target_durations[stream_id] = target_duration
+
+    def viewers(self, stream_id: str) -> int:
+        """Number of active viewers of the channel."""
+        clients = self.last_seen.get(stream_id)
+        if not clients:
+            return 0
+
+        idle_timeout = self.idle_durations * self.target_durations.get(
+            stream_id, self.default_target_duration
+        )
+        deadline = time.monotonic() - idle_timeout
+        for client in [x for x, seen in clients.items() if seen < deadline]:
+            del clients[client]
+
+        return len(clients)
+
+    def is_active(self, stream_id: str) -> bool:
+        return self.viewers(stream_id) > 0
+
+
+class Prefetcher:
+    """Background fetching of upcoming segments of actively watched channels."""
+
+    def __init__(self, cache: SegmentCache, viewers: ViewerTracker,
+                 fetch: Callable[[str, str], Awaitable[Optional[CacheEntry]]],
+                 segments: int = 2, concurrency: int = 4) -> None:
+        self.cache = cache
+        self.viewers = viewers
+        self.fetch = fetch  # (stream_id, upstream path with query) -> cache entry
+        self.segments = segments
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.tasks: Set['asyncio.Future[None]'] = set()
+        self.issued = 0
+        self.cancelled = 0  # not started due to no viewers left
+
+    def schedule(self, stream_id: str, playlist: 'ParsedPlaylist') -> None:
+        """Prefetch last segments of the media playlist."""
+        if not self.segments or not self.cache.max_bytes:
+            return
+
+        for segment in playlist.segments[-self.segments:]:
+            if segment.cache_key not in self.cache:
+                task = asyncio.ensure_future(
+                    self._prefetch(stream_id, segment.path_qs, segment.cache_key)
+                )
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+    async def _prefetch(self, stream_id: str, path_qs: str, key: str) -> None:
+        async with self.semaphore:
+            # Might've been requested while waiting
+            if key in self.cache:
+                return
+
+            # Nobody's watching anymore
+            if not self.viewers.is_active(stream_id):
+                self.cancelled += 1
+                return
+
+            self.issued += 1
+            flight = self.cache.begin(key)
+            entry = None
+            try:
+                entry = await self.fetch(stream_id, path_qs)
+                if entry is not None:
+                    entry.prefetched = True
+            except (asyncio.TimeoutError, aiohttp.ClientError, CircuitOpenError) as e:
+                logger.debug('Failed to prefetch %s: %s', path_qs, e)
+            finally:
+                self.cache.end(key, flight, entry)
+
+    def stats(self) -> Dict[str, float]:
+        """Prefetch statistics."""
+        return {'prefetch_issued': self.issued, 'prefetch_cancelled': self.cancelled,
+                'prefetch_pending': len(self.tasks)}
+
+    def close(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+
+
+async def extract_hls_src(chunks: AsyncIterator[bytes]) -> Optional[str]:
+    """Find stream URL in web player's page, stop reading it once found."""
+    tail = b''
+    async for chunk in chunks:
+        data = tail + chunk
+        start = data.find(HLS_SRC_PREFIX)
+        while start >= 0:
+            match = HLS_SRC_PATTERN.match(data, start)
+            if match:
+                return match.group('stream_url').decode()
+            next_start = data.find(HLS_SRC_PREFIX, start + 1)
+            if next_start < 0:
+                break
+            start = next_start
+
+        # Carry over what might be the beginning of the match straddling the chunks
+        if 0 <= start and len(data) - start <= HLS_SRC_MAX_SIZE:
+            tail = data[start:]
+        else:
+            tail = data[-(len(HLS_SRC_PREFIX) - 1):]
+
+    return None
+
+
+def player_url(channel: Channel, ustvgo_url: str = USTVGO_URL) -> str:
+    """Web player's page of the channel."""
+    return f'{ustvgo_url.rstrip("/")}/player.php?stream={channel["stream_id"]}'
+
+
+async def retrieve_stream_url(channel: Channel, pool: UpstreamPool, max_retries: int = 5,
+                              ustvgo_url: str = USTVGO_URL) -> Optional['ChannelRecord']:
+    """Retrieve stream URL from web player with retries backing off exponentially."""
+    url = player_url(channel, ustvgo_url)
+    timeout, max_timeout = 2, 10
+    exceptions = (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                  aiohttp.ClientResponseError, aiohttp.ServerDisconnectedError, CircuitOpenError)
+
+    attempt = 0
+    while True:
+        try:
+            session = pool.session(url)
+            async with pool.limiter.slot(url) as slot, session.get(
+                url=url, headers=USTVGO_HEADERS, raise_for_status=True,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                slot.response_started()
+                stream_url = await extract_hls_src(response.content.iter_any())
+                if stream_url is None:
+                    return None
+
+                # Keep the connection alive unless there's much of the page left,
+                # URL is found anyway, broken rest of the page just closes the connection
+                if response.content_length is not None and \
+                        response.content_length <= PLAYER_PAGE_DRAIN_SIZE:
+                    with contextlib.suppress(asyncio.TimeoutError, aiohttp.ClientError):
+                        await response.read()
+
+                return ChannelRecord.create(channel, stream_url, ustvgo_url)
+        except Exception as e:
+            is_exc_valid = any([isinstance(e, exc) for exc in exceptions])
+            if not is_exc_valid:
+                raise
+
+            timeout = min(timeout + 1, max_timeout)
+            max_retries -= 1
+            if max_retries <= 0:
+                logger.error('Failed to get url %s', url)
+                return None
+
+            attempt += 1
+            await asyncio.sleep(backoff_delay(attempt))
+
+
+def playlist_base_url(host: str, password: str) -> furl:
+    return furl(netloc=host, scheme='http', path=password)
+
+
+def render_playlist_header(host: str, use_uncompressed_tvguide: bool, password: str,
+                           query: str = '') -> str:
+    """Render master playlist's header, TV Guide is filtered with the query if any."""
+    tvg_compressed_ext = '' if use_uncompressed_tvguide else '.gz'
+    tvg_url = playlist_base_url(host, password) / f'tvguide.xml{tvg_compressed_ext}'
+    return '#EXTM3U url-tvg="%s%s" refresh="1800"\n\n' % (tvg_url, f'?{query}' if query else '')
+
+
+def playlist_entry(channel: Channel, path_qs: Optional[str] = None) -> Tuple[str, ...]:
+    """Master playlist's entry of the channel split at the places of proxy's base URL,
+    listed with stream path and query or, in lazy mode, with the path resolving it."""
+    # Stream URL is resolved on the first request
+    path_qs = path_qs or f'/{channel["stream_id"]}/{LAZY_PLAYLIST_NAME}'
+    return (f'#EXTINF:-1 tvg-id="{channel["stream_id"]}" tvg-logo="',
+            f'/logos/{channel["stream_id"]}.png" group-title="{channel["category"]}",'
+            f'{channel["name"]}\n',
+            f'{path_qs}\n\n')
+
+
+def render_playlist(entries: Iterable[Tuple[str, ...]], host: str,
+                    use_uncompressed_tvguide: bool, password: str) -> str:
+    """Render master playlist."""
+    with io.StringIO() as f:
+        base_url = playlist_base_url(host, password).url
+        f.write(render_playlist_header(host, use_uncompressed_tvguide, password))
+        for entry in entries:
+            f.write(base_url.join(entry))
+
+        return f.getvalue()
+
+
+class ChannelRecord(NamedTuple):
+    """Immutable channel with its stream URL split once for serving,
+    replaced as a whole when the stream changes."""
+
+    stream_id: str
+    info: Channel  # shared listing, never modified
+    is_vip: bool
+    stream_origin: str
+    path_qs: str  # stream path with query, without auth key
+    key: str  # auth key the stream URL came with
+    entry: Tuple[str, ...]  # master playlist's entry
+    player_url: str  # web player's page the stream URL is scraped from
+
+    @classmethod
+    def create(cls, channel: Channel, stream_url: str,
+               ustvgo_url: str = USTVGO_URL) -> 'ChannelRecord':
+        url = furl(stream_url)
+        origin: str = url.origin
+        key: str = url.args.get('wmsAuthSign') or ''
+        # No need to expose auth key to the master playlist
+        location: str = url.remove(args=['wmsAuthSign']).tostr(query_dont_quote='=')
+        path_qs = location[len(origin):] or '/'
+        return cls(channel['stream_id'], channel, '/vipStream/' in location, origin, path_qs, key,
+                   playlist_entry(channel, path_qs), player_url(channel, ustvgo_url))
+
+    @property
+    def location(self) -> str:
+        """Stream URL without auth key, as it's listed in master playlist."""
+        return self.stream_origin + self.path_qs
+
+    @property
+    def stream_url(self) -> str:
+        """Upstream stream URL with the auth key."""
+        return upstream_url(self.stream_origin, self.path_qs, self.key)
+
+
+def parse_flag(name: str, value: str) -> bool:
+    """Boolean query parameter."""
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(f'Bad value of {name}: {value!r}')
+
+
+class ChannelView(NamedTuple):
+    """Channels listed by a playlist, all of them unless filtered by the request's query."""
+
+    categories: FrozenSet[str] = frozenset()  # case-insensitive
+    languages: FrozenSet[str] = frozenset()  # case-insensitive
+    stream_ids: FrozenSet[str] = frozenset()
+    vip: Optional[bool] = None
+    healthy: bool = False
+    # Channels left out for their current state, e.g. unhealthy, set by the server
+    excluded: FrozenSet[str] = frozenset()
+
+    @classmethod
+    def from_query(cls, query: Iterable[Tuple[str, str]]) -> 'ChannelView':
+        """Parse filters like ?category=News,Sports&language=en&stream_id=ABC&vip=0&healthy=1,
+        lists are comma separated or repeated, other parameters are ignored."""
+        lists: Dict[str, Set[str]] = {'category': set(), 'language': set(), 'stream_id': set()}
+        flags: Dict[str, bool] = {}
+        for name, value in query:
+            if name in lists:
+                lists[name].update(x.strip() for x in value.split(',') if x.strip())
+            elif name in ('vip', 'healthy'):
+                flags[name] = parse_flag(name, value)
+
+        return cls(frozenset(x.casefold() for x in lists['category']),
+                   frozenset(x.casefold() for x in lists['language']),
+                   frozenset(lists['stream_id']), flags.get('vip'), flags.get('healthy', False))
+
+    @property
+    def query(self) -> str:
+        """Query string of the filters but health, e.g. for TV Guide of the view."""
+        params = [(name, ','.join(sorted(values))) for name, values in (
+            ('category', self.categories), ('language', self.languages),
+            ('stream_id', self.stream_ids)
+        ) if values]
+        if self.vip is not None:
+            params.append(('vip', str(int(self.vip))))
+        return urlencode(params, safe=',')
+
+
+class ChannelIndex:
+    """Stream ids of the channels by category, language and vip flag in listing order,
+    views are selected from them instead of filtering every channel."""
+
+    __slots__ = ('order', 'positions', 'by_category', 'by_language', 'by_vip', 'selections')
+
+    def __init__(self, channels: Iterable[Tuple[Channel, Optional[bool]]]) -> None:
+        self.order: Tuple[str, ...] = ()
+        self.positions: Dict[str, int] = {}
+        self.by_category: Dict[str, List[str]] = {}
+        self.by_language: Dict[str, List[str]] = {}
+        self.by_vip: Dict[Optional[bool], List[str]] = {False: [], True: [], None: []}  # None unknown
+        for channel, is_vip in channels:
+            stream_id = channel['stream_id']
+            self.positions[stream_id] = len(self.positions)
+            self.by_category.setdefault(channel['category'].casefold(), []).append(stream_id)
+            self.by_language.setdefault(channel['language'].casefold(), []).append(stream_id)
+            self.by_vip[is_vip].append(stream_id)
+        self.order = tuple(self.positions)
+        # Recently selected views, their number is bounded as queries are client-controlled
+        self.selections: 'OrderedDict[ChannelView, Tuple[str, ...]]' = OrderedDict()
+
+    def select(self, view: ChannelView) -> Tuple[str, ...]:
+        """Stream ids of the view in listing order, the ones of unknown vip flag included."""
+        key = view._replace(healthy=False, excluded=frozenset())
+        selection = self.selections.get(key)
+        if selection is not None:
+            self.selections.move_to_end(key)
+            return selection
+
+        groups: List[Iterable[str]] = []
+        if view.stream_ids:
+            groups.append(x for x in view.stream_ids if x in self.positions)
+        if view.categories:
+            groups.append(x for category in view.categories for x in self.by_category.get(category, ()))
+        if view.languages:
+            groups.append(x for language in view.languages for x in self.by_language.get(language, ()))
+        if view.vip is not None:
+            groups.append(self.by_vip[view.vip] + self.by_vip[None])
+
+        if not groups:
+            selection = self.order
+        else:
+            selected = set(groups[0])
+            for group in groups[1:]:
+                selected.intersection_update(group)
+            selection = tuple(sorted(selected, key=self.positions.__getitem__))
+
+        self.selections[key] = selection
+        if len(self.selections) > 64:
+            self.selections.popitem(last=False)
+        return selection
+
+
+class ChannelRegistry:
+    """Snapshot of the served channels in listing order with their indexes.
+
+    It's never modified, updated channels make a new registry which is swapped in
+    at once, so a request sees either the old or the new channels but no mix of them.
+    """
+
+    __slots__ = ('records', 'by_stream_id', 'by_vip', 'index')
+
+    def __init__(self, records: Iterable[ChannelRecord] = ()) -> None:
+        self.records = tuple(records)
+        self.by_stream_id = {x.stream_id: x for x in self.records}
+        self.by_vip: Dict[bool, Tuple[ChannelRecord, ...]] = {
+            is_vip: tuple(x for x in self.records if x.is_vip == is_vip) for is_vip in (False, True)
+        }
+        self.index = ChannelIndex((x.info, x.is_vip) for x in self.records)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __iter__(self) -> Iterator[ChannelRecord]:
+        return iter(self.records)
+
+    def __contains__(self, stream_id: object) -> bool:
+        return stream_id in self.by_stream_id
+
+    def get(self, stream_id: str) -> Optional[ChannelRecord]:
+        return self.by_stream_id.get(stream_id)
+
+    def select(self, view: ChannelView) -> Tuple[str, ...]:
+        """Stream ids of the view in listing order."""
+        return self.index.select(view)
+
+    def replace(self, updated: Iterable[ChannelRecord],
+                order: Sequence[str]) -> 'ChannelRegistry':
+        """New registry with the updated channels swapped in, in the order of the listing."""
+        records = {**self.by_stream_id, **{x.stream_id: x for x in updated}}
+        return ChannelRegistry(records[x] for x in order if x in records)
+
+    def changed(self, other: 'ChannelRegistry') -> Set[str]:
+        """Channels added, removed or moved in the other registry."""
+        changed = set(self.by_stream_id).symmetric_difference(other.by_stream_id)
+        changed.update(x.stream_id for x in other if x.stream_id in self.by_stream_id
+                       and self.by_stream_id[x.stream_id].location != x.location)
+        return changed
+
+
+class RenderedPlaylist:
+    """Rendered master playlist ready to be served."""
+
+    __slots__ = ('body', 'gzipped', 'etag', 'last_modified')
+
+    def __init__(self, text: str, last_modified: datetime.datetime) -> None:
+        self.body = text.encode('utf-8')
+        self.gzipped = gzip.compress(self.body)
+        self.etag = hashlib.md5(self.body).hexdigest()
+        self.last_modified = last_modified
+
+    def response(self, request: web.Request) -> web.Response:
+        """Make response, honor client's conditional and compression headers."""
+        headers = {aiohttp.hdrs.ETAG: f'"{self.etag}"',
+                   aiohttp.hdrs.LAST_MODIFIED: email.utils.format_datetime(self.last_modified,
+                                                                           usegmt=True),
+                   aiohttp.hdrs.VARY: aiohttp.hdrs.ACCEPT_ENCODING}
+
+        if_none_match = request.headers.get(aiohttp.hdrs.IF_NONE_MATCH)
+        if if_none_match is not None:
+            if self.etag in if_none_match or if_none_match.strip() == '*':
+                return web.Response(status=304, headers=headers)
+        elif request.if_modified_since is not None and \
+                request.if_modified_since >= self.last_modified:
+            return web.Response(status=304, headers=headers)
+
+        if 'gzip' in request.headers.get(aiohttp.hdrs.ACCEPT_ENCODING, '').lower():
+            headers[aiohttp.hdrs.CONTENT_ENCODING] = 'gzip'
+            return web.Response(body=self.gzipped, headers=headers,
+                                content_type='text/plain', charset='utf-8')
+
+        return web.Response(body=self.body, headers=headers,
+                            content_type='text/plain', charset='utf-8')
+
+
+class PlaylistCache:
+    """Master playlists rendered per (host, password, TV Guide compression) and view of the channels.
+
+    Rendered playlists are kept until the channels change. Entries are split at
+    the places of the base URL beforehand, so rendering is just joining them.
+    """
+
+    def __init__(self, listing: Callable[[ChannelView], Iterable[Tuple[str, ...]]],
+                 render_header: Callable[[str, ChannelView], str], base_url: Callable[[str], str],
+                 max_entries: int = 64) -> None:
+        self.listing = listing  # view -> entries of the listed channels in order
+        self.render_header = render_header  # host, view -> header
+        self.base_url = base_url  # host -> base URL entries are joined with
+        self.max_entries = max_entries  # bounds memory, Host header and query are client-controlled
+        self.entries: 'OrderedDict[Tuple[Tuple[str, ...], ChannelView], RenderedPlaylist]' = \
+            OrderedDict()
+        self.last_modified = self._now()
+
+    @staticmethod
+    def _now() -> datetime.datetime:
+        # HTTP dates have seconds precision
+        return datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+    def get(self, host: str, *variant: str, view: ChannelView = ChannelView()) -> RenderedPlaylist:
+        """Get rendered playlist of the view."""
+        key = (host, *variant)
+        playlist = self.entries.get((key, view))
+        if playlist is None:
+            playlist = RenderedPlaylist(self._render(host, view), self.last_modified)
+            self.entries[(key, view)] = playlist
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end((key, view))
+
+        return playlist
+
+    def _render(self, host: str, view: ChannelView) -> str:
+        base_url = self.base_url(host)
+        with io.StringIO() as f:
+            f.write(self.render_header(host, view))
+            for entry in self.listing(view):
+                f.write(base_url.join(entry))
+
+            return f.getvalue()
+
+    def invalidate(self, last_modified: Optional[datetime.datetime] = None) -> None:
+        """Drop rendered playlists, the channels have changed."""
+        self.entries.clear()
+        self.last_modified = (last_modified or self._now()).replace(microsecond=0)
+
+
+async def collect_urls(channels: List[Channel], pool: UpstreamPool, show_progress: bool = True,
+                       ustvgo_url: str = USTVGO_URL) -> List[ChannelRecord]:
+    """Collect channel stream URLs from ustvgo.tv web players,
+    number of parallel requests is adapted by the pool's limiter."""
+    logger.info('Extracting stream URLs from USTVGO. Parallel requests: %d, adaptive.',
+                pool.limiter.options['initial_limit'])
+    retrieve_tasks = [retrieve_stream_url(channel, pool, ustvgo_url=ustvgo_url)
+                      for channel in channels]
+    gather = functools.partial(tqdm.gather, desc='Collect URLs') if show_progress \
+        else asyncio.gather
+    results: List[Optional[ChannelRecord]] = await gather(*retrieve_tasks)
+
+    channels_ok = [x for x in results if x]
+    report_msg = 'Extracted %d channels out of %d.'
+    if len(channels_ok) < len(results):
+        report_msg += ' You can extract more using VPN.'
+    logger.info(report_msg, len(channels_ok), len(results))
+
+    return channels_ok
+
+
+async def update_auth_key(channel: Channel, pool: UpstreamPool,
+                          ustvgo_url: str = USTVGO_URL) -> Optional[str]:
+    """Update auth key."""
+    record = await retrieve_stream_url(channel, pool, ustvgo_url=ustvgo_url)
+    return record.key if record is not None else None
+
+
+def auth_key_lifetime(key: str) -> Optional[float]:
+    """Lifetime of auth key declared within it, if any."""
+    # Key is base64 encoded "server_time=...&hash_value=...&validminutes=..."
+    try:
+        decoded = base64.b64decode(key + '=' * (-len(key) % 4)).decode()
+        return int(dict(parse_qsl(decoded))['validminutes']) * 60
+    except (ValueError, UnicodeDecodeError, KeyError):
+        return None
+
+
+class AuthKey:
+    """Auth key shared by VIP or non-VIP streams."""
+
+    def __init__(self, is_vip: bool, default_lifetime: float = 1800,
+                 ustvgo_url: str = USTVGO_URL) -> None:
+        self.log_prefix = '[VIP (VPN)]' if is_vip else '[No VIP (No VPN)]'
+        self.key = ''
+        self.is_vip = is_vip
+        self.ustvgo_url = ustvgo_url
+        self.lock = asyncio.Lock()
+        self.retrieved_time = 0.0
+        self.failed_time = 0.0  # of the last renewal that didn't get a new key
+        self.channel: Optional[Channel] = None  # channel to scrape new keys from
+        self.default_lifetime = default_lifetime
+        self.lifetimes: Deque[float] = deque(maxlen=10)  # observed till the first 403
+        self.expired_key = ''
+        self.refreshes = 0
+        self.refresh_time = 0.0
+        self.lock_wait_time = 0.0
+        self.listeners: List[Callable[['AuthKey'], None]] = []  # notified of new keys
+
+    def __str__(self) -> str:
+        return self.key
+
+    def set(self, key: str) -> None:
+        """Swap in new key, the same one is kept with the time it was retrieved."""
+        if key == self.key:
+            return
+
+        self.key = key
+        self.retrieved_time = time.time()
+        for listener in self.listeners:
+            listener(self)
+
+    @property
+    def lifetime(self) -> float:
+        """Expected lifetime of the key."""
+        if self.lifetimes:
+            return sorted(self.lifetimes)[len(self.lifetimes) // 2]
+
+        return auth_key_lifetime(self.key) or self.default_lifetime
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.retrieved_time
+
+    def expired(self, key: str) -> None:
+        """Register expiry of the key, i.e. 403 response."""
+        if key == self.key and key != self.expired_key and self.retrieved_time:
+            self.expired_key = key
+            self.lifetimes.append(self.age)
+
+    async def refresh(self, pool: UpstreamPool, channel: Optional[Channel] = None) -> bool:
+        """Scrape new key, should be called under the lock."""
+        channel = channel or self.channel
+        if channel is None:
+            return False
+
+        logger.info('%s Fetching new auth key from USTVGO.', self.log_prefix)
+        started_time = time.monotonic()
+        new_auth_key = await update_auth_key(channel, pool, self.ustvgo_url)
+        self.refresh_time += time.monotonic() - started_time
+        self.refreshes += 1
+
+        if new_auth_key:
+            self.set(new_auth_key)
+            logger.info('%s Got new auth key "%s"', self.log_prefix, self)
+            return True
+
+        logger.error('%s Failed to get new auth key!', self.log_prefix)
+        self.failed_time = time.time()
+        return False
+
+    async def renew(self, key: str, pool: UpstreamPool, channel: Channel) -> None:
+        """Renew expired key unless it's been already done by someone else."""
+        started_time = time.monotonic()
+        async with self.lock:
+            self.lock_wait_time += time.monotonic() - started_time
+            # Don't hammer upstream after failed renewal
+            if self.key == key and time.time() - self.failed_time > AUTH_KEY_RETRY_DELAY:
+                if await self.refresh(pool, channel) and self.key == key:
+                    logger.warning('%s Got the expired auth key again.', self.log_prefix)
+                    self.failed_time = time.time()
+
+    def stats(self) -> Dict[str, float]:
+        """Auth key statistics."""
+        prefix = 'auth_key_vip' if self.is_vip else 'auth_key_nonvip'
+        return {f'{prefix}_age': self.age if self.key else 0,
+                f'{prefix}_lifetime': self.lifetime,
+                f'{prefix}_observed_lifetimes': len(self.lifetimes),
+                f'{prefix}_refreshes': self.refreshes,
+                f'{prefix}_refresh_seconds': self.refresh_time,
+                f'{prefix}_lock_wait_seconds': self.lock_wait_time}
+
+
+class AuthKeyRefresher:
+    """Background renewal of auth keys ahead of their expiry."""
+
+    def __init__(self, auth_keys: List[AuthKey], pool: UpstreamPool, ahead: float = 0.8,
+                 check_interval: float = 10, retry_interval: float = 60) -> None:
+        self.auth_keys = auth_keys
+        self.pool = pool
+        self.ahead = ahead  # refresh when this share of expected lifetime passed
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.failed_time: Dict[bool, float] = {}
+
+    def is_due(self, auth_key: AuthKey) -> bool:
+        return bool(auth_key.key) and auth_key.age > auth_key.lifetime * self.ahead and \
+            time.time() - self.failed_time.get(auth_key.is_vip, 0) > self.retry_interval
+
+    async def run(self) -> None:
+        """Refresh keys forever."""
+        while True:
+            await asyncio.sleep(self.check_interval)
+            for auth_key in self.auth_keys:
+                if not self.is_due(auth_key):
+                    continue
+
+                # Viewers keep using current key until the new one's swapped in
+                async with auth_key.lock:
+                    key = auth_key.key
+                    try:
+                        # Key might not have been rotated upstream yet, try again later
+                        if self.is_due(auth_key) and (not await auth_key.refresh(self.pool)
+                                                      or auth_key.key == key):
+                            self.failed_time[auth_key.is_vip] = time.time()
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        logger.error('%s Failed to refresh auth key: %r', auth_key.log_prefix, e,
+                                     exc_info=True)
+                        self.failed_time[auth_key.is_vip] = time.time()
+
+
+class ChannelReconciler:
+    """Background re-discovery of missing, failed and moved channels.
+
+    Every round checks channels that weren't collected or whose streams failed,
+    topped up with the least recently checked ones to notice VIP/origin moves.
+    Requests are few at a time and yield to the others queued for the origin.
+    """
+
+    def __init__(self, all_channels: List[Channel], streams: Callable[[], ChannelRegistry],
+                 update: Callable[[List[ChannelRecord]], None], pool: UpstreamPool,
+                 interval: float = 300, batch_size: int = 10, concurrency: int = 2,
+                 ustvgo_url: str = USTVGO_URL) -> None:
+        self.all_channels = all_channels
+        self.streams = streams  # currently served channels by stream_id
+        self.update = update  # swaps in rediscovered channels
+        self.pool = pool
+        self.ustvgo_url = ustvgo_url
+        self.interval = interval
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.failed: Set[str] = set()
+        self.listeners: List[Callable[[Set[str]], None]] = []  # notified of failed channels
+        self.checked_time: Dict[str, float] = {}
+        self.checks = 0
+        self.updates = 0
+
+    def mark_failed(self, stream_id: str) -> None:
+        """Stream of the channel isn't available, check it in the next round."""
+        if stream_id not in self.failed:
+            self.failed.add(stream_id)
+            self._notify()
+
+    def set_failed(self, stream_ids: Iterable[str]) -> None:
+        """Failed channels as they're known to the coordinator."""
+        self.failed = set(stream_ids)
+
+    def _notify(self) -> None:
+        for listener in self.listeners:
+            listener(self.failed)
+
+    def candidates(self) -> List[Channel]:
+        streams = self.streams()
+        failing = [x for x in self.all_channels
+                   if x['stream_id'] not in streams or x['stream_id'] in self.failed]
+        others = sorted((x for x in self.all_channels
+                         if x['stream_id'] in streams and x['stream_id'] not in self.failed),
+                        key=lambda x: self.checked_time.get(x['stream_id'], 0))
+        return failing + others[:max(self.batch_size - len(failing), 0)]
+
+    async def check(self, channel: Channel) -> Optional[ChannelRecord]:
+        """Rediscover the channel, return it if it's new or moved."""
+        async with self.semaphore:
+            url = player_url(channel, self.ustvgo_url)
+            # Low priority, let queued requests go first
+            while self.pool.limiter.origin(url).waiters:
+                await asyncio.sleep(1)
+
+            self.checks += 1
+            self.checked_time[channel['stream_id']] = time.time()
+            found = await retrieve_stream_url(channel, self.pool, max_retries=1,
+                                              ustvgo_url=self.ustvgo_url)
+            if found is None:
+                return None
+
+            if channel['stream_id'] in self.failed:
+                self.failed.discard(channel['stream_id'])
+                self._notify()
+            current = self.streams().get(channel['stream_id'])
+            if current is not None and current.location == found.location:
+                return None
+            return found
+
+    async def reconcile(self) -> List[ChannelRecord]:
+        """Run a round, return the channels that were swapped in."""
+        candidates = self.candidates()
+        results = await asyncio.gather(*[self.check(x) for x in candidates],
+                                       return_exceptions=True)
+        updated: List[ChannelRecord] = []
+        for channel, result in zip(candidates, results):
+            if isinstance(result, BaseException):
+                # Checked again in the next round
+                logger.error('Failed to rediscover channel %s: %r',
+                             channel['stream_id'], result)
+            elif result is not None:
+                updated.append(result)
+        if updated:
+            self.updates += len(updated)
+            self.update(updated)
+            logger.info('Rediscovered %d channels: %s.', len(updated),
+                        ', '.join(x.stream_id for x in updated))
+        return updated
+
+    async def run(self) -> None:
+        """Reconcile channels forever."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error('Failed to reconcile channels: %r', e, exc_info=True)
+
+    def stats(self) -> Dict[str, float]:
+        """Reconciler statistics."""
+        return {'reconciler_checks': self.checks, 'reconciler_updates': self.updates,
+                'reconciler_failed': len(self.failed)}
+
+
+def dump_state(channels: Iterable[ChannelRecord], auth_keys: List[AuthKey]) -> Dict[str, Any]:
+    """Collected channels and auth keys as plain data."""
+    return {
+        'version': VERSION,
+        'saved_time': time.time(),
+        'channels': [{'stream_id': x.stream_id, 'stream_url': x.stream_url,
+                      'stream_origin': x.stream_origin, 'is_vip': x.is_vip}
+                     for x in channels],
+        'auth_keys': dump_auth_keys(auth_keys),
+    }
+
+
+def dump_auth_keys(auth_keys: List[AuthKey]) -> List[Dict[str, Any]]:
+    return [{'is_vip': x.is_vip, 'key': x.key, 'retrieved_time': x.retrieved_time}
+            for x in auth_keys if x.key]
+
+
+def apply_state(state: Dict[str, Any], channels: List[Channel], auth_keys: List[AuthKey],
+                ustvgo_url: str = USTVGO_URL) -> List[ChannelRecord]:
+    """Set auth keys from the dumped state, return the channels with saved stream URLs."""
+    saved_channels = {x['stream_id']: x['stream_url'] for x in state['channels']}
+
+    loaded_channels = [ChannelRecord.create(x, saved_channels[x['stream_id']], ustvgo_url)
+                       for x in channels if x['stream_id'] in saved_channels]
+
+    apply_auth_keys(state['auth_keys'], auth_keys)
+    return loaded_channels
+
+
+def apply_auth_keys(dumped_auth_keys: List[Dict[str, Any]], auth_keys: List[AuthKey]) -> None:
+    saved_auth_keys = {x['is_vip']: x for x in dumped_auth_keys}
+    for auth_key in auth_keys:
+        if auth_key.is_vip in saved_auth_keys:
+            auth_key.key = saved_auth_keys[auth_key.is_vip]['key']
+            auth_key.retrieved_time = saved_auth_keys[auth_key.is_vip]['retrieved_time']
+
+
+def save_state(filepath: pathlib.Path, channels: Iterable[ChannelRecord],
+               auth_keys: List[AuthKey]) -> None:
+    """Save collected channels and auth keys for the next warm start."""
+    try:
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_filepath = filepath.with_name(filepath.name + '.tmp')
+        tmp_filepath.write_bytes(JSON.dumps(dump_state(channels, auth_keys)))
+        os.replace(tmp_filepath, filepath)
+    except OSError as e:
+        logger.error('Failed to save state to %s: %s', filepath, e)
+
+
+def load_state(filepath: pathlib.Path, channels: List[Channel], auth_keys: List[AuthKey],
+               ustvgo_url: str = USTVGO_URL) -> List[ChannelRecord]:
+    """Load channels with their stream URLs and auth keys saved by the previous run."""
+    try:
+        state = JSON.loads(filepath.read_bytes())
+        return apply_state(state, channels, auth_keys, ustvgo_url)
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.error('Failed to load state from %s: %s', filepath, e)
+        return []
+
+
+class WorkerPool:
+    """Worker processes sharing the server port with SO_REUSEPORT.
+
+    Channels and auth keys are scraped and renewed by the coordinator process once
+    for all the workers and pushed to them through the pipes. Workers report expired
+    keys and failed channels back to it.
+    """
+
+    def __init__(self, workers: int, options: Dict[str, Any],
+                 renew: Callable[[bool, str], Awaitable[None]], mark_failed: Callable[[str], None],
+                 min_uptime: float = 10) -> None:
+        self.workers = workers
+        self.options = options  # playlist_server() arguments of the workers
+        self.renew = renew  # (is_vip, expired key)
+        self.mark_failed = mark_failed  # stream_id of the channel failed on a worker
+        self.min_uptime = min_uptime  # worker exited sooner is considered broken
+        self.context = multiprocessing.get_context('spawn')
+        self.processes: List[Optional[multiprocessing.process.BaseProcess]] = [None] * workers
+        self.connections: List[Optional[Connection]] = [None] * workers
+        self.started_time = [0.0] * workers
+        self.state: Dict[str, Any] = {}
+        self.failed: List[str] = []  # failed channels as they're known to the coordinator
+        self.renewals: Set['asyncio.Future[None]'] = set()
+
+    def start(self, state: Dict[str, Any]) -> None:
+        """Start workers serving the channels."""
+        self.state = state
+        for idx in range(self.workers):
+            self._spawn(idx)
+
+    def _spawn(self, idx: int) -> None:
+        options = dict(self.options)
+        if options.get('disk_cache_dir'):
+            # Disk cache is wiped at startup, each worker needs its own
+            options['disk_cache_dir'] = str(pathlib.Path(options['disk_cache_dir']) / f'worker-{idx}')
+
+        connection, worker_connection = self.context.Pipe()
+        process = self.context.Process(target=run_worker, name=f'ustvgo-iptv-worker-{idx}',
+                                       args=(worker_connection, options, self.state), daemon=True)
+        process.start()
+        worker_connection.close()
+
+        asyncio.get_event_loop().add_reader(connection.fileno(), self._receive, idx)
+        self.processes[idx] = process
+        self.connections[idx] = connection
+        self.started_time[idx] = time.monotonic()
+        if self.failed:
+            self._send(idx, ('failed', self.failed))
+        logger.info('Started worker #%d, pid %s.', idx, process.pid)
+
+    def _receive(self, idx: int) -> None:
+        connection = self.connections[idx]
+        assert connection is not None
+        try:
+            command, *params = connection.recv()
+        except (EOFError, OSError):
+            self._disconnect(idx)
+            return
+
+        if command == 'renew':
+            future = asyncio.ensure_future(self._renew(idx, *params))
+            self.renewals.add(future)
+            future.add_done_callback(self.renewals.discard)
+        elif command == 'failed':
+            self.mark_failed(*params)
+
+    async def _renew(self, idx: int, is_vip: bool, key: str) -> None:
+        try:
+            await self.renew(is_vip, key)
+        finally:
+            # Reply even if the key's been renewed already, worker waits for it
+            self._send(idx, ('keys', self.state['auth_keys']))
+
+    def _send(self, idx: int, message: Tuple[str, Any]) -> None:
+        connection = self.connections[idx]
+        if connection is not None:
+            try:
+                connection.send(message)
+            except OSError:
+                self._disconnect(idx)
 
+    def _disconnect(self, idx: int) -> None:
+        connection = self.connections[idx]
+        if connection is not None:
+            asyncio.get_event_loop().remove_reader(connection.fileno())
+            connection.close()
+            self.connections[idx] = None
 
-def root_dir() -> pathlib.Path:
-    """Root directory."""
-    if hasattr(sys, '_MEIPASS'):
-        return pathlib.Path(sys._MEIPASS)
-    else:
-        return pathlib.Path(__file__).parent
+    def publish(self, state: Dict[str, Any]) -> None:
+        """Push new channels and auth keys to the workers."""
+        self.state = state
+        for idx in range(self.workers):
+            self._send(idx, ('channels', state))
 
+    def watch(self, auth_keys: List[AuthKey], reconciler: 'ChannelReconciler') -> None:
+        """Push auth keys to the workers once any of them is renewed
+        and failed channels once they change."""
+        for auth_key in auth_keys:
+            auth_key.listeners.append(lambda _: self.publish_auth_keys(dump_auth_keys(auth_keys)))
+        reconciler.listeners.append(lambda failed: self.publish_failed(sorted(failed)))
 
-def load_dict(filename: str) -> Any:
-    """Load root dictionary."""
-    filepath = root_dir() / filename
-    with open(filepath, encoding='utf-8') as f:
-        return json.load(f)
+    def publish_auth_keys(self, auth_keys: List[Dict[str, Any]]) -> None:
+        if self.state:
+            self.state['auth_keys'] = auth_keys
+            for idx in range(self.workers):
+                self._send(idx, ('keys', auth_keys))
 
+    def publish_failed(self, failed: List[str]) -> None:
+        self.failed = failed
+        for idx in range(self.workers):
+            self._send(idx, ('failed', failed))
 
-def local_ip_addresses() -> List[str]:
-    """Finding all local IP addresses."""
-    ip_addresses: List[str] = []
-    interfaces = netifaces.interfaces()
-    for i in interfaces:
-        iface = netifaces.ifaddresses(i).get(netifaces.AF_INET, [])
-        ip_addresses.extend(x['addr'] for x in iface)
+    async def supervise(self, interval: float = 1) -> None:
+        """Restart exited workers, return once they fail right after the start."""
+        while True:
+            await asyncio.sleep(interval)
+            for idx, process in enumerate(self.processes):
+                if process is None or process.is_alive():
+                    continue
 
-    return ip_addresses
+                self._disconnect(idx)
+                logger.error('Worker #%d exited with code %s.', idx, process.exitcode)
+                if time.monotonic() - self.started_time[idx] < self.min_uptime:
+                    return
+                self._spawn(idx)
 
+    def close(self) -> None:
+        """Stop the workers."""
+        for renewal in self.renewals:
+            renewal.cancel()
 
-async def gather_with_concurrency(n: int, *tasks: Awaitable[Any],
-                                  show_progress: bool = True,
-                                  progress_title: Optional[str] = None) -> Any:
-    """Gather tasks with concurrency."""
-    semaphore = asyncio.Semaphore(n)
+        for idx, process in enumerate(self.processes):
+            self._disconnect(idx)
+            if process is not None and process.is_alive():
+                process.terminate()
 
-    async def sem_task(task: Awaitable[Any]) -> Any:
-        async with semaphore:
-            return await task
+        for process in self.processes:
+            if process is not None:
+                process.join(timeout=5)
 
-    gather = functools.partial(tqdm.gather, desc=progress_title) if show_progress \
-        else asyncio.gather
-    return await gather(*[sem_task(x) for x in tasks])  # type: ignore
 
+class CoordinatorLink:
+    """Worker's side of the pipe to the coordinator process."""
 
-async def retrieve_stream_url(channel: Channel, max_retries: int = 5) -> Optional[Channel]:
-    """Retrieve stream URL from web player with retries."""
-    url = 'https://ustvgo.tv/player.php?stream=' + channel['stream_id']
-    timeout, max_timeout = 2, 10
-    exceptions = (asyncio.TimeoutError, aiohttp.ClientConnectionError,
-                  aiohttp.ClientResponseError, aiohttp.ServerDisconnectedError)
+    def __init__(self, connection: Connection,
+                 on_channels: Callable[[Dict[str, Any]], None],
+                 on_auth_keys: Callable[[List[Dict[str, Any]]], None],
+                 on_failed: Callable[[List[str]], None]) -> None:
+        self.connection = connection
+        self.on_channels = on_channels
+        self.on_auth_keys = on_auth_keys
+        self.on_failed = on_failed
+        self.loop = asyncio.get_event_loop()
+        self.closed: 'asyncio.Future[None]' = self.loop.create_future()
+        self.auth_keys_received: 'asyncio.Future[None]' = self.loop.create_future()
+        self.loop.add_reader(connection.fileno(), self._receive)
 
-    while True:
+    def _receive(self) -> None:
         try:
-            async with aiohttp.TCPConnector(ssl=False) as connector:
-                async with aiohttp.ClientSession(headers=USTVGO_HEADERS, raise_for_status=True,
-                                                 connector=connector) as session:
-                    async with session.get(url=url, timeout=timeout) as response:
-                        resp_html = await response.text()
-                        match = re.search(r'hls_src=["\'](?P<stream_url>[^"\']+)', resp_html)
-                        if match:
-                            channel['stream_url'] = furl(match.group('stream_url'))
-                            return channel
-                        return None
-        except Exception as e:
-            is_exc_valid = any([isinstance(e, exc) for exc in exceptions])
-            if not is_exc_valid:
-                raise
-
-            timeout = min(timeout + 1, max_timeout)
-            max_retries -= 1
-            if max_retries <= 0:
-                logger.error('Failed to get url %s', url)
-                return None
+            command, payload = self.connection.recv()
+        except (EOFError, OSError):
+            logger.error('Lost connection to the coordinator process.')
+            self.close()
+            return
 
+        if command == 'failed':
+            self.on_failed(payload)
+            return
 
-def render_playlist(channels: List[Channel], host: str,
-                    use_uncompressed_tvguide: bool, password: str) -> str:
-    """Render master playlist."""
-    with io.StringIO() as f:
-        base_url = furl(netloc=host, scheme='http', path=password)
-        tvg_compressed_ext = '' if use_uncompressed_tvguide else '.gz'
-        tvg_url = base_url / f'tvguide.xml{tvg_compressed_ext}'
-
-        f.write('#EXTM3U url-tvg="%s" refresh="1800"\n\n' % tvg_url)
-        for channel in channels:
-            if channel.get('stream_url'):
-                tvg_logo = base_url / 'logos' / (channel['stream_id'] + '.png')
-                stream_url = (furl(base_url,
-                                   path=base_url.pathstr + channel['stream_url'].pathstr,
-                                   query=channel['stream_url'].querystr)
-                              # No need to expose auth key to the master playlist
-                              .remove(args=['wmsAuthSign'])
-                              .tostr(query_dont_quote='='))
-
-                f.write(('#EXTINF:-1 tvg-id="{0[stream_id]}" tvg-logo="{1}" '
-                         'group-title="{0[category]}",{0[name]}\n'.format(channel, tvg_logo)))
-                f.write(f'{stream_url}\n\n')
+        if command == 'channels':
+            self.on_channels(payload)
+        elif command == 'keys':
+            self.on_auth_keys(payload)
 
-        return f.getvalue()
+        received, self.auth_keys_received = self.auth_keys_received, self.loop.create_future()
+        received.set_result(None)
 
+    async def renew(self, auth_key: AuthKey, key: str, timeout: float = 30) -> None:
+        """Have expired key renewed by the coordinator unless it's been already done."""
+        started_time = time.monotonic()
+        async with auth_key.lock:
+            auth_key.lock_wait_time += time.monotonic() - started_time
+            if auth_key.key != key or self.closed.done():
+                return
 
-async def collect_urls(channels: List[Channel], parallel: int) -> List[Channel]:
-    """Collect channel stream URLs from ustvgo.tv web players."""
-    logger.info('Extracting stream URLs from USTVGO. Parallel requests: %d.', parallel)
-    retrieve_tasks = [retrieve_stream_url(channel) for channel in channels]
-    channels = await gather_with_concurrency(parallel, *retrieve_tasks,
-                                             progress_title='Collect URLs')
+            received = self.auth_keys_received
+            self.connection.send(('renew', auth_key.is_vip, key))
+            try:
+                await asyncio.wait_for(asyncio.shield(received), timeout)
+            except asyncio.TimeoutError:
+                logger.error('%s Coordinator has not renewed auth key.', auth_key.log_prefix)
 
-    channels_ok = [x for x in channels if x]
-    report_msg = 'Extracted %d channels out of %d.'
-    if len(channels_ok) < len(channels):
-        report_msg += ' You can extract more using VPN.'
-    logger.info(report_msg, len(channels_ok), len(channels))
+    def mark_failed(self, stream_id: str) -> None:
+        """Have the coordinator rediscover the channel whose stream failed."""
+        if not self.closed.done():
+            self.connection.send(('failed', stream_id))
 
-    return channels_ok
+    def close(self) -> None:
+        if not self.closed.done():
+            self.loop.remove_reader(self.connection.fileno())
+            self.connection.close()
+            self.closed.set_result(None)
 
 
-async def update_auth_key(channel: Channel) -> Optional[str]:
-    """Update auth key."""
-    if await retrieve_stream_url(channel):
-        auth_key: str = channel['stream_url'].args.get('wmsAuthSign')
-        return auth_key
+def run_worker(connection: Connection, options: Dict[str, Any], state: Dict[str, Any]) -> None:
+    """Entry point of the worker process."""
+    if options['fast_loop']:
+        enable_fast_loop()
 
-    return None
+    try:
+        asyncio.run(playlist_server(**options, worker_connection=connection, worker_state=state))
+    except KeyboardInterrupt:
+        pass
 
 
-async def playlist_server(port: int, parallel: bool, tvguide_base_url: str,
+async def playlist_server(port: int, parallel: int, stream_parallel: int, tvguide_base_url: str,
                           access_logs: bool, icons_for_light_bg: bool,
-                          use_uncompressed_tvguide: bool, password: str) -> None:
+                          use_uncompressed_tvguide: bool, password: str,
+                          pool_size: int, dns_cache_ttl: int, upstream_keepalive: float,
+                          stream_chunk_size: int, stream_buffer_size: int,
+                          segment_cache_size: int, disk_cache_dir: Optional[str],
+                          disk_cache_size: int, prefetch_segments: int, prefetch_concurrency: int,
+                          asset_cache_dir: Optional[str], auth_key_refresh: bool,
+                          auth_key_lifetime_default: int, state_file: Optional[str],
+                          lazy: bool, lazy_ttl: int, enable_metrics: bool, workers: int,
+                          fast_loop: bool, fast_json: bool, ustvgo_url: str,
+                          rediscover_interval: int, max_upstream_requests: int,
+                          max_client_upstream_requests: int, max_upstream_buffer: int,
+                          max_client_upstream_buffer: int, client_rate: int, client_burst: int,
+                          channel_rate: int, channel_burst: int, client_ip_header: Optional[str],
+                          binds: Optional[List[str]],
+                          keepalive_timeout: float, backlog: int, reuse_port: bool,
+                          hedging: bool, origin_probe_interval: int, stats_interval: int,
+                          tvguide_local_icons: bool, tvguide_time_shift: int,
+                          worker_connection: Optional[Connection] = None,
+                          worker_state: Optional[Dict[str, Any]] = None) -> None:
     """Run proxying server with key rotation."""
+    options = {name: value for name, value in locals().items()
+               if name not in ('worker_connection', 'worker_state')}
+
+    if fast_json and not JSON.enable_orjson():
+        logger.warning('orjson is not installed, using json module.')
+    started_time = time.monotonic()
+
     async def master_handler(request: web.Request) -> web.Response:
         """Master playlist handler."""
-        return web.Response(
-            text=render_playlist(channels, request.host, use_uncompressed_tvguide, password)
-        )
+        try:
+            view = ChannelView.from_query(request.query.items())
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
+
+        if view.healthy or (lazy and view.vip is not None):
+            view = view._replace(excluded=frozenset(x for x in select_channels(view)
+                                                    if not is_listed(x, view)))
+        playlist = playlist_cache.get(request.host, password, str(use_uncompressed_tvguide),
+                                      view=view)
+        return playlist.response(request)
 
     async def logos_handler(request: web.Request) -> web.Response:
         """Channel logos handler."""
+        # Only logos of the channels, not to fetch and keep whatever is asked for
+        stream_id, _, extension = request.match_info['filename'].rpartition('.')
+        if extension != 'png' or stream_id not in listed_channels:
+            return web.Response(text='Logo not found!', status=404)
+
         color_scheme = 'for-light-bg' if icons_for_light_bg else 'for-dark-bg'
         logo_url = (furl(tvguide_base_url) / 'images/icons/channels' /
                     color_scheme / request.match_info.get('filename')).url
 
-        async with aiohttp.TCPConnector(ssl=False, force_close=True) as connector:
-            async with aiohttp.request(method=request.method, url=logo_url,
-                                       connector=connector) as response:
-                content = await response.read()
+        try:
+            logo = await asset_cache.get(logo_url, max_age=LOGOS_MAX_AGE)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            return web.Response(text=str(e), status=502)
 
-                return web.Response(
-                    body=content, status=response.status,
-                    content_type='image/png'
-                )
+        return logo.response(request, content_type='image/png')
+
+    async def tvguide_handler(request: web.Request) -> web.StreamResponse:
+        """TV Guide handler.
+
+        Transformed guide is streamed as it's processed and, on a miss, as it arrives
+        from upstream, the result is kept with the guide for the following requests.
+        """
+        try:
+            view = ChannelView.from_query(request.query.items())
+        except ValueError as e:
+            return web.Response(text=str(e), status=400)
 
-    async def tvguide_handler(request: web.Request) -> web.Response:
-        """TV Guide handler."""
         is_compressed = request.path.endswith('.gz')
-        compressed_ext = '.gz' if is_compressed else ''
         color_scheme = 'for-light-bg' if icons_for_light_bg else 'for-dark-bg'
-        tvguide_filename = f'ustvgo.{color_scheme}.xml{compressed_ext}'
+        # Only compressed version is downloaded, uncompressed one is derived from it
+        tvguide_filename = f'ustvgo.{color_scheme}.xml.gz'
         tvguide_url = furl(tvguide_base_url).add(path=tvguide_filename).url
 
-        async with aiohttp.TCPConnector(ssl=False, force_close=True) as connector:
-            async with aiohttp.request(method=request.method, url=tvguide_url,
-                                       connector=connector) as response:
-                content = await response.read()
-                content_type = 'application/gzip' if is_compressed else 'application/xml'
+        try:
+            tvguide = await asset_cache.open(tvguide_url, max_age=TVGUIDE_MAX_AGE)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            return web.Response(text=str(e), status=502)
 
-                return web.Response(
-                    body=content, status=response.status,
-                    content_type=content_type
-                )
+        if isinstance(tvguide, Asset) and tvguide.status != 200:
+            return tvguide.response(request, content_type='application/gzip')
+
+        # Channels of the view only, by their ids in the playlist and in the TV Guide
+        channel_ids = frozenset(y for x in select_channels(view)
+                                for y in (x, listed_channels[x]['tvguide_id'])) if view.query else None
+        logos_url = playlist_base_url(request.host, password).url + '/logos/'
+        icon_url = functools.partial(local_icon_url, logos_url=logos_url) \
+            if tvguide_local_icons else None
+        transforms = (sorted(channel_ids or ()), logos_url if icon_url else '', tvguide_time_shift)
+        variant = hashlib.md5(repr(transforms).encode()).hexdigest() \
+            if channel_ids is not None or icon_url or tvguide_time_shift else ''
+
+        # Plain guide is sent compressed to the clients accepting it
+        is_encoded = not is_compressed and \
+            'gzip' in request.headers.get(aiohttp.hdrs.ACCEPT_ENCODING, '').lower()
+        suffix = '' if is_compressed else '-gzip' if is_encoded else '-plain'
+        response_variant = (variant + suffix).lstrip('-')
+        content_type = 'application/gzip' if is_compressed else 'application/xml'
+        content_encoding = 'gzip' if is_encoded else None
+
+        content: Optional[bytes] = None
+        if isinstance(tvguide, Asset):
+            not_modified = tvguide.not_modified(request, response_variant)
+            if not_modified is not None:
+                return not_modified
+            content = tvguide.derived.get(variant) if variant else tvguide.body
+            if content is not None and (is_compressed or is_encoded):
+                return tvguide.response(request, content_type, body=content,
+                                        variant=response_variant, content_encoding=content_encoding)
 
-    async def stream_handler(request: web.Request) -> web.Response:
+        if content is not None:
+            chunks = iter_slices(content)
+        elif isinstance(tvguide, Asset):
+            chunks = iter_slices(tvguide.body)
+        else:
+            chunks = tvguide.iter_chunks()
+
+        transform = TvGuideTransform(channel_ids, icon_url,
+                                     datetime.timedelta(minutes=tvguide_time_shift)) \
+            if content is None and variant else None
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) \
+            if not (is_compressed or is_encoded) else None
+        loop = asyncio.get_event_loop()
+        response = web.StreamResponse(headers=asset_headers(tvguide.etag, tvguide.last_modified,
+                                                            response_variant))
+        response.content_type = content_type
+        if content_encoding is not None:
+            response.headers[aiohttp.hdrs.CONTENT_ENCODING] = content_encoding
+        if not is_compressed:
+            response.headers[aiohttp.hdrs.VARY] = aiohttp.hdrs.ACCEPT_ENCODING
+
+        async def write(chunk: bytes) -> None:
+            for piece in inflate(decompressor, chunk) if decompressor is not None else (chunk,):
+                if not piece:
+                    continue
+                if not response.prepared:
+                    await response.prepare(request)
+                await response.write(piece)
+
+        output: List[bytes] = []  # transformed guide to keep
+        try:
+            async for chunk in chunks:
+                if transform is not None:
+                    chunk = await loop.run_in_executor(None, transform.feed, chunk)
+                    output.append(chunk)
+                await write(chunk)
+
+            if transform is not None:
+                output.append(transform.close())
+                await write(output[-1])
+            if not response.prepared:
+                await response.prepare(request)
+            await response.write_eof(decompressor.flush() if decompressor is not None else b'')
+        except (asyncio.TimeoutError, aiohttp.ClientError, zlib.error, xml.sax.SAXException) as e:
+            if not response.prepared:
+                return web.Response(text=f'Bad TV Guide: {e}', status=502)
+            # Client sees a truncated response
+            logger.error('Streaming of %s interrupted: %s', request.path, e)
+            if request.transport is not None:
+                request.transport.close()
+            return response
+        except ConnectionResetError:
+            return response
+
+        asset = tvguide if isinstance(tvguide, Asset) else tvguide.asset
+        if transform is not None and asset is not None:
+            asset.keep(variant, b''.join(output))
+
+        return response
+
+    async def stream_handler(request: web.Request) -> web.StreamResponse:
         """Stream handler."""
-        stream_id = request.match_info.get('stream_id')
-        if stream_id not in streams:
+        try:
+            admission.check_rate(client_address(request, client_ip_header))
+        except AdmissionRejected as e:
+            return rejected_response(e)
+
+        stream_id = request.match_info['stream_id']
+        is_lazy_entry = request.match_info['tail'] == '/' + LAZY_PLAYLIST_NAME
+        if stream_id in lazy_channels and (is_lazy_entry or stream_id not in streams):
+            lazy_channel = await resolve_channel(stream_id)
+            if lazy_channel is None:
+                return web.Response(text='Stream is not available!', status=404)
+
+            if is_lazy_entry:
+                raise web.HTTPFound(password_prefix + lazy_channel.path_qs)
+
+        channel = streams.get(stream_id)
+        if channel is None:
             return web.Response(text='Stream not found!', status=404)
 
-        channel = streams[stream_id]
+        viewers.touch(stream_id, client_address(request, client_ip_header))
+
+        # Segments of parsed playlists are looked up, other paths are stripped of auth key
+        upstream_path_qs = request.path_qs[len(password_prefix):]
+        segment = segment_table.get(upstream_path_qs)
+        if segment is None:
+            upstream_path_qs = strip_auth_key(upstream_path_qs)
+
+        # Serve from cache or wait for the same resource requested by another client
+        if segment_cache.max_bytes and request.method == 'GET' and \
+                aiohttp.hdrs.RANGE not in request.headers:
+            cache_key = segment.cache_key if segment is not None else segment_cache.make_key(
+                stream_id, request.path[len(password_prefix):], request.query
+            )
+            entry = await segment_cache.lookup(cache_key)
+            if isinstance(entry, SegmentDownload):
+                return await entry.stream(request)
+
+            if entry is None:
+                flight = segment_cache.begin(cache_key)
+                try:
+                    response, entry = await fetch_admitted(request, channel, upstream_path_qs,
+                                                           cache_key)
+                finally:
+                    segment_cache.end(cache_key, flight, entry)
+            elif entry.playlist is not None:
+                response = playlist_response(request, entry)
+            else:
+                response = entry.response()
+
+            # Get ahead of the player with the upcoming segments
+            if entry is not None and entry.playlist is not None and \
+                    entry.playlist.target_duration is not None:
+                viewers.set_target_duration(stream_id, entry.playlist.target_duration)
+                prefetcher.schedule(stream_id, entry.playlist)
+
+            return response
+
+        response, _ = await fetch_admitted(request, channel, upstream_path_qs, cache_key=None)
+        return response
+
+    def rejected_response(e: AdmissionRejected) -> web.Response:
+        """Fast response to the request over the limit."""
+        return web.Response(text=str(e), status=e.status, headers={
+            aiohttp.hdrs.RETRY_AFTER: str(max(math.ceil(e.retry_after), 1))
+        })
+
+    async def fetch_admitted(request: web.Request, channel: ChannelRecord, upstream_path_qs: str,
+                             cache_key: Optional[str]
+                             ) -> Tuple[web.StreamResponse, Optional[CacheEntry]]:
+        """Fetch stream resource unless upstream request is over the limits."""
+        try:
+            ticket = admission.upstream(client_address(request, client_ip_header),
+                                        channel.stream_id)
+        except AdmissionRejected as e:
+            return rejected_response(e), None
+
+        with ticket:
+            return await fetch_stream(request, channel, upstream_path_qs, cache_key, ticket)
+
+    def playlist_response(request: web.Request, entry: CacheEntry) -> web.Response:
+        """Parsed upstream playlist with URLs of the proxy."""
+        assert entry.playlist is not None
+        body = entry.playlist.render(f'http://{request.host}{password_prefix}')
+        return web.Response(body=body, status=entry.status, headers=entry.headers)
+
+    async def fetch_segment(stream_id: str, upstream_path_qs: str) -> Optional[CacheEntry]:
+        """Fetch segment from upstream for the cache."""
+        channel = streams.get(stream_id)
+        if channel is None:
+            return None
+
+        origins = origin_registry.route(channel)
+        started_time = time.monotonic()
+        try:
+            async with origin_registry.request(
+                origins, 'GET', upstream_path_qs, auth_keys[channel.is_vip].key,
+                headers=USTVGO_HEADERS, raise_for_status=True
+            ) as (response, origin):
+                response_time = time.monotonic()
+                metrics.observe('upstream_ttfb_seconds', response_time - started_time,
+                                origin=origin)
+                metrics.inc('upstream_responses_total', origin=origin, status=str(response.status))
+                content = await response.read()
+                metrics.observe('upstream_fetch_seconds', time.monotonic() - started_time,
+                                origin=origin)
+                origin_registry.record_transfer(origin, len(content), time.monotonic() - response_time)
+                return CacheEntry(content, proxy_response_headers(response.headers))
+        except aiohttp.ClientResponseError as e:
+            origin = url_origin(str(e.request_info.url))
+            metrics.inc('upstream_responses_total', origin=origin, status=str(e.status))
+            if origin != channel.stream_origin and e.status in (403, 404):
+                origin_registry.exclude(origin, channel.stream_id)
+            raise
+
+    async def probe_origin(origin: str, is_vip: bool) -> None:
+        """Measure origin's response time with the playlist of a channel of the kind."""
+        auth_key = auth_keys[is_vip]
+        if not streams.by_vip[is_vip] or not auth_key.key:
+            return
+
+        channel = streams.by_vip[is_vip][0]
+        try:
+            async with origin_registry.request(
+                [origin], 'GET', channel.path_qs, auth_key.key,
+                headers=USTVGO_HEADERS, raise_for_status=True,
+                timeout=aiohttp.ClientTimeout(total=10)
+            ) as (response, _):
+                await response.read()
+        except aiohttp.ClientResponseError as e:
+            if origin != channel.stream_origin and e.status in (403, 404):
+                origin_registry.exclude(origin, channel.stream_id)
+        except (asyncio.TimeoutError, aiohttp.ClientError, CircuitOpenError) as e:
+            logger.debug('Probe of %s failed: %s', origin, e)
+
+    def notfound_playlist() -> web.Response:
+        """Placeholder playlist of unavailable stream."""
+        notfound_segment_url = furl(tvguide_base_url) / 'assets/404.ts'
+        return web.Response(text=(
+            '#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:10\n'
+            f'#EXTINF:10.000\n{notfound_segment_url}\n#EXT-X-ENDLIST'
+        ))
+
+    async def fetch_stream(request: web.Request, channel: ChannelRecord, upstream_path_qs: str,
+                           cache_key: Optional[str], ticket: UpstreamTicket
+                           ) -> Tuple[web.StreamResponse, Optional[CacheEntry]]:
+        """Fetch stream resource by upstream path with query (without auth key),
+        optionally keeping a cache entry of it under the key as long as the ticket
+        allows to buffer it."""
         headers = {name: value for name, value in request.headers.items()
-                   if name not in (aiohttp.hdrs.HOST, aiohttp.hdrs.USER_AGENT)}
+                   if name.lower() not in HOP_BY_HOP_HEADERS}
         headers = {**headers, **USTVGO_HEADERS}
 
         data = await request.read()
         max_retries = 2  # Second retry for 403-forbidden recovery or response payload errors
 
-        for retry in range(1, max_retries + 1):
-            upstream_url_part = request.path_qs[len(password_prefix):]
-            url = (furl(upstream_url_part)
-                   .set(origin=channel['stream_origin'],
-                        args={'wmsAuthSign': channel['auth_key']})
-                   ).tostr(query_dont_quote='=')
+        retry = 0
+        while retry < max_retries:
+            retry += 1
+            auth_key = auth_keys[channel.is_vip]
+            key = auth_key.key
+            origins = origin_registry.route(channel)
+            origin = origins[0]
+            # Slow segment requests are hedged by the next origin
+            hedge_delay = origin_registry.hedge_delay(origins) \
+                if request.method == 'GET' and not request.path.endswith('.m3u8') else None
 
+            started_time = time.monotonic()
             try:
-                async with aiohttp.TCPConnector(ssl=False, force_close=True) as connector:
-                    async with aiohttp.request(
-                        method=request.method, url=url, params=request.query, data=data,
-                        headers=headers, raise_for_status=True, connector=connector
-                    ) as response:
+                async with origin_registry.request(
+                    origins, request.method, upstream_path_qs, key, hedge_delay,
+                    data=data, headers=headers, raise_for_status=True
+                ) as (response, origin):
+                    response_time = time.monotonic()
+                    metrics.observe('upstream_ttfb_seconds', response_time - started_time,
+                                    origin=origin)
+                    metrics.inc('upstream_responses_total', origin=origin,
+                                status=str(response.status))
+
+                    resp_headers = proxy_response_headers(response.headers)
+                    cacheable = cache_key is not None and response.status == 200
 
+                    # Playlists are tiny, serve them at once
+                    if request.path.endswith('.m3u8'):
                         content = await response.read()
-                        headers = {name: value for name, value in response.headers.items()
-                                   if name not in
-                                   (aiohttp.hdrs.CONTENT_ENCODING, aiohttp.hdrs.CONTENT_LENGTH,
-                                    aiohttp.hdrs.TRANSFER_ENCODING, aiohttp.hdrs.CONNECTION)}
-
-                        return web.Response(
-                            body=content, status=response.status,
-                            headers=headers
+                        entry = CacheEntry(content, resp_headers, status=response.status,
+                                           ttl=playlist_ttl(content))
+
+                        metrics.observe('upstream_fetch_seconds', time.monotonic() - started_time,
+                                        origin=origin)
+                        metrics.inc('proxied_bytes_total', len(content), kind='m3u8')
+
+                        if response.status != 200:
+                            return entry.response(), None
+
+                        # Parsed once, served to the viewers with proxy URLs and without keys
+                        entry.playlist = parse_playlist(content, channel.stream_id,
+                                                        upstream_path_qs.partition('?')[0])
+                        segment_table.add(entry.playlist)
+                        return playlist_response(request, entry), entry if cacheable else None
+
+                    size = response.content_length \
+                        if aiohttp.hdrs.CONTENT_ENCODING not in response.headers else None
+
+                    # Segments to cache are read at upstream's pace into the download
+                    # shared with the clients requesting them meanwhile, each of them
+                    # including this one reads it at its own pace.
+                    client: 'Optional[asyncio.Future[web.StreamResponse]]' = None
+                    chunks: Optional[List[bytes]]
+                    if cache_key is not None and cacheable and size is not None and \
+                            size <= segment_cache.max_bytes and ticket.reserve(size):
+                        download = SegmentDownload(response.status, resp_headers, size)
+                        segment_cache.share(cache_key, download)
+                        client = asyncio.ensure_future(download.stream(request))
+                        completed = await download.fill(
+                            response.content.iter_chunked(stream_chunk_size)
+                        )
+                        received, chunks = download.received, download.chunks
+                    else:
+                        # Others wouldn't get it faster than this client reads it
+                        if cache_key is not None:
+                            segment_cache.share(cache_key, None)
+                        stream, received, completed, chunks = await forward_segment(
+                            request, response, resp_headers, size, ticket if cacheable else None
                         )
+
+                    metrics.observe('upstream_fetch_seconds', time.monotonic() - started_time,
+                                    origin=origin)
+                    metrics.inc('proxied_bytes_total', received, kind='ts')
+                    if completed:
+                        origin_registry.record_transfer(origin, received,
+                                                        time.monotonic() - response_time)
+
+                    # Segments are immutable, they live in cache until evicted
+                    segment_entry = CacheEntry(b''.join(chunks), resp_headers) \
+                        if chunks is not None and completed else None
+
+                # Upstream response is done with, the client might be still reading the download
+                if client is not None:
+                    stream = await client
+                return stream, segment_entry
+
+            except CircuitOpenError as e:
+                # Don't tie up the handler while origin is down
+                if request.path.endswith('.m3u8'):
+                    return notfound_playlist(), None
+                return web.Response(text=str(e), status=503, headers={
+                    aiohttp.hdrs.RETRY_AFTER: str(math.ceil(e.retry_after))
+                }), None
+
             except aiohttp.ClientResponseError as e:
+                origin = url_origin(str(e.request_info.url))
+                metrics.inc('upstream_responses_total', origin=origin, status=str(e.status))
+                # Stream isn't served by another origin, fall back to channel's own,
+                # it's not a retry, the origin isn't routed to anymore
+                if origin != channel.stream_origin and e.status in (403, 404):
+                    origin_registry.exclude(origin, channel.stream_id)
+                    retry -= 1
+                    continue
+
                 if retry >= max_retries:
-                    return web.Response(text=e.message, status=e.status)
+                    return web.Response(text=e.message, status=e.status), None
 
                 if request.path.endswith('.m3u8') and e.status == 404:
-                    notfound_segment_url = furl(tvguide_base_url) / 'assets/404.ts'
-                    return web.Response(text=(
-                        '#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:10\n'
-                        f'#EXTINF:10.000\n{notfound_segment_url}\n#EXT-X-ENDLIST'
-                    ))
+                    reconciler.mark_failed(channel.stream_id)
+                    if coordinator_link is not None:
+                        coordinator_link.mark_failed(channel.stream_id)
+                    return notfound_playlist(), None
 
-                auth_key = channel['auth_key']
-                async with auth_key.lock:
-                    if e.status == 403 and time.time() - auth_key.retrieved_time > 5:
-                        logger.info('%s Fetching new auth key from USTVGO.', auth_key.log_prefix)
-                        new_auth_key = await update_auth_key(channel)
-                        if new_auth_key:
-                            auth_key.key = new_auth_key
-                            logger.info('%s Got new auth key "%s"', auth_key.log_prefix, auth_key)
-                            auth_key.retrieved_time = time.time()
-                        else:
-                            logger.error('%s Failed to get new auth key!', auth_key.log_prefix)
+                # Key is normally refreshed in the background ahead of expiry,
+                # retry with the fresh one or renew it if there is none.
+                if e.status == 403:
+                    auth_key.expired(key)
+                    if coordinator_link is not None:
+                        await coordinator_link.renew(auth_key, key)
+                    else:
+                        await auth_key.renew(key, pool, channel.info)
+                elif upstream_failed(e):
+                    await asyncio.sleep(backoff_delay(retry, base=0.1))
 
             except aiohttp.ClientPayloadError as e:
                 if retry >= max_retries:
-                    return web.Response(text=str(e), status=500)
+                    return web.Response(text=str(e), status=500), None
+                await asyncio.sleep(backoff_delay(retry, base=0.1))
 
             except aiohttp.ClientError as e:
                 logger.error('[Retry %d/%d] Error occured during handling request: %s',
                              retry, max_retries, e, exc_info=True)
                 if retry >= max_retries:
-                    return web.Response(text=str(e), status=500)
+                    return web.Response(text=str(e), status=500), None
+                await asyncio.sleep(backoff_delay(retry, base=0.1))
 
-        return web.Response(text='', status=500)
+        return web.Response(text='', status=500), None
 
-    # Load channels info
-    channels = load_dict('channels.json')
+    async def forward_segment(request: web.Request, response: aiohttp.ClientResponse,
+                              headers: Mapping[str, str], size: Optional[int],
+                              ticket: Optional[UpstreamTicket]
+                              ) -> Tuple[web.StreamResponse, int, bool, Optional[List[bytes]]]:
+        """Forward segment chunk by chunk as it arrives, writes are drained, so slow client
+        slows down upstream reading instead of growing the buffer. Chunks are kept as long as
+        the ticket, if any, allows to buffer them. Return the response, bytes received,
+        whether the segment was read in full and the chunks kept."""
+        stream = web.StreamResponse(status=response.status, headers=headers)
+        if size is not None:
+            stream.content_length = size
+
+        chunks: Optional[List[bytes]] = [] if ticket is not None else None
+        received = 0
+        completed = False
+        try:
+            await stream.prepare(request)
+            async for chunk in response.content.iter_chunked(stream_chunk_size):
+                if ticket is not None and chunks is not None:
+                    chunks.append(chunk)
+                    # Don't hold segments that won't fit into the cache anyway
+                    # or the memory allowed to be buffered
+                    if received + len(chunk) > segment_cache.max_bytes or \
+                            not ticket.reserve(len(chunk)):
+                        chunks = None
+                        ticket.release()
+                await stream.write(chunk)
+                received += len(chunk)
+            await stream.write_eof()
+            completed = True
+        except (aiohttp.ClientError, ConnectionResetError) as e:
+            # Nothing can be retried once bytes were sent to the client,
+            # drop the connection so the client sees a truncated response.
+            logger.debug('Streaming of %s interrupted: %s', request.path, e)
+            if request.transport is not None:
+                request.transport.close()
 
-    # Retrieve available channels with their stream urls
-    channels = await collect_urls(channels, parallel)
+        return stream, received, completed, chunks
 
-    if not channels:
-        logger.error('No channels were retrieved!')
-        return
+    # Metrics
+    metrics = Metrics(enabled=enable_metrics)
+    metrics.describe('requests_total', 'counter', 'Served requests')
+    metrics.describe('request_duration_seconds', 'histogram', 'Request handling time')
+    metrics.describe('upstream_ttfb_seconds', 'histogram', 'Time to upstream response headers')
+    metrics.describe('upstream_fetch_seconds', 'histogram', 'Time to fetch upstream response')
+    metrics.describe('upstream_responses_total', 'counter', 'Upstream responses by status')
+    metrics.describe('proxied_bytes_total', 'counter', 'Bytes proxied from upstream')
+    metrics.describe('event_loop_lag_seconds', 'histogram', 'Event loop wake up delay')
+    metrics.describe('channel_viewers', 'gauge', 'Active viewers of the channel')
+    metrics.describe('upstream_concurrency_limit', 'gauge', 'Adaptive limit of upstream requests')
+    metrics.describe('upstream_in_flight', 'gauge', 'Upstream requests in flight')
+    metrics.describe('upstream_queued', 'gauge', 'Upstream requests waiting for the limit')
+    metrics.describe('upstream_latency_seconds', 'gauge', 'Moving average of upstream latency')
+    metrics.describe('upstream_circuit_open', 'gauge', 'Upstream is considered down')
+    metrics.describe('upstream_rejected_total', 'counter', 'Requests failed fast, upstream down')
+    metrics.describe('origin_score_seconds', 'gauge', 'Expected time to fetch a segment from origin')
+    metrics.describe('origin_ttfb_seconds', 'gauge', 'Moving average of origin TTFB')
+    metrics.describe('origin_ttfb_p95_seconds', 'gauge', 'Recent p95 of origin TTFB, hedging delay')
+    metrics.describe('origin_throughput_bytes', 'gauge', 'Moving average of segment download speed')
+    metrics.describe('origin_error_rate', 'gauge', 'Moving average of origin failures')
+    metrics.describe('admission_limit', 'gauge', 'Configured admission limit, 0 is unlimited')
+    metrics.describe('admission_rejected_total', 'counter', 'Requests rejected over the limit')
+    metrics.describe('admission_upstream_requests', 'gauge', 'Admitted upstream requests in flight')
+    metrics.describe('admission_upstream_bytes', 'gauge', 'Bytes buffered by upstream requests')
+    metrics.describe('admission_clients', 'gauge', 'Clients tracked by admission control')
+
+    # Upstream connection pool shared by all handlers
+    # with requests to every origin limited adaptively to what it can handle
+    limiter = UpstreamLimiter(initial_limit=parallel, max_limit=pool_size)
+    pool = UpstreamPool(pool_size=pool_size, dns_cache_ttl=dns_cache_ttl,
+                        keepalive_timeout=upstream_keepalive, read_bufsize=stream_buffer_size,
+                        limiter=limiter)
+    # Every origin seen serving the streams, channels fail over to the healthiest ones
+    origin_registry = OriginRegistry(pool, hedging=hedging, probe_interval=origin_probe_interval,
+                                     initial_limit=stream_parallel)
+
+    # TV Guide and logos
+    asset_cache = AssetCache(pool, pathlib.Path(asset_cache_dir) if asset_cache_dir else None)
+
+    # Cache of stream playlists and segments shared by the viewers of the same channel
+    # with optional disk tier for the segments evicted from memory
+    disk_cache = DiskCache(pathlib.Path(disk_cache_dir), max_bytes=disk_cache_size * 2 ** 20) \
+        if disk_cache_dir and disk_cache_size else None
+    segment_cache = SegmentCache(max_bytes=segment_cache_size * 2 ** 20, spill=disk_cache)
+    # Segments of the playlists served by the proxy
+    segment_table = SegmentTable()
+
+    # Bounds of memory and upstream requests a client or many of them can take up
+    admission = Admission(max_requests=max_upstream_requests,
+                          max_client_requests=max_client_upstream_requests,
+                          max_bytes=max_upstream_buffer * 2 ** 20,
+                          max_client_bytes=max_client_upstream_buffer * 2 ** 20,
+                          client_rate=client_rate, client_burst=client_burst,
+                          channel_rate=channel_rate, channel_burst=channel_burst)
+
+    # Prefetching upcoming segments of the channels being watched
+    viewers = ViewerTracker()
+    prefetcher = Prefetcher(segment_cache, viewers, fetch_segment,
+                            segments=prefetch_segments, concurrency=prefetch_concurrency)
+
+    async def stats_reporter() -> None:
+        """Log statistics periodically."""
+        while True:
+            await asyncio.sleep(stats_interval)
+            stats = {**pool.stats(), **limiter.stats(), **origin_registry.stats(), **admission.stats(),
+                     **reconciler.stats(),
+                     **segment_cache.stats(), **segment_table.stats(), **prefetcher.stats(),
+                     **asset_cache.stats(), **nonvip_auth_key.stats(), **vip_auth_key.stats()}
+            logger.info('Stats: %s', ', '.join(f'{name}={round(value, 3)}'
+                                               for name, value in stats.items()))
 
     # Auth keys
-    class AuthKey:
-        def __init__(self, is_vip: bool) -> None:
-            self.log_prefix = '[VIP (VPN)]' if is_vip else '[No VIP (No VPN)]'
-            self.key = ''
-            self.is_vip = is_vip
-            self.lock = asyncio.Lock()
-            self.retrieved_time = 0
+    nonvip_auth_key = AuthKey(is_vip=False, default_lifetime=auth_key_lifetime_default,
+                              ustvgo_url=ustvgo_url)
+    vip_auth_key = AuthKey(is_vip=True, default_lifetime=auth_key_lifetime_default,
+                           ustvgo_url=ustvgo_url)
+    auth_keys = [nonvip_auth_key, vip_auth_key]
+
+    # Served channels, swapped as a whole when they change
+    streams = ChannelRegistry()
+
+    # Multi-process mode, this process either coordinates the workers or is one of them
+    worker_pool: Optional[WorkerPool] = None
+    coordinator_link: Optional[CoordinatorLink] = None
+
+    def setup_channel(channel: ChannelRecord, renew_key: bool = False) -> None:
+        """Register stream origin, take auth key the channel came with."""
+        auth_key = auth_keys[channel.is_vip]
+        origin_registry.add(channel.stream_origin, channel.is_vip)
+
+        if not auth_key.key or renew_key:
+            auth_key.set(channel.key)
+        if not auth_key.channel:
+            auth_key.channel = channel.info
+
+    def publish_channels(collected_channels: List[ChannelRecord], renew_keys: bool = False,
+                         modified_time: Optional[float] = None) -> None:
+        """Start serving collected channels."""
+        nonlocal streams
 
-        def __str__(self) -> str:
-            return self.key
+        renewed_keys = set()
+        for channel in collected_channels:
+            setup_channel(channel, renew_key=renew_keys and channel.is_vip not in renewed_keys)
+            renewed_keys.add(channel.is_vip)
 
-    nonvip_auth_key = AuthKey(is_vip=False)
-    vip_auth_key = AuthKey(is_vip=True)
+        published = ChannelRegistry(collected_channels)
+        # Playlists are kept unless channels were added, removed or moved
+        changed = streams.changed(published)
+        streams = published
 
-    # Add stream origins, vip flags, auth keys
-    for channel in channels:
-        channel['stream_origin'] = channel['stream_url'].origin
-        channel['is_vip'] = '/vipStream/' in channel['stream_url'].url
-        channel['auth_key'] = vip_auth_key if channel['is_vip'] else nonvip_auth_key
+        if changed:
+            playlist_cache.invalidate((
+                datetime.datetime.fromtimestamp(modified_time, datetime.timezone.utc)
+                if modified_time else None
+            ))
+        if worker_pool is not None:
+            worker_pool.publish(dump_state(streams, auth_keys))
 
-        for auth_key in nonvip_auth_key, vip_auth_key:
-            if not auth_key.key and (channel['is_vip'] == auth_key.is_vip):
-                auth_key.key = channel['stream_url'].args.get('wmsAuthSign')
+    def update_channels(updated: List[ChannelRecord]) -> None:
+        """Swap in rediscovered channels, keep serving the others as they are."""
+        nonlocal streams
+        for channel in updated:
+            setup_channel(channel)
 
-    # Transform list into a map for better accessibility
-    streams = {x['stream_id']: x for x in channels}
+        streams = streams.replace(updated, listing_order)
+        playlist_cache.invalidate()
+        if worker_pool is not None:
+            worker_pool.publish(dump_state(streams, auth_keys))
+        if state_filepath:
+            save_state(state_filepath, streams, auth_keys)
+
+    def publish_coordinator_channels(state: Dict[str, Any]) -> None:
+        """Start serving channels pushed by the coordinator, same on every worker."""
+        publish_channels(apply_state(state, all_channels, auth_keys, ustvgo_url),
+                         modified_time=state['saved_time'])
+
+    async def renew_for_worker(is_vip: bool, key: str) -> None:
+        auth_key = vip_auth_key if is_vip else nonvip_auth_key
+        # Worker got 403 with the key, its lifetime is observed
+        auth_key.expired(key)
+        if auth_key.channel is not None:
+            await auth_key.renew(key, pool, auth_key.channel)
+
+    async def resolve_channel(stream_id: str) -> Optional[ChannelRecord]:
+        """Resolve stream URL of the channel on demand, concurrent calls share one scrape.
+        Expired channels are served while they're re-resolved in the background,
+        failed resolutions aren't retried for a while."""
+        channel = streams.get(stream_id)
+        now = time.time()
+        if now - unresolved_time.get(stream_id, 0) < LAZY_FAILURE_TTL:
+            return channel
+
+        if channel is None:
+            return await asyncio.shield(start_resolving(stream_id))
+
+        if now - resolved_time.get(stream_id, 0) >= lazy_ttl:
+            start_resolving(stream_id)
+        return channel
+
+    def start_resolving(stream_id: str) -> 'asyncio.Future[Optional[ChannelRecord]]':
+        future = resolving.get(stream_id)
+        if future is None:
+            future = resolving[stream_id] = asyncio.ensure_future(resolve_channel_url(stream_id))
+            future.add_done_callback(lambda _: resolving.pop(stream_id, None))
+        return future
+
+    async def resolve_channel_url(stream_id: str) -> Optional[ChannelRecord]:
+        nonlocal streams
+        channel = await retrieve_stream_url(lazy_channels[stream_id], pool, ustvgo_url=ustvgo_url)
+        if channel is None:
+            unresolved_time[stream_id] = time.time()
+            logger.warning('Failed to resolve channel %s.', stream_id)
+            return streams.get(stream_id)  # keep the old one
+
+        unresolved_time.pop(stream_id, None)
+        setup_channel(channel, renew_key=True)
+        streams = streams.replace([channel], listing_order)
+        resolved_time[stream_id] = time.time()
+        logger.info('Resolved channel %s.', stream_id)
+        return channel
+
+    async def recollect_urls() -> None:
+        """Re-scrape channels of warm start in the background."""
+        collected_channels = await collect_urls(all_channels, pool, show_progress=False,
+                                                ustvgo_url=ustvgo_url)
+        if collected_channels:
+            publish_channels(collected_channels, renew_keys=True)
+            logger.info('Refreshed %d channels.', len(streams))
+            if state_filepath:
+                save_state(state_filepath, streams, auth_keys)
+
+    def keys_snapshot() -> List[str]:
+        return [x.key for x in auth_keys]
+
+    async def state_saver() -> None:
+        """Save state when auth keys change."""
+        saved_keys = keys_snapshot()
+        while True:
+            await asyncio.sleep(60)
+            if state_filepath and keys_snapshot() != saved_keys:
+                saved_keys = keys_snapshot()
+                save_state(state_filepath, streams, auth_keys)
+
+    if workers > 1:
+        worker_pool = WorkerPool(workers, {**options, 'workers': 1, 'state_file': None,
+                                           'auth_key_refresh': False, 'stats_interval': 0},
+                                 renew=renew_for_worker,
+                                 mark_failed=lambda stream_id: reconciler.mark_failed(stream_id))
+
+    def select_channels(view: ChannelView) -> Tuple[str, ...]:
+        """Stream ids of the view, in lazy mode out of all the listed channels."""
+        return lazy_index.select(view) if lazy else streams.select(view)
+
+    def is_listed(stream_id: str, view: ChannelView) -> bool:
+        """Channel of the view is listed in its current state."""
+        channel = streams.get(stream_id)
+        if channel is None:
+            # Lazy mode channel yet to be resolved, vip flag is unknown
+            return view.vip is None
+
+        return (view.vip is None or channel.is_vip == view.vip) and \
+            (not view.healthy or (stream_id not in reconciler.failed
+                                  and origin_registry.is_available(channel)))
+
+    def listing(view: ChannelView) -> Iterable[Tuple[str, ...]]:
+        """Master playlist's entries of the view."""
+        if lazy:
+            return (lazy_entries[x] for x in select_channels(view) if x not in view.excluded)
+
+        records = streams.by_stream_id
+        return (records[x].entry for x in select_channels(view) if x not in view.excluded)
+
+    # Master playlists are rendered once per host and view
+    playlist_cache = PlaylistCache(
+        listing,
+        lambda host, view: render_playlist_header(host, use_uncompressed_tvguide, password,
+                                                  view.query),
+        lambda host: playlist_base_url(host, password).url
+    )
+
+    # Load channels info
+    all_channels: List[Channel] = load_dict('channels.json')
+
+    # Warm start with channels and auth keys of the previous run
+    state_filepath = pathlib.Path(state_file) if state_file else None
+    warm_channels = load_state(state_filepath, all_channels, auth_keys, ustvgo_url) \
+        if state_filepath else []
+    listing_order = [x['stream_id'] for x in all_channels]
+    listed_channels = {x['stream_id']: x for x in all_channels}
+    # Lazy mode channels, all listed and resolved on their first request
+    lazy_channels = listed_channels if lazy else {}
+    lazy_entries = {x['stream_id']: playlist_entry(x) for x in all_channels} if lazy else {}
+    lazy_index = ChannelIndex((x, None) for x in all_channels if lazy)
+    resolved_time: Dict[str, float] = {}
+    unresolved_time: Dict[str, float] = {}  # of the last failed resolution
+    resolving: Dict[str, 'asyncio.Future[Optional[ChannelRecord]]'] = {}
+    # Re-discovery of the channels that are missing or whose streams fail
+    reconciler = ChannelReconciler(all_channels, lambda: streams, update_channels, pool,
+                                   interval=rediscover_interval, ustvgo_url=ustvgo_url)
+    if worker_pool is not None:
+        worker_pool.watch(auth_keys, reconciler)
+
+    if worker_connection is not None and worker_state is not None:
+        # Channels and auth keys are maintained by the coordinator
+        publish_coordinator_channels(worker_state)
+        coordinator_link = CoordinatorLink(
+            worker_connection, on_channels=publish_coordinator_channels,
+            on_auth_keys=lambda dumped: apply_auth_keys(dumped, auth_keys),
+            on_failed=reconciler.set_failed
+        )
+    elif lazy:
+        logger.info('Lazy mode, %d channels are resolved on their first request.',
+                    len(all_channels))
+        for channel in warm_channels:
+            setup_channel(channel)
+            resolved_time[channel.stream_id] = time.time()
+        streams = ChannelRegistry(warm_channels)
+    elif warm_channels:
+        logger.info('Loaded %d channels from %s, refreshing them in the background.',
+                    len(warm_channels), state_filepath)
+        publish_channels(warm_channels)
+    else:
+        # Retrieve available channels with their stream urls
+        collected_channels = await collect_urls(all_channels, pool, ustvgo_url=ustvgo_url)
+
+        if not collected_channels:
+            logger.error('No channels were retrieved!')
+            await pool.close()
+            return
+
+        publish_channels(collected_channels)
+        if state_filepath:
+            save_state(state_filepath, streams, auth_keys)
 
     # Print auth keys
-    for auth_key in nonvip_auth_key, vip_auth_key:
-        if auth_key.key:
+    for auth_key in auth_keys:
+        if auth_key.key and coordinator_link is None:
             logger.info('%s Init auth key with "%s"', auth_key.log_prefix, auth_key)
 
-    if not nonvip_auth_key.key and not vip_auth_key.key:
+    if not nonvip_auth_key.key and not vip_auth_key.key and not lazy:
         logger.error('No auth keys were retrieved!')
+        await pool.close()
         return
 
     # Setup access logging
@@ -355,33 +3822,135 @@ async def playlist_server(port: int, parallel: bool, tvguide_base_url: str,
     else:
         access_logger.setLevel('ERROR')
 
+    @web.middleware
+    async def metrics_middleware(request: web.Request, handler: Handler) -> web.StreamResponse:
+        """Count requests and measure their latency per route."""
+        route = route_names.get(request.match_info.handler, 'other')
+        if route == 'stream':
+            route = 'stream_' + request.path.rsplit('.', 1)[-1] \
+                if request.path.endswith(('.m3u8', '.ts')) else 'stream_other'
+
+        started_time = time.monotonic()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            metrics.inc('requests_total', route=route, status=str(status))
+            metrics.observe('request_duration_seconds', time.monotonic() - started_time,
+                            route=route)
+
+    async def metrics_handler(request: web.Request) -> web.Response:
+        """Metrics handler."""
+        return web.Response(text=metrics.render(), content_type='text/plain',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    route_names: Dict[Any, str] = {master_handler: 'master', tvguide_handler: 'tvguide',
+                                   logos_handler: 'logos', stream_handler: 'stream',
+                                   metrics_handler: 'metrics'}
+
+    first_request_served = False
+
+    @web.middleware
+    async def startup_timer(request: web.Request, handler: Handler) -> web.StreamResponse:
+        """Report time to the first served request."""
+        nonlocal first_request_served
+        response = await handler(request)
+        if not first_request_served:
+            first_request_served = True
+            logger.info('First request served in %.2f s since startup.',
+                        time.monotonic() - started_time)
+        return response
+
     # Run server
-    app = web.Application()
+    middlewares = [startup_timer, metrics_middleware] if metrics.enabled else [startup_timer]
+    app = web.Application(middlewares=middlewares)
     app.router.add_get('/', master_handler)  # master shortcut
     app.router.add_get('/ustvgo.m3u8', master_handler)  # master
     app.router.add_get('/tvguide.xml', tvguide_handler)  # tvguide
     app.router.add_get('/tvguide.xml.gz', tvguide_handler)  # tvguide compressed
     app.router.add_get('/logos/{filename:[^/]+}', logos_handler)  # logos
+    if metrics.enabled:
+        app.router.add_get('/metrics', metrics_handler)  # metrics
     app.router.add_get('/{stream_id}{tail:/.*}', stream_handler)  # stream
 
+    async def close_connection(request: web.Request, response: web.StreamResponse) -> None:
+        """Tell the client the connection won't be kept alive."""
+        response.force_close()
+        response.headers[aiohttp.hdrs.CONNECTION] = 'close'
+
+    if not keepalive_timeout:
+        app.on_response_prepare.append(close_connection)
+
     password = password.strip()
     if password:
         password_prefix = f'/{password}'
         app_auth = web.Application()
         app_auth.add_subapp(password_prefix, app)
-        runner = web.AppRunner(app_auth)
+        runner = web.AppRunner(app_auth, keepalive_timeout=keepalive_timeout)
     else:
         password_prefix = ''
-        runner = web.AppRunner(app)
+        runner = web.AppRunner(app, keepalive_timeout=keepalive_timeout)
+
+    # All interfaces unless bound to the specific addresses or Unix sockets
+    binds = binds or ['']
+    for base_url in served_base_urls(binds, port) if coordinator_link is None else []:
+        logger.info(f'Serving {base_url}{password_prefix}/ustvgo.m3u8')
+        logger.info(f'Serving {base_url}{password_prefix}/tvguide.xml')
 
-    for ip_address in local_ip_addresses():
-        logger.info(f'Serving http://{ip_address}:{port}{password_prefix}/ustvgo.m3u8')
-        logger.info(f'Serving http://{ip_address}:{port}{password_prefix}/tvguide.xml')
+    # Expose components' statistics
+    for stats_source in (pool.stats, limiter.stats, origin_registry.stats, reconciler.stats,
+                         segment_cache.stats, segment_table.stats, prefetcher.stats, asset_cache.stats,
+                         nonvip_auth_key.stats, vip_auth_key.stats):
+        metrics.add_stats(stats_source)
+    metrics.add_collector(limiter.collect)
+    metrics.add_collector(origin_registry.collect)
+    metrics.add_collector(admission.collect)
+    metrics.add_collector(lambda: (('channel_viewers', (('channel', x),), viewers.viewers(x))
+                                   for x in list(viewers.last_seen)))
+
+    stats_task = asyncio.ensure_future(stats_reporter()) if stats_interval else None
+    lag_task = asyncio.ensure_future(measure_event_loop_lag(metrics)) \
+        if metrics.enabled and worker_pool is None else None
+    auth_key_refresher = AuthKeyRefresher(auth_keys, pool)
+    auth_key_task = asyncio.ensure_future(auth_key_refresher.run()) \
+        if auth_key_refresh else None
+    recollect_task = asyncio.ensure_future(recollect_urls()) \
+        if warm_channels and not lazy else None
+    reconcile_task = asyncio.ensure_future(reconciler.run()) \
+        if rediscover_interval and not lazy and coordinator_link is None else None
+    state_task = asyncio.ensure_future(state_saver()) if state_filepath else None
+    probe_task = asyncio.ensure_future(origin_registry.run(probe_origin)) \
+        if origin_probe_interval and worker_pool is None else None
 
     try:
+        if worker_pool is not None:
+            # Workers serve the port, here channels and auth keys are kept up to date for them
+            logger.info('Starting %d workers.', workers)
+            worker_pool.start(dump_state(streams, auth_keys))
+            await worker_pool.supervise()
+            logger.error('Workers failed to start, shutting down.')
+            return
+
         await runner.setup()
-        site = web.TCPSite(runner, port=port)
-        await site.start()
+        for bind in binds:
+            host, bind_port, path = parse_bind(bind, port)
+            site: web.BaseSite
+            if path is not None:
+                site = web.UnixSite(runner, path, backlog=backlog)
+            else:
+                # Workers share the port
+                site = web.TCPSite(runner, host, bind_port, backlog=backlog,
+                                   reuse_port=reuse_port or coordinator_link is not None)
+            await site.start()
+
+        if coordinator_link is not None:
+            await coordinator_link.closed
+            return
 
         # Sleep forever by 1 hour intervals,
         # on Windows before Python 3.8 wake up every 1 second to handle
@@ -394,7 +3963,20 @@ async def playlist_server(port: int, parallel: bool, tvguide_base_url: str,
         while True:
             await asyncio.sleep(delay)
     finally:
+        for task in (stats_task, lag_task, auth_key_task, recollect_task, reconcile_task, state_task,
+                     probe_task):
+            if task:
+                task.cancel()
+        prefetcher.close()
+        segment_cache.close()
+        if worker_pool is not None:
+            worker_pool.close()
+        if coordinator_link is not None:
+            coordinator_link.close()
         await runner.cleanup()  # cleanup used resources, release port
+        await pool.close()
+        if state_filepath:
+            save_state(state_filepath, streams, auth_keys)
 
 
 def service_command_handler(command: str, *exec_args: str) -> bool:
@@ -498,6 +4080,13 @@ def args_parser() -> argparse.ArgumentParser:
 
         return constrained_int
 
+    def bind_address(arg: str) -> str:
+        try:
+            parse_bind(arg, 0)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(f'{arg}: {e}')
+        return arg
+
     parser = argparse.ArgumentParser(
         'ustvgo-iptv', description='USTVGO Free IPTV.', add_help=False
     )
@@ -509,7 +4098,13 @@ def args_parser() -> argparse.ArgumentParser:
     parser.add_argument(
         '-t', '--parallel', metavar='N',
         type=int_range(min_value=1), default=10,
-        help='Number of parallel parsing requests (default: %(default)s)'
+        help='Initial number of parallel parsing requests, adapted to upstream (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--stream-parallel', metavar='N',
+        type=int_range(min_value=1), default=16,
+        help='Initial number of parallel stream requests per origin, adapted to upstream '
+             '(default: %(default)s)'
     )
     parser.add_argument(
         '--icons-for-light-bg', action='store_true',
@@ -530,12 +4125,209 @@ def args_parser() -> argparse.ArgumentParser:
         action='store_true',
         help='Use uncompressed version of TV Guide in "url-tvg" attribute'
     )
+    parser.add_argument(
+        '--tvguide-local-icons',
+        action='store_true',
+        help='Point channel icons of TV Guide to the local logos'
+    )
+    parser.add_argument(
+        '--tvguide-time-shift', metavar='MINUTES',
+        type=int_range(min_value=-24 * 60, max_value=24 * 60), default=0,
+        help='Shift programmes of TV Guide by the minutes (default: %(default)s)'
+    )
     parser.add_argument(
         '--password',
         type=quote_plus,
         default='',
         help='Add password to the path'
     )
+    parser.add_argument(
+        '--pool-size', metavar='N',
+        type=int_range(min_value=1), default=32,
+        help='Max number of pooled keep-alive connections per upstream origin (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--dns-cache-ttl', metavar='SECONDS',
+        type=int_range(min_value=0), default=300,
+        help='Upstream DNS cache TTL (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--upstream-keepalive', metavar='SECONDS',
+        type=float, default=30,
+        help='Keep-alive timeout of idle upstream connections (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--stream-chunk-size', metavar='BYTES',
+        type=int_range(min_value=1024), default=2 ** 16,
+        help='Size of chunks segments are streamed to the clients with (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--stream-buffer-size', metavar='BYTES',
+        type=int_range(min_value=1024), default=2 ** 18,
+        help='Max bytes buffered from upstream per streamed segment (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--segment-cache-size', metavar='MB',
+        type=int_range(min_value=0), default=64,
+        help='Size of in-memory stream segments cache, 0 to disable (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--disk-cache-dir', metavar='PATH',
+        help='Directory to spill segments evicted from memory cache to, wiped at startup'
+    )
+    parser.add_argument(
+        '--disk-cache-size', metavar='MB',
+        type=int_range(min_value=0), default=512,
+        help='Size of on-disk segments cache (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--prefetch-segments', metavar='N',
+        type=int_range(min_value=0), default=2,
+        help='Number of upcoming segments to prefetch for watched channels, 0 to disable '
+             '(default: %(default)s)'
+    )
+    parser.add_argument(
+        '--prefetch-concurrency', metavar='N',
+        type=int_range(min_value=1), default=4,
+        help='Max number of parallel prefetch requests (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--asset-cache-dir', metavar='PATH',
+        help='Directory to persist downloaded TV Guide and logos to'
+    )
+    parser.add_argument(
+        '--no-auth-key-refresh', dest='auth_key_refresh', action='store_false',
+        help='Renew auth keys only when they expire instead of ahead of time in the background'
+    )
+    parser.add_argument(
+        '--auth-key-lifetime', dest='auth_key_lifetime_default', metavar='SECONDS',
+        type=int_range(min_value=60), default=1800,
+        help='Expected auth key lifetime until one is declared in the key or observed '
+             '(default: %(default)s)'
+    )
+    parser.add_argument(
+        '--state-file', metavar='PATH',
+        help='File to save collected stream URLs and auth keys to, '
+             'so the next start serves right away while refreshing them in the background'
+    )
+    parser.add_argument(
+        '--lazy', action='store_true',
+        help='List all the channels right away and resolve their stream URLs on the first request'
+    )
+    parser.add_argument(
+        '--lazy-ttl', metavar='SECONDS',
+        type=int_range(min_value=0), default=3600,
+        help='Time to re-resolve stream URL of the channel in lazy mode (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--metrics', dest='enable_metrics', action='store_true',
+        help='Serve Prometheus metrics on /metrics'
+    )
+    parser.add_argument(
+        '--workers', metavar='N',
+        type=int_range(min_value=1), default=1,
+        help='Number of worker processes sharing the port (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--fast-loop', action='store_true',
+        help='Use uvloop event loop if it\'s installed'
+    )
+    parser.add_argument(
+        '--fast-json', action='store_true',
+        help='Use orjson for JSON if it\'s installed'
+    )
+    parser.add_argument(
+        '--ustvgo-url', metavar='URL', default=USTVGO_URL,
+        help='USTVGO web site URL to scrape stream URLs from'
+    )
+    parser.add_argument(
+        '--rediscover-interval', metavar='SECONDS',
+        type=int_range(min_value=0), default=300,
+        help='Interval of re-discovering missing, failed and moved channels in the background, '
+             '0 disables it (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--max-upstream-requests', metavar='N',
+        type=int_range(min_value=0), default=0,
+        help='Max number of upstream stream requests in flight, 0 is unlimited (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--max-client-upstream-requests', metavar='N',
+        type=int_range(min_value=0), default=0,
+        help='Max number of upstream stream requests in flight per client IP, 0 is unlimited '
+             '(default: %(default)s)'
+    )
+    parser.add_argument(
+        '--max-upstream-buffer', metavar='MB',
+        type=int_range(min_value=0), default=0,
+        help='Max size of segments buffered by upstream requests in flight, 0 is unlimited '
+             '(default: %(default)s)'
+    )
+    parser.add_argument(
+        '--max-client-upstream-buffer', metavar='MB',
+        type=int_range(min_value=0), default=0,
+        help='Max size of segments buffered by upstream requests in flight per client IP, '
+             '0 is unlimited (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--client-rate', metavar='N',
+        type=int_range(min_value=0), default=0,
+        help='Max stream requests per second per client IP, 0 is unlimited (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--client-burst', metavar='N',
+        type=int_range(min_value=1), default=50,
+        help='Stream requests per client IP allowed above the rate at once (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--client-ip-header', metavar='NAME',
+        help='Header a trusted reverse proxy puts client IP into, e.g. X-Forwarded-For, '
+             'to apply per-client limits by'
+    )
+    parser.add_argument(
+        '--channel-rate', metavar='N',
+        type=int_range(min_value=0), default=0,
+        help='Max upstream requests per second per channel, 0 is unlimited (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--channel-burst', metavar='N',
+        type=int_range(min_value=1), default=20,
+        help='Upstream requests per channel allowed above the rate at once (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--bind', dest='binds', metavar='ADDRESS', action='append', type=bind_address,
+        help='Address to listen on instead of all interfaces: HOST, HOST:PORT, [IPV6]:PORT '
+             'or unix:PATH, can be repeated'
+    )
+    parser.add_argument(
+        '--keepalive-timeout', metavar='SECONDS',
+        type=float, default=75,
+        help='Time to keep idle client connections open, 0 closes them after every response '
+             '(default: %(default)s)'
+    )
+    parser.add_argument(
+        '--backlog', metavar='N',
+        type=int_range(min_value=1), default=128,
+        help='Max number of pending client connections (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--reuse-port', action='store_true',
+        help='Set SO_REUSEPORT on listening sockets to share the port with other processes'
+    )
+    parser.add_argument(
+        '--no-hedging', dest='hedging', action='store_false',
+        help='Don\'t request slow segments from another origin too'
+    )
+    parser.add_argument(
+        '--origin-probe-interval', metavar='SECONDS',
+        type=int_range(min_value=0), default=30,
+        help='Interval of probing origins not used meanwhile, 0 disables it (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--stats-interval', metavar='SECONDS',
+        type=int_range(min_value=0), default=0,
+        help='Log cache and upstream statistics every N seconds, 0 to disable (default: %(default)s)'
+    )
     parser.add_argument(
         '-v', '--version', action='version', version=f'%(prog)s {VERSION}',
         help='Show program\'s version number and exit'
@@ -576,6 +4368,19 @@ def main() -> None:
                      if arg.startswith('-') or idx == 0]
         exit(args.invoke_subcommand(*exec_args))
 
+    if args.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error('--workers requires SO_REUSEPORT support')
+        if args.lazy:
+            parser.error('--workers is not supported in --lazy mode')
+        if any(x.startswith('unix:') for x in args.binds or []):
+            parser.error('--workers can\'t share Unix sockets')
+    if args.reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--reuse-port requires SO_REUSEPORT support')
+
+    if args.fast_loop and not enable_fast_loop():
+        logger.warning('uvloop is not installed, using default event loop.')
+
     # Run server
     try:
         asyncio.run(playlist_server(**vars(args)))